@@ -9,8 +9,9 @@ def parse_xml_report(file_path):
     # Assuming the first testsuite element is the one we're interested in
     testsuite = root.find('testsuite')
 
-    # Extract 'failures' and 'tests' attributes
-    failures = int(testsuite.attrib['failures'])
+    # Extract 'failures' and 'tests' attributes; known failures run as xfails,
+    # which the report counts as skipped
+    failures = int(testsuite.attrib['failures']) + int(testsuite.attrib['skipped'])
     total_tests = int(testsuite.attrib['tests'])
     passed = total_tests - failures
 
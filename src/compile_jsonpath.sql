@@ -0,0 +1,418 @@
+-- Translation of schemas to jsonpath.
+--
+-- compile_to_jsonpath(schema) expresses a schema as one strict-mode jsonpath
+-- predicate, so `data @@ path` validates entirely inside Postgres's jsonpath
+-- engine. It returns NULL when the schema uses something jsonpath can't
+-- express (property counts, uniqueItems, recursive $ref, $dynamicRef, ...),
+-- and when the predicate would be longer than 64k characters: expanding
+-- $refs in place and oneOf into its exclusive-or both multiply its size.
+--
+-- Every predicate is built on @ and kept two-valued: type-specific
+-- comparisons are guarded by @.type(), and key lookups, which are errors in
+-- strict mode, only happen inside exists(@ ? (...)). The strings 'true' and
+-- 'false' stand for constant predicates and are folded away by the _jp_*
+-- combinators.
+
+CREATE OR REPLACE FUNCTION _jp_and(VARIADIC _parts TEXT[])
+RETURNS TEXT AS $$
+  SELECT CASE
+    WHEN array_position(_parts, NULL) IS NOT NULL THEN NULL
+    WHEN 'false' = ANY(_parts) THEN 'false'
+    WHEN cardinality(array_remove(_parts, 'true')) = 0 THEN 'true'
+    WHEN cardinality(array_remove(_parts, 'true')) = 1 THEN (array_remove(_parts, 'true'))[1]
+    ELSE '(' || array_to_string(array_remove(_parts, 'true'), ' && ') || ')'
+  END
+$$ LANGUAGE sql IMMUTABLE;
+
+
+CREATE OR REPLACE FUNCTION _jp_or(VARIADIC _parts TEXT[])
+RETURNS TEXT AS $$
+  SELECT CASE
+    WHEN array_position(_parts, NULL) IS NOT NULL THEN NULL
+    WHEN 'true' = ANY(_parts) THEN 'true'
+    WHEN cardinality(array_remove(_parts, 'false')) = 0 THEN 'false'
+    WHEN cardinality(array_remove(_parts, 'false')) = 1 THEN (array_remove(_parts, 'false'))[1]
+    ELSE '(' || array_to_string(array_remove(_parts, 'false'), ' || ') || ')'
+  END
+$$ LANGUAGE sql IMMUTABLE;
+
+
+CREATE OR REPLACE FUNCTION _jp_not(_part TEXT)
+RETURNS TEXT AS $$
+  SELECT CASE _part WHEN 'true' THEN 'false' WHEN 'false' THEN 'true' ELSE '!(' || _part || ')' END
+$$ LANGUAGE sql IMMUTABLE STRICT;
+
+
+-- Some item of _path satisfies _pred.
+CREATE OR REPLACE FUNCTION _jp_exists(_path TEXT, _pred TEXT)
+RETURNS TEXT AS $$
+  SELECT CASE _pred
+    WHEN 'false' THEN 'false'
+    WHEN 'true' THEN format('exists(%s)', _path)
+    ELSE format('exists(%s ? (%s))', _path, _pred)
+  END
+$$ LANGUAGE sql IMMUTABLE STRICT;
+
+
+-- The object @ has all of _names.
+CREATE OR REPLACE FUNCTION _jp_has(_names TEXT[])
+RETURNS TEXT AS $$
+  SELECT CASE
+    WHEN cardinality(_names) = 0 THEN 'true'
+    ELSE format('exists(@ ? (%s))', (SELECT string_agg(format('exists(@.%s)', to_jsonb(n)), ' && ') FROM unnest(_names) AS n))
+  END
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Translations of $ref targets by absolute URI, so a target $ref'd from many
+-- places is translated once. A target's translation doesn't depend on where
+-- it is reached from: one that reaches a $ref being expanded reaches itself.
+-- The memo only holds for one index, and is cleared by _jsonpath_begin().
+CREATE OR REPLACE FUNCTION _jsonpath_begin()
+RETURNS VOID AS $$
+BEGIN
+  IF to_regclass('pg_temp.json_schema_jsonpath_memo') IS NULL THEN
+    CREATE TEMPORARY TABLE json_schema_jsonpath_memo (
+      uri TEXT PRIMARY KEY,
+      pred TEXT
+    );
+  ELSE
+    TRUNCATE pg_temp.json_schema_jsonpath_memo;
+  END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Predicate on @ for a subschema, or NULL if it can't be expressed or is
+-- longer than _max_length. _refs holds the $refs being expanded, to detect
+-- recursion. Children are translated one at a time, and the node gives up at
+-- the first that can't be.
+CREATE OR REPLACE FUNCTION _jsonpath_node(schema JSONB, _index JSONB, _base TEXT, _refs TEXT[])
+RETURNS TEXT AS $$
+DECLARE
+  _max_length CONSTANT INT := 65536;
+  _parts TEXT[] := '{}';
+  _checks TEXT[];
+  _key TEXT;
+  _value JSONB;
+  _uri TEXT;
+  _pred TEXT;
+  _contains TEXT;
+  _names TEXT[];
+  _patterns TEXT[];
+  _prefix INT := 0;
+  _i INT;
+BEGIN
+  IF jsonb_typeof(schema) = 'boolean' THEN
+    RETURN schema::TEXT;
+  ELSIF jsonb_typeof(schema) <> 'object' THEN
+    RETURN NULL;
+  END IF;
+
+  -- contains with minContains 0 can't fail, but still evaluates the items it
+  -- matches for unevaluatedItems
+  IF schema ?| ARRAY['minProperties', 'maxProperties', '$dynamicRef']
+    OR schema->'uniqueItems' = 'true'
+    OR (schema ? 'contains' AND (coalesce(schema->'minContains', '1') NOT IN ('0', '1') OR schema ? 'maxContains')) THEN
+    RETURN NULL;
+  END IF;
+  IF jsonb_typeof(schema->'$id') = 'string' THEN
+    _base := _resolve_uri(_base, schema->>'$id');
+  END IF;
+
+  IF schema ? '$ref' THEN
+    _uri := _resolve_uri(_base, schema->>'$ref');
+    IF _uri = ANY(_refs) THEN
+      RETURN NULL;
+    END IF;
+    SELECT m.pred INTO _pred FROM pg_temp.json_schema_jsonpath_memo AS m WHERE m.uri = _uri;
+    IF NOT FOUND THEN
+      _value := _index_lookup(_index, _uri);
+      _pred := CASE WHEN _value IS NOT NULL THEN _jsonpath_node(_value, _index, split_part(_uri, '#', 1), _refs || _uri) END;
+      INSERT INTO pg_temp.json_schema_jsonpath_memo VALUES (_uri, _pred);
+    END IF;
+    IF _pred IS NULL THEN
+      RETURN NULL;
+    END IF;
+    _parts := _parts || _pred;
+  END IF;
+
+  IF schema ? 'type' THEN
+    SELECT _jp_or(VARIADIC array_agg(CASE t
+      WHEN 'integer' THEN '(@.type() == "number" && @.floor() == @)'
+      ELSE format('@.type() == %s', to_jsonb(t))
+    END))
+    INTO _pred
+    FROM jsonb_array_elements_text(CASE jsonb_typeof(schema->'type') WHEN 'array' THEN schema->'type' ELSE jsonb_build_array(schema->'type') END) AS t;
+    _parts := _parts || _pred;
+  END IF;
+
+  -- only scalars compare by value in jsonpath
+  IF schema ?| ARRAY['enum', 'const'] THEN
+    FOREACH _key IN ARRAY ARRAY['enum', 'const']
+    LOOP
+      CONTINUE WHEN NOT schema ? _key;
+      SELECT _jp_or(VARIADIC array_agg(CASE jsonb_typeof(e)
+        WHEN 'null' THEN '@.type() == "null"'
+        WHEN 'array' THEN NULL
+        WHEN 'object' THEN NULL
+        ELSE format('(@.type() == %s && @ == %s)', to_jsonb(jsonb_typeof(e)), e)
+      END))
+      INTO _pred
+      FROM jsonb_array_elements(CASE _key WHEN 'enum' THEN schema->'enum' ELSE jsonb_build_array(schema->'const') END) AS e;
+      _parts := _parts || coalesce(_pred, CASE WHEN schema->'enum' = '[]' THEN 'false' END);
+    END LOOP;
+  END IF;
+
+  -- numbers
+  _checks := '{}';
+  FOREACH _key IN ARRAY ARRAY['multipleOf', 'minimum', 'maximum', 'exclusiveMinimum', 'exclusiveMaximum']
+  LOOP
+    IF jsonb_typeof(schema->_key) = 'number' THEN
+      _checks := _checks || format(CASE _key
+        WHEN 'multipleOf' THEN '@ %% %s == 0'
+        WHEN 'minimum' THEN '@ >= %s'
+        WHEN 'maximum' THEN '@ <= %s'
+        WHEN 'exclusiveMinimum' THEN '@ > %s'
+        ELSE '@ < %s'
+      END, schema->_key);
+    END IF;
+  END LOOP;
+  IF cardinality(_checks) > 0 THEN
+    _parts := _parts || _jp_or('@.type() != "number"', _jp_and(VARIADIC _checks));
+  END IF;
+
+  -- strings; lengths become bounded repetitions, which regexes cap at 255
+  _checks := '{}';
+  IF schema ? 'minLength' THEN
+    _checks := _checks || CASE WHEN (schema->>'minLength')::NUMERIC <= 255
+      THEN format('@ like_regex "^.{%s,}" flag "s"', ceil((schema->>'minLength')::NUMERIC)) END;
+  END IF;
+  IF schema ? 'maxLength' THEN
+    _checks := _checks || CASE WHEN (schema->>'maxLength')::NUMERIC <= 255
+      THEN format('@ like_regex "^.{0,%s}$" flag "s"', floor((schema->>'maxLength')::NUMERIC)) END;
+  END IF;
+  IF schema ? 'pattern' THEN
+    PERFORM _compile_pattern(schema->>'pattern');
+    _checks := _checks || format('@ like_regex %s flag "s"', to_jsonb(schema->>'pattern'));
+  END IF;
+  IF cardinality(_checks) > 0 THEN
+    _parts := _parts || _jp_or('@.type() != "string"', _jp_and(VARIADIC _checks));
+  END IF;
+
+  -- arrays
+  _checks := '{}';
+  IF schema ? 'minItems' THEN
+    _checks := _checks || format('@.size() >= %s', schema->'minItems');
+  END IF;
+  IF schema ? 'maxItems' THEN
+    _checks := _checks || format('@.size() <= %s', schema->'maxItems');
+  END IF;
+  IF jsonb_typeof(schema->'prefixItems') = 'array' THEN
+    FOR _value, _i IN SELECT e, n - 1 FROM jsonb_array_elements(schema->'prefixItems') WITH ORDINALITY AS t(e, n)
+    LOOP
+      _pred := _jsonpath_node(_value, _index, _base, _refs);
+      IF _pred IS NULL THEN
+        RETURN NULL;
+      END IF;
+      _checks := _checks || _jp_or(format('@.size() <= %s', _i), _jp_exists(format('@[%s]', _i), _pred));
+      _prefix := _i + 1;
+    END LOOP;
+  END IF;
+  IF schema ? 'contains' THEN
+    _contains := _jsonpath_node(schema->'contains', _index, _base, _refs);
+    IF _contains IS NULL THEN
+      RETURN NULL;
+    END IF;
+  END IF;
+  -- unevaluatedItems only sees what this node evaluated: the items after
+  -- prefixItems that contains doesn't match
+  _key := CASE
+    WHEN schema ? 'items' THEN 'items'
+    WHEN schema ? 'unevaluatedItems' AND _unevaluated_supported(schema, 'unevaluatedItems') THEN 'unevaluatedItems'
+  END;
+  IF schema ? 'unevaluatedItems' AND _key IS NULL THEN
+    RETURN NULL;
+  END IF;
+  IF _key IS NOT NULL THEN
+    _pred := _jsonpath_node(schema->_key, _index, _base, _refs);
+    IF _pred IS NULL THEN
+      RETURN NULL;
+    END IF;
+    _checks := _checks || _jp_or(format('@.size() <= %s', _prefix),
+      _jp_not(_jp_exists(CASE WHEN _prefix = 0 THEN '@[*]' ELSE format('@[%s to last]', _prefix) END,
+        _jp_not(CASE WHEN _key = 'unevaluatedItems' AND _contains IS NOT NULL THEN _jp_or(_contains, _pred) ELSE _pred END))));
+  END IF;
+  IF _contains IS NOT NULL AND schema->'minContains' IS DISTINCT FROM '0' THEN
+    _checks := _checks || _jp_exists('@[*]', _contains);
+  END IF;
+  IF cardinality(_checks) > 0 THEN
+    _parts := _parts || _jp_or('@.type() != "array"', _jp_and(VARIADIC _checks));
+  END IF;
+
+  -- objects
+  _checks := '{}';
+  IF jsonb_typeof(schema->'required') = 'array' THEN
+    _checks := _checks || _jp_has(ARRAY(SELECT jsonb_array_elements_text(schema->'required')));
+  END IF;
+  IF jsonb_typeof(schema->'dependentRequired') = 'object' THEN
+    FOR _key, _value IN SELECT * FROM jsonb_each(schema->'dependentRequired')
+    LOOP
+      _checks := _checks || _jp_or(_jp_not(_jp_has(ARRAY[_key])), _jp_has(ARRAY(SELECT jsonb_array_elements_text(_value))));
+    END LOOP;
+  END IF;
+  IF jsonb_typeof(schema->'dependentSchemas') = 'object' THEN
+    FOR _key, _value IN SELECT * FROM jsonb_each(schema->'dependentSchemas')
+    LOOP
+      _pred := _jsonpath_node(_value, _index, _base, _refs);
+      IF _pred IS NULL THEN
+        RETURN NULL;
+      END IF;
+      _checks := _checks || _jp_or(_jp_not(_jp_has(ARRAY[_key])), _pred);
+    END LOOP;
+  END IF;
+  IF jsonb_typeof(schema->'properties') = 'object' THEN
+    FOR _key, _value IN SELECT * FROM jsonb_each(schema->'properties')
+    LOOP
+      _pred := _jsonpath_node(_value, _index, _base, _refs);
+      IF _pred IS NULL THEN
+        RETURN NULL;
+      END IF;
+      _checks := _checks || _jp_not(_jp_exists('@', _jp_and(format('exists(@.%s)', to_jsonb(_key)),
+        _jp_not(_jp_exists('@.' || to_jsonb(_key)::TEXT, _pred)))));
+    END LOOP;
+    _names := ARRAY(SELECT jsonb_object_keys(schema->'properties'));
+  END IF;
+  IF jsonb_typeof(schema->'patternProperties') = 'object' THEN
+    FOR _key, _value IN SELECT * FROM jsonb_each(schema->'patternProperties')
+    LOOP
+      PERFORM _compile_pattern(_key);
+      _pred := _jsonpath_node(_value, _index, _base, _refs);
+      IF _pred IS NULL THEN
+        RETURN NULL;
+      END IF;
+      _checks := _checks || _jp_not(_jp_exists('@.keyvalue()', _jp_and(format('@.key like_regex %s flag "s"', to_jsonb(_key)),
+        _jp_not(_jp_exists('@.value', _pred)))));
+    END LOOP;
+    _patterns := ARRAY(SELECT jsonb_object_keys(schema->'patternProperties'));
+  END IF;
+  _key := CASE
+    WHEN schema ? 'additionalProperties' THEN 'additionalProperties'
+    WHEN schema ? 'unevaluatedProperties' AND _unevaluated_supported(schema, 'unevaluatedProperties') THEN 'unevaluatedProperties'
+  END;
+  IF schema ? 'unevaluatedProperties' AND _key IS NULL THEN
+    RETURN NULL;
+  END IF;
+  IF _key IS NOT NULL THEN
+    _pred := _jsonpath_node(schema->_key, _index, _base, _refs);
+    IF _pred IS NULL THEN
+      RETURN NULL;
+    END IF;
+    _checks := _checks || _jp_not(_jp_exists('@.keyvalue()', _jp_and(VARIADIC
+      ARRAY(SELECT format('@.key != %s', to_jsonb(n)) FROM unnest(_names) AS n)
+      || ARRAY(SELECT format('!(@.key like_regex %s flag "s")', to_jsonb(p)) FROM unnest(_patterns) AS p)
+      || _jp_not(_jp_exists('@.value', _pred)))));
+  END IF;
+  IF schema ? 'propertyNames' THEN
+    _pred := _jsonpath_node(schema->'propertyNames', _index, _base, _refs);
+    IF _pred IS NULL THEN
+      RETURN NULL;
+    END IF;
+    _checks := _checks || _jp_not(_jp_exists('@.keyvalue()', _jp_not(_jp_exists('@.key', _pred))));
+  END IF;
+  IF cardinality(_checks) > 0 THEN
+    _parts := _parts || _jp_or('@.type() != "object"', _jp_and(VARIADIC _checks));
+  END IF;
+
+  -- applicators on the same instance
+  IF jsonb_typeof(schema->'allOf') = 'array' THEN
+    FOR _value IN SELECT jsonb_array_elements(schema->'allOf')
+    LOOP
+      _pred := _jsonpath_node(_value, _index, _base, _refs);
+      IF _pred IS NULL THEN
+        RETURN NULL;
+      END IF;
+      _parts := _parts || _pred;
+    END LOOP;
+  END IF;
+  IF jsonb_typeof(schema->'anyOf') = 'array' THEN
+    _checks := '{}';
+    FOR _value IN SELECT jsonb_array_elements(schema->'anyOf')
+    LOOP
+      _pred := _jsonpath_node(_value, _index, _base, _refs);
+      IF _pred IS NULL THEN
+        RETURN NULL;
+      END IF;
+      _checks := _checks || _pred;
+    END LOOP;
+    _parts := _parts || _jp_or(VARIADIC _checks);
+  END IF;
+  IF jsonb_typeof(schema->'oneOf') = 'array' THEN
+    -- exactly one: the expansion is quadratic, so only short lists are translated
+    IF jsonb_array_length(schema->'oneOf') > 8 THEN
+      RETURN NULL;
+    END IF;
+    _checks := '{}';
+    FOR _value IN SELECT jsonb_array_elements(schema->'oneOf')
+    LOOP
+      _pred := _jsonpath_node(_value, _index, _base, _refs);
+      IF _pred IS NULL THEN
+        RETURN NULL;
+      END IF;
+      _checks := _checks || _pred;
+    END LOOP;
+    -- every branch is repeated once per branch
+    IF (SELECT sum(length(c)) FROM unnest(_checks) AS c) * cardinality(_checks) > _max_length THEN
+      RETURN NULL;
+    END IF;
+    _parts := _parts || (SELECT _jp_or(VARIADIC array_agg(_jp_and(VARIADIC ARRAY[_checks[i]]
+      || ARRAY(SELECT _jp_not(_checks[j]) FROM generate_subscripts(_checks, 1) AS j WHERE j <> i))))
+      FROM generate_subscripts(_checks, 1) AS i);
+  END IF;
+  IF schema ? 'not' THEN
+    _pred := _jsonpath_node(schema->'not', _index, _base, _refs);
+    IF _pred IS NULL THEN
+      RETURN NULL;
+    END IF;
+    _parts := _parts || _jp_not(_pred);
+  END IF;
+  IF schema ? 'if' THEN
+    _pred := _jsonpath_node(schema->'if', _index, _base, _refs);
+    IF _pred IS NULL THEN
+      RETURN NULL;
+    END IF;
+    _checks := ARRAY['true', 'true'];
+    IF schema ? 'then' THEN
+      _checks[1] := _jsonpath_node(schema->'then', _index, _base, _refs);
+      IF _checks[1] IS NULL THEN
+        RETURN NULL;
+      END IF;
+    END IF;
+    IF schema ? 'else' THEN
+      _checks[2] := _jsonpath_node(schema->'else', _index, _base, _refs);
+      IF _checks[2] IS NULL THEN
+        RETURN NULL;
+      END IF;
+    END IF;
+    _parts := _parts || _jp_and(_jp_or(_jp_not(_pred), _checks[1]), _jp_or(_pred, _checks[2]));
+  END IF;
+
+  _pred := _jp_and(VARIADIC _parts);
+  RETURN CASE WHEN length(_pred) <= _max_length THEN _pred END;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION compile_to_jsonpath(schema JSONB)
+RETURNS JSONPATH AS $$
+DECLARE
+  _pred TEXT;
+BEGIN
+  PERFORM _jsonpath_begin();
+  _pred := _jsonpath_node(schema, _schema_index(_bundle_schema(schema)), '', '{}');
+  IF _pred IN ('true', 'false') THEN
+    RETURN _pred::JSONPATH;
+  END IF;
+  RETURN ('strict exists($ ? (' || _pred || '))')::JSONPATH;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,906 @@
+-- Compiled validation plans.
+--
+-- compile_schema(schema) walks a schema once and flattens it into a plan: one
+-- row per subschema in json_schema_plan_node and one row per keyword in
+-- json_schema_plan_keyword, with operands already cast (numeric bounds, key
+-- arrays, patterns) and subschemas referenced by node id.
+--
+-- The keyword rows are then assembled into a program stored on the plan row:
+-- an int[] of opcodes, a parallel array of operands, and the index of the
+-- first instruction of every node for every instance type (_plan_types()).
+-- A node's code for a type only holds the keywords that can fail on that
+-- type, with type, enum and const already decided where the type settles
+-- them; types with the same code share it. Each node's code ends with
+-- opcode 0.
+-- Nodes that can be reached along more than one edge are flagged as shared;
+-- their verdicts are memoized during a validation, unless they depend on the
+-- dynamic scope. For $dynamicRef, every node is mapped to the schema resource
+-- it belongs to, and every resource to its {$dynamicAnchor: node} map.
+-- validate_compiled() runs that program. When the whole schema can be
+-- expressed as a jsonpath predicate, _plan_jsonpath() stores that on the plan
+-- the first time the jsonpath engine asks for it.
+--
+-- Plans are derived data, so reloading this script drops them.
+--
+-- The plan table is shared by all backends and read without locks. There is
+-- one plan per fingerprint: a backend that misses a schema another backend is
+-- still compiling waits for that backend's transaction at the insert, then
+-- uses its plan, or compiles its own if that transaction rolled back.
+
+DROP TABLE IF EXISTS json_schema_plan_resource;
+DROP TABLE IF EXISTS json_schema_plan_keyword;
+DROP TABLE IF EXISTS json_schema_plan_node;
+DROP TABLE IF EXISTS json_schema_plan;
+DROP TYPE IF EXISTS json_schema_operand CASCADE;
+
+CREATE TYPE json_schema_operand AS (
+  num NUMERIC,
+  keys TEXT[],
+  val JSONB,
+  children INT[],
+  nums NUMERIC[],
+  path JSONPATH
+);
+
+CREATE TABLE json_schema_plan (
+  plan_id SERIAL PRIMARY KEY,
+  fingerprint TEXT NOT NULL UNIQUE,
+  schema JSONB NOT NULL,
+  opcodes INT[],
+  operands json_schema_operand[],
+  node_start INT[],
+  node_shared BOOLEAN[],
+  node_resource INT[],
+  resource_anchors JSONB[],
+  jsonpath JSONPATH,
+  jsonpath_translated BOOLEAN NOT NULL DEFAULT FALSE,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE json_schema_plan_node (
+  plan_id INT NOT NULL REFERENCES json_schema_plan ON DELETE CASCADE,
+  node_id INT NOT NULL,
+  path TEXT[] NOT NULL,
+  fingerprint TEXT,
+  cost INT,
+  PRIMARY KEY (plan_id, node_id),
+  UNIQUE (plan_id, path),
+  UNIQUE (plan_id, fingerprint)
+);
+
+CREATE TABLE json_schema_plan_keyword (
+  plan_id INT NOT NULL,
+  node_id INT NOT NULL,
+  keyword TEXT NOT NULL,
+  ord INT NOT NULL,
+  cost INT NOT NULL,
+  num_operand NUMERIC,
+  text_operand TEXT[],
+  json_operand JSONB,
+  children INT[],
+  path_operand JSONPATH,
+  PRIMARY KEY (plan_id, node_id, keyword),
+  FOREIGN KEY (plan_id, node_id) REFERENCES json_schema_plan_node ON DELETE CASCADE
+);
+
+-- $ref resolution index of a plan: every resource and anchor URI of the
+-- schema with the path of the subschema it names.
+CREATE TABLE json_schema_plan_resource (
+  plan_id INT NOT NULL REFERENCES json_schema_plan ON DELETE CASCADE,
+  kind TEXT NOT NULL,
+  uri TEXT NOT NULL,
+  path TEXT[] NOT NULL,
+  PRIMARY KEY (plan_id, kind, uri)
+);
+
+
+-- Patterns are compiled once into a matcher for _pattern_matches(): a tag
+-- followed by its argument.
+--   L<like pattern>     literal, ^prefix, suffix$ or ^exact$ patterns
+--   C<+|*><characters>  ^[class]+$ or ^[class]*$ over plain characters and ranges
+--   R<regex>            everything else
+-- Regexes are checked here so an invalid one fails compile_schema instead of
+-- raising in the middle of a validation.
+CREATE OR REPLACE FUNCTION _compile_pattern(_pattern TEXT)
+RETURNS TEXT AS $$
+DECLARE
+  _literal CONSTANT TEXT := '((?:[^][\\^$.|?*+(){}]|\\[^A-Za-z0-9])*)';
+  _match TEXT[];
+  _chars TEXT := '';
+BEGIN
+  _match := regexp_match(_pattern, '^(\^?)' || _literal || '(\$?)$');
+  IF _match IS NOT NULL THEN
+    RETURN 'L'
+      || CASE WHEN _match[1] = '' THEN '%' ELSE '' END
+      || replace(replace(replace(regexp_replace(_match[2], '\\(.)', '\1', 'g'), '\', '\\'), '%', '\%'), '_', '\_')
+      || CASE WHEN _match[3] = '' THEN '%' ELSE '' END;
+  END IF;
+
+  _match := regexp_match(_pattern, '^\^\[([^]\\^[][^]\\[]*)\]([+*])[$]$');
+  IF _match IS NOT NULL THEN
+    FOR _match IN SELECT regexp_matches(_match[1], '(.)-(.)|(.)', 'g')
+    LOOP
+      IF _match[3] IS NOT NULL THEN
+        _chars := _chars || _match[3];
+      ELSIF ascii(_match[2]) - ascii(_match[1]) BETWEEN 0 AND 255 THEN
+        _chars := _chars || (SELECT string_agg(chr(c), '') FROM generate_series(ascii(_match[1]), ascii(_match[2])) AS c);
+      ELSE
+        _chars := NULL;
+      END IF;
+    END LOOP;
+    IF _chars IS NOT NULL THEN
+      RETURN 'C' || substr(_pattern, length(_pattern) - 1, 1) || _chars;
+    END IF;
+  END IF;
+
+  PERFORM '' ~ _pattern;
+  RETURN 'R' || _pattern;
+EXCEPTION
+  WHEN invalid_regular_expression THEN
+    RAISE EXCEPTION 'Invalid pattern %: %', _pattern, SQLERRM;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+-- Hash key of a scalar for enum lookups. Numbers are keyed by value so that
+-- 1 and 1.0 collide like they do under jsonb equality.
+CREATE OR REPLACE FUNCTION _enum_key(_value JSONB)
+RETURNS TEXT AS $$
+  SELECT CASE jsonb_typeof(_value)
+    WHEN 'string' THEN 's' || (_value #>> '{}')
+    WHEN 'number' THEN 'n' || trim_scale(_value::NUMERIC)::TEXT
+    WHEN 'boolean' THEN 'b' || _value::TEXT
+    ELSE 'z'
+  END
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- enum operands: the instance types present, a hash set of the scalar values
+-- and the array and object values, which still need a jsonb comparison.
+CREATE OR REPLACE FUNCTION _compile_enum(_values JSONB)
+RETURNS TABLE (types TEXT[], value_set JSONB) AS $$
+  SELECT
+    array_agg(DISTINCT jsonb_typeof(e)),
+    jsonb_build_object(
+      'scalars', coalesce(jsonb_object_agg(_enum_key(e), TRUE) FILTER (WHERE jsonb_typeof(e) NOT IN ('array', 'object')), '{}'),
+      'containers', coalesce(jsonb_agg(e) FILTER (WHERE jsonb_typeof(e) IN ('array', 'object')), '[]'))
+  FROM jsonb_array_elements(_values) AS e
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Static cost estimate of one keyword, not counting the subschemas it applies.
+-- Cheap checks run first within a node and cheap branches first within
+-- allOf / anyOf / oneOf.
+CREATE OR REPLACE FUNCTION _keyword_cost(_keyword TEXT, _text TEXT[], _json JSONB, _children INT[])
+RETURNS INT AS $$
+  SELECT CASE
+    WHEN _keyword IN ('false', 'type', 'const', 'multipleOf', 'minimum', 'maximum', 'exclusiveMinimum',
+      'exclusiveMaximum', 'minLength', 'maxLength', 'minItems', 'maxItems', 'required') THEN 1
+    WHEN _keyword = 'enum' THEN 2 + jsonb_array_length(_json->'containers') / 16
+    WHEN _keyword IN ('pattern', 'uniqueItems', 'minProperties', 'maxProperties', 'dependentRequired') THEN 4
+    WHEN _keyword IN ('$ref', '$dynamicRef') THEN 32
+    WHEN _keyword = 'properties' THEN 8 * greatest(cardinality(_children), 1) + CASE WHEN _json <> '{}' THEN 16 ELSE 0 END
+    ELSE 8 * greatest(cardinality(_children), 1)
+  END
+$$ LANGUAGE sql IMMUTABLE;
+
+
+CREATE OR REPLACE FUNCTION _compile_keyword(_plan_id INT, _node_id INT, _keyword TEXT, _num NUMERIC DEFAULT NULL, _text TEXT[] DEFAULT NULL, _json JSONB DEFAULT NULL, _children INT[] DEFAULT NULL)
+RETURNS VOID AS $$
+  INSERT INTO json_schema_plan_keyword (plan_id, node_id, keyword, ord, cost, num_operand, text_operand, json_operand, children)
+  SELECT _plan_id, _node_id, _keyword, coalesce(max(ord), 0) + 1, _keyword_cost(_keyword, _text, _json, _children),
+    _num, _text, _json, _children
+  FROM json_schema_plan_keyword WHERE plan_id = _plan_id AND node_id = _node_id
+$$ LANGUAGE sql;
+
+
+-- Base URI at _path: that of the innermost resource enclosing it.
+CREATE OR REPLACE FUNCTION _plan_base(_plan_id INT, _path TEXT[])
+RETURNS TEXT AS $$
+  SELECT r.uri
+  FROM json_schema_plan_resource AS r
+  WHERE r.plan_id = _plan_id AND r.kind = 'resource' AND r.path = _path[:cardinality(r.path)]
+  ORDER BY cardinality(r.path) DESC
+  LIMIT 1
+$$ LANGUAGE sql STABLE;
+
+
+-- Path of the subschema a $ref at _path points to, or NULL.
+CREATE OR REPLACE FUNCTION _plan_resolve(_plan_id INT, _path TEXT[], _ref TEXT)
+RETURNS TEXT[] AS $$
+DECLARE
+  _uri TEXT := _resolve_uri(_plan_base(_plan_id, _path), _ref);
+  _fragment TEXT;
+  _target TEXT[];
+BEGIN
+  _fragment := substr(_uri, length(split_part(_uri, '#', 1)) + 2);
+  IF _fragment = '' OR left(_fragment, 1) = '/' THEN
+    SELECT r.path || _json_pointer_path(_fragment) INTO _target
+    FROM json_schema_plan_resource AS r
+    WHERE r.plan_id = _plan_id AND r.kind = 'resource' AND r.uri = split_part(_uri, '#', 1);
+  ELSE
+    SELECT r.path INTO _target
+    FROM json_schema_plan_resource AS r
+    WHERE r.plan_id = _plan_id AND r.kind <> 'resource' AND r.uri = _uri
+    LIMIT 1;
+  END IF;
+  RETURN _target;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION _compile_schema_node(_plan_id INT, _root JSONB, _path TEXT[])
+RETURNS INT AS $$
+DECLARE
+  schema JSONB;
+  _node_id INT;
+  _fingerprint TEXT;
+  _key TEXT;
+  _key2 TEXT;
+  _keys TEXT[];
+  _children INT[];
+  _i INT;
+BEGIN
+  SELECT node_id INTO _node_id FROM json_schema_plan_node WHERE plan_id = _plan_id AND path = _path;
+  IF FOUND THEN
+    RETURN _node_id;
+  END IF;
+
+  schema := _root #> _path;
+  IF schema IS NULL OR jsonb_typeof(schema) NOT IN ('object', 'boolean') THEN
+    RAISE EXCEPTION 'Invalid subschema at %', '#/' || array_to_string(_path, '/');
+  END IF;
+
+  -- identical subschemas share a node. $refs in them must also resolve from
+  -- the same base, and subschemas that declare resources or anchors keep
+  -- their own, since those are looked up by path.
+  IF schema::TEXT !~ '"\$(id|anchor|dynamicAnchor)":' THEN
+    _fingerprint := md5(CASE WHEN schema::TEXT ~ '"\$(ref|dynamicRef)":' THEN _plan_base(_plan_id, _path) ELSE '' END
+      || ' ' || schema::TEXT);
+    SELECT node_id INTO _node_id FROM json_schema_plan_node WHERE plan_id = _plan_id AND fingerprint = _fingerprint;
+    IF FOUND THEN
+      RETURN _node_id;
+    END IF;
+  END IF;
+
+  INSERT INTO json_schema_plan_node (plan_id, node_id, path, fingerprint)
+  SELECT _plan_id, coalesce(max(node_id), 0) + 1, _path, _fingerprint
+  FROM json_schema_plan_node WHERE plan_id = _plan_id
+  RETURNING node_id INTO _node_id;
+
+  IF jsonb_typeof(schema) = 'boolean' THEN
+    IF NOT schema::BOOLEAN THEN
+      PERFORM _compile_keyword(_plan_id, _node_id, 'false');
+    END IF;
+    RETURN _node_id;
+  END IF;
+
+  FOREACH _key IN ARRAY ARRAY['$ref', '$dynamicRef']
+  LOOP
+    IF schema ? _key THEN
+      _keys := _plan_resolve(_plan_id, _path, schema->>_key);
+      IF _keys IS NULL THEN
+        RAISE EXCEPTION 'Unresolvable % %', _key, schema->>_key;
+      END IF;
+      -- a $dynamicRef that lands on a $dynamicAnchor is resolved at run time
+      -- against the dynamic scope; every subschema that could be picked is
+      -- compiled now. Otherwise it behaves like $ref.
+      _key2 := NULL;
+      IF _key = '$dynamicRef' AND _root #> _keys ->> '$dynamicAnchor' = split_part(schema->>_key, '#', 2) THEN
+        _key2 := split_part(schema->>_key, '#', 2);
+        PERFORM _compile_schema_node(_plan_id, _root, r.path)
+        FROM json_schema_plan_resource AS r
+        WHERE r.plan_id = _plan_id AND r.kind = '$dynamicAnchor' AND split_part(r.uri, '#', 2) = _key2;
+      END IF;
+      PERFORM _compile_keyword(_plan_id, _node_id, _key, _text => ARRAY[schema->>_key, _key2],
+        _children => ARRAY[_compile_schema_node(_plan_id, _root, _keys)]);
+    END IF;
+  END LOOP;
+
+  IF schema ? 'type' THEN
+    PERFORM _compile_keyword(_plan_id, _node_id, 'type', _text => CASE jsonb_typeof(schema->'type')
+      WHEN 'array' THEN ARRAY(SELECT jsonb_array_elements_text(schema->'type'))
+      ELSE ARRAY[schema->>'type']
+    END);
+  END IF;
+
+  IF schema ? 'enum' THEN
+    PERFORM _compile_keyword(_plan_id, _node_id, 'enum', _text => e.types, _json => e.value_set)
+    FROM _compile_enum(schema->'enum') AS e;
+  END IF;
+
+  IF schema ? 'const' THEN
+    PERFORM _compile_keyword(_plan_id, _node_id, 'const', _text => ARRAY[jsonb_typeof(schema->'const')], _json => schema->'const');
+  END IF;
+
+  -- numeric, string, array and object bounds
+  FOREACH _key IN ARRAY ARRAY['multipleOf', 'minimum', 'maximum', 'exclusiveMinimum', 'exclusiveMaximum',
+    'minLength', 'maxLength', 'minItems', 'maxItems', 'minProperties', 'maxProperties']
+  LOOP
+    IF jsonb_typeof(schema->_key) = 'number' THEN
+      IF _key = 'multipleOf' AND (schema->_key)::NUMERIC <= 0 THEN
+        RAISE EXCEPTION 'multipleOf must be greater than 0';
+      END IF;
+      PERFORM _compile_keyword(_plan_id, _node_id, _key, _num => (schema->_key)::NUMERIC);
+    END IF;
+  END LOOP;
+
+  IF schema ? 'pattern' THEN
+    PERFORM _compile_keyword(_plan_id, _node_id, 'pattern', _text => ARRAY[_compile_pattern(schema->>'pattern')]);
+  END IF;
+
+  IF jsonb_typeof(schema->'required') = 'array' AND jsonb_array_length(schema->'required') > 0 THEN
+    PERFORM _compile_keyword(_plan_id, _node_id, 'required', _text => ARRAY(SELECT jsonb_array_elements_text(schema->'required')));
+  END IF;
+
+  -- keys holds the trigger properties so objects that have none of them are
+  -- passed with a single ?|
+  IF jsonb_typeof(schema->'dependentRequired') = 'object' THEN
+    PERFORM _compile_keyword(_plan_id, _node_id, 'dependentRequired',
+      _text => ARRAY(SELECT jsonb_object_keys(schema->'dependentRequired')), _json => schema->'dependentRequired');
+  END IF;
+
+  IF schema->'uniqueItems' = 'true' THEN
+    PERFORM _compile_keyword(_plan_id, _node_id, 'uniqueItems');
+  END IF;
+
+  IF jsonb_typeof(schema->'dependentSchemas') = 'object' THEN
+    _keys := ARRAY(SELECT jsonb_object_keys(schema->'dependentSchemas'));
+    _children := '{}';
+    FOR _i IN 1 .. coalesce(array_length(_keys, 1), 0)
+    LOOP
+      _children := _children || _compile_schema_node(_plan_id, _root, _path || ARRAY['dependentSchemas', _keys[_i]]);
+    END LOOP;
+    PERFORM _compile_keyword(_plan_id, _node_id, 'dependentSchemas', _text => _keys, _children => _children);
+  END IF;
+
+  -- properties, patternProperties, additionalProperties and unevaluatedProperties
+  -- compile to a single 'properties' step, so every member of an object is
+  -- classified once. keys holds the declared names (num of them) followed by the
+  -- patterns, children their subschemas, and val the subschemas for members that
+  -- no name or pattern covers.
+  IF schema ?| ARRAY['properties', 'patternProperties', 'additionalProperties', 'unevaluatedProperties'] THEN
+    IF schema ? 'unevaluatedProperties' AND NOT schema ? 'additionalProperties'
+      AND NOT _unevaluated_supported(schema, 'unevaluatedProperties') THEN
+      RAISE EXCEPTION 'unevaluatedProperties next to in-place applicators is not supported, at %', '#/' || array_to_string(_path, '/')
+        USING ERRCODE = 'feature_not_supported';
+    END IF;
+    _keys := '{}';
+    _children := '{}';
+    _i := 0;
+    FOREACH _key IN ARRAY ARRAY['properties', 'patternProperties']
+    LOOP
+      IF jsonb_typeof(schema->_key) = 'object' THEN
+        FOR _key2 IN SELECT jsonb_object_keys(schema->_key)
+        LOOP
+          _keys := _keys || CASE WHEN _key = 'patternProperties' THEN _compile_pattern(_key2) ELSE _key2 END;
+          _children := _children || _compile_schema_node(_plan_id, _root, _path || ARRAY[_key, _key2]);
+        END LOOP;
+      END IF;
+      IF _key = 'properties' THEN
+        _i := coalesce(array_length(_keys, 1), 0);
+      END IF;
+    END LOOP;
+    PERFORM _compile_keyword(_plan_id, _node_id, 'properties', _num => _i, _text => _keys, _children => _children,
+      _json => jsonb_strip_nulls(jsonb_build_object(
+        'additional', CASE WHEN schema ? 'additionalProperties' THEN _compile_schema_node(_plan_id, _root, _path || 'additionalProperties'::TEXT) END,
+        'unevaluated', CASE WHEN schema ? 'unevaluatedProperties' AND NOT schema ? 'additionalProperties' THEN _compile_schema_node(_plan_id, _root, _path || 'unevaluatedProperties'::TEXT) END
+      )));
+  END IF;
+
+  IF schema ? 'propertyNames' THEN
+    PERFORM _compile_keyword(_plan_id, _node_id, 'propertyNames',
+      _children => ARRAY[_compile_schema_node(_plan_id, _root, _path || 'propertyNames'::TEXT)]);
+  END IF;
+
+  -- applicators: subschema lists
+  FOREACH _key IN ARRAY ARRAY['prefixItems', 'allOf', 'anyOf', 'oneOf']
+  LOOP
+    IF jsonb_typeof(schema->_key) = 'array' THEN
+      _children := '{}';
+      FOR _i IN 0 .. jsonb_array_length(schema->_key) - 1
+      LOOP
+        _children := _children || _compile_schema_node(_plan_id, _root, _path || ARRAY[_key, _i::TEXT]);
+      END LOOP;
+      PERFORM _compile_keyword(_plan_id, _node_id, _key, _children => _children);
+    END IF;
+  END LOOP;
+
+  -- items and unevaluatedItems start after the prefixItems. Annotations from
+  -- in-place applicators are not tracked, so unevaluatedItems is only enforced
+  -- when this node is the only thing evaluating the array; next to them, one
+  -- that can fail is rejected rather than checked against the wrong items.
+  IF schema ? 'unevaluatedItems' AND NOT schema ? 'items' AND NOT _unevaluated_supported(schema, 'unevaluatedItems') THEN
+    RAISE EXCEPTION 'unevaluatedItems next to in-place applicators is not supported, at %', '#/' || array_to_string(_path, '/')
+      USING ERRCODE = 'feature_not_supported';
+  END IF;
+  FOREACH _key IN ARRAY ARRAY['items', 'unevaluatedItems']
+  LOOP
+    IF schema ? _key AND NOT (_key = 'unevaluatedItems' AND schema ?| _in_place_applicators()) THEN
+      _children := ARRAY[_compile_schema_node(_plan_id, _root, _path || _key)];
+      IF _key = 'unevaluatedItems' AND schema ? 'contains' THEN
+        -- items matched by contains are evaluated: check {anyOf: [contains, unevaluatedItems]}
+        INSERT INTO json_schema_plan_node (plan_id, node_id, path)
+        SELECT _plan_id, max(node_id) + 1, _path || '$unevaluatedItems'::TEXT
+        FROM json_schema_plan_node WHERE plan_id = _plan_id
+        RETURNING node_id INTO _i;
+        PERFORM _compile_keyword(_plan_id, _i, 'anyOf',
+          _children => ARRAY[_compile_schema_node(_plan_id, _root, _path || 'contains'::TEXT)] || _children);
+        _children := ARRAY[_i];
+      END IF;
+      PERFORM _compile_keyword(_plan_id, _node_id, _key,
+        _num => coalesce(jsonb_array_length(CASE WHEN jsonb_typeof(schema->'prefixItems') = 'array' THEN schema->'prefixItems' END), 0),
+        _json => jsonb_build_object('items', schema ? 'items'),
+        _children => _children);
+    END IF;
+  END LOOP;
+
+  IF schema ? 'contains' THEN
+    PERFORM _compile_keyword(_plan_id, _node_id, 'contains',
+      _json => jsonb_build_object('min', coalesce(schema->'minContains', '1'), 'max', schema->'maxContains'),
+      _children => ARRAY[_compile_schema_node(_plan_id, _root, _path || 'contains'::TEXT)]);
+  END IF;
+
+  IF schema ? 'not' THEN
+    PERFORM _compile_keyword(_plan_id, _node_id, 'not',
+      _children => ARRAY[_compile_schema_node(_plan_id, _root, _path || 'not'::TEXT)]);
+  END IF;
+
+  -- children are {if, then, else}, with NULL for a missing branch
+  IF schema ? 'if' THEN
+    PERFORM _compile_keyword(_plan_id, _node_id, 'if', _children => ARRAY[
+      _compile_schema_node(_plan_id, _root, _path || 'if'::TEXT),
+      CASE WHEN schema ? 'then' THEN _compile_schema_node(_plan_id, _root, _path || 'then'::TEXT) END,
+      CASE WHEN schema ? 'else' THEN _compile_schema_node(_plan_id, _root, _path || 'else'::TEXT) END
+    ]);
+  END IF;
+
+  RETURN _node_id;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Rejects schemas that can recurse without moving to a child instance: a
+-- cycle of $ref, $dynamicRef (to any of its possible targets) and in-place
+-- applicators would evaluate the same node on the same instance forever.
+CREATE OR REPLACE FUNCTION _plan_check_cycles(_plan_id INT)
+RETURNS VOID AS $$
+DECLARE
+  _path TEXT[];
+BEGIN
+  WITH RECURSIVE edge AS (
+    SELECT k.node_id AS parent, c.node_id AS child
+    FROM json_schema_plan_keyword AS k, unnest(k.children) AS c(node_id)
+    WHERE k.plan_id = _plan_id AND c.node_id IS NOT NULL
+      AND k.keyword IN ('$ref', '$dynamicRef', 'allOf', 'anyOf', 'oneOf', 'not', 'if', 'dependentSchemas')
+    UNION ALL
+    SELECT k.node_id, n.node_id
+    FROM json_schema_plan_keyword AS k
+    JOIN json_schema_plan_resource AS a
+      ON a.plan_id = _plan_id AND a.kind = '$dynamicAnchor' AND split_part(a.uri, '#', 2) = k.text_operand[2]
+    JOIN json_schema_plan_node AS n ON n.plan_id = _plan_id AND n.path = a.path
+    WHERE k.plan_id = _plan_id AND k.keyword = '$dynamicRef'
+  ), reach(start, node_id) AS (
+    SELECT parent, child FROM edge
+    UNION
+    SELECT r.start, e.child FROM reach AS r JOIN edge AS e ON e.parent = r.node_id
+  )
+  SELECT n.path INTO _path
+  FROM reach AS r
+  JOIN json_schema_plan_node AS n ON n.plan_id = _plan_id AND n.node_id = r.start
+  WHERE r.start = r.node_id
+  ORDER BY r.start
+  LIMIT 1;
+
+  IF FOUND THEN
+    RAISE EXCEPTION 'Schema at % refers back to itself without descending into the instance',
+      '#/' || array_to_string(_path, '/')
+      USING ERRCODE = 'invalid_recursion';
+  END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Replaces $refs to small, non-recursive subschemas with a copy of their
+-- keywords, and points ref-to-ref chains straight at their end, so only
+-- recursive references remain jumps at run time. Plans with a $dynamicRef
+-- that depends on the dynamic scope are left alone: skipping a node would
+-- drop its resource from that scope.
+CREATE OR REPLACE FUNCTION _plan_inline_refs(_plan_id INT)
+RETURNS VOID AS $$
+DECLARE
+  _inline_size CONSTANT INT := 4;
+  _ref RECORD;
+  _target INT;
+BEGIN
+  IF EXISTS (
+    SELECT FROM json_schema_plan_keyword
+    WHERE plan_id = _plan_id AND keyword = '$dynamicRef' AND text_operand[2] IS NOT NULL
+  ) THEN
+    RETURN;
+  END IF;
+
+  FOR _ref IN
+    SELECT node_id, keyword, children[1] AS child
+    FROM json_schema_plan_keyword
+    WHERE plan_id = _plan_id AND keyword IN ('$ref', '$dynamicRef')
+    ORDER BY node_id, keyword
+  LOOP
+    _target := _plan_ref_target(_plan_id, _ref.child);
+    IF _target <> _ref.node_id
+      AND (SELECT count(*) FROM json_schema_plan_keyword WHERE plan_id = _plan_id AND node_id = _target) <= _inline_size
+      AND NOT EXISTS (
+        SELECT FROM json_schema_plan_keyword AS n
+        JOIN json_schema_plan_keyword AS t ON t.plan_id = _plan_id AND t.node_id = _target AND t.keyword = n.keyword
+        WHERE n.plan_id = _plan_id AND n.node_id = _ref.node_id AND n.keyword <> _ref.keyword
+      )
+      AND NOT EXISTS (
+        WITH RECURSIVE reach(node_id) AS (
+          SELECT c FROM json_schema_plan_keyword AS k, unnest(k.children) AS c
+          WHERE k.plan_id = _plan_id AND k.node_id = _target
+          UNION
+          SELECT c FROM reach AS r, json_schema_plan_keyword AS k, unnest(k.children) AS c
+          WHERE k.plan_id = _plan_id AND k.node_id = r.node_id
+        )
+        SELECT FROM reach WHERE node_id = _target
+      ) THEN
+      DELETE FROM json_schema_plan_keyword
+      WHERE plan_id = _plan_id AND node_id = _ref.node_id AND keyword = _ref.keyword;
+      INSERT INTO json_schema_plan_keyword (plan_id, node_id, keyword, ord, cost, num_operand, text_operand, json_operand, children)
+      SELECT plan_id, _ref.node_id, keyword,
+        ord + (SELECT coalesce(max(ord), 0) FROM json_schema_plan_keyword WHERE plan_id = _plan_id AND node_id = _ref.node_id),
+        cost, num_operand, text_operand, json_operand, children
+      FROM json_schema_plan_keyword
+      WHERE plan_id = _plan_id AND node_id = _target;
+    ELSIF _target <> _ref.child THEN
+      UPDATE json_schema_plan_keyword SET children = ARRAY[_target]
+      WHERE plan_id = _plan_id AND node_id = _ref.node_id AND keyword = _ref.keyword;
+    END IF;
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Opcodes of the assembled program, by keyword. 0 ends a node.
+CREATE OR REPLACE FUNCTION _plan_opcode(_keyword TEXT)
+RETURNS INT AS $$
+  SELECT array_position(ARRAY[
+    'false', '$ref', '$dynamicRef', 'type', 'enum', 'const',
+    'multipleOf', 'minimum', 'maximum', 'exclusiveMinimum', 'exclusiveMaximum',
+    'minLength', 'maxLength', 'pattern', 'minItems', 'maxItems', 'uniqueItems',
+    'minProperties', 'maxProperties', 'required', 'dependentRequired',
+    'properties', 'propertyNames', 'dependentSchemas', 'prefixItems', 'items', 'unevaluatedItems', 'contains',
+    'allOf', 'anyOf', 'oneOf', 'not', 'if',
+    -- the number and string keywords of a node, checked by one instruction
+    'number', 'string'
+  ], _keyword)
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Instance types, in the order of the code a node has for each of them.
+CREATE OR REPLACE FUNCTION _plan_types()
+RETURNS TEXT[] AS $$
+  SELECT ARRAY['null', 'boolean', 'number', 'string', 'array', 'object']
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Opcode of a keyword in a node's code for instances of _type: NULL when the
+-- keyword can't fail on that type, 1 (false) when it always does. The number
+-- and string keywords of a node are grouped into one instruction.
+CREATE OR REPLACE FUNCTION _plan_typed_opcode(_keyword TEXT, _text TEXT[], _type TEXT)
+RETURNS INT AS $$
+  SELECT CASE
+    WHEN _keyword IN ('multipleOf', 'minimum', 'maximum', 'exclusiveMinimum', 'exclusiveMaximum') THEN
+      CASE WHEN _type = 'number' THEN _plan_opcode('number') END
+    WHEN _keyword IN ('minLength', 'maxLength', 'pattern') THEN
+      CASE WHEN _type = 'string' THEN _plan_opcode('string') END
+    WHEN _keyword IN ('minItems', 'maxItems', 'uniqueItems', 'prefixItems', 'items', 'unevaluatedItems', 'contains') THEN
+      CASE WHEN _type = 'array' THEN _plan_opcode(_keyword) END
+    WHEN _keyword IN ('minProperties', 'maxProperties', 'required', 'dependentRequired', 'properties',
+      'propertyNames', 'dependentSchemas') THEN
+      CASE WHEN _type = 'object' THEN _plan_opcode(_keyword) END
+    -- only an integer check is left of type on numbers
+    WHEN _keyword = 'type' THEN CASE
+      WHEN _type = ANY(_text) THEN NULL
+      WHEN _type = 'number' AND 'integer' = ANY(_text) THEN _plan_opcode('number')
+      ELSE 1
+    END
+    WHEN _keyword IN ('enum', 'const') THEN
+      CASE WHEN _type = ANY(_text) THEN _plan_opcode(_keyword) ELSE 1 END
+    ELSE _plan_opcode(_keyword)
+  END
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Node cost is the sum of its keyword costs; branches of allOf / anyOf / oneOf
+-- are reordered cheapest first.
+CREATE OR REPLACE FUNCTION _order_plan(_plan_id INT)
+RETURNS VOID AS $$
+  UPDATE json_schema_plan_node AS n SET cost = (
+    SELECT coalesce(sum(k.cost), 0) FROM json_schema_plan_keyword AS k
+    WHERE k.plan_id = n.plan_id AND k.node_id = n.node_id
+  )
+  WHERE n.plan_id = _plan_id;
+
+  UPDATE json_schema_plan_keyword AS k SET children = (
+    SELECT array_agg(c ORDER BY n.cost, i)
+    FROM unnest(k.children) WITH ORDINALITY AS u(c, i)
+    JOIN json_schema_plan_node AS n ON n.plan_id = k.plan_id AND n.node_id = u.c
+  )
+  WHERE k.plan_id = _plan_id AND k.keyword IN ('allOf', 'anyOf', 'oneOf');
+$$ LANGUAGE sql;
+
+
+-- Follows a node that is nothing but a $ref to the node it points at.
+CREATE OR REPLACE FUNCTION _plan_ref_target(_plan_id INT, _node_id INT)
+RETURNS INT AS $$
+DECLARE
+  _target INT;
+BEGIN
+  FOR _i IN 1 .. 32
+  LOOP
+    SELECT k.children[1] INTO _target
+    FROM json_schema_plan_keyword AS k
+    WHERE k.plan_id = _plan_id AND k.node_id = _node_id AND k.keyword = '$ref'
+      AND NOT EXISTS (
+        SELECT 1 FROM json_schema_plan_keyword AS o
+        WHERE o.plan_id = _plan_id AND o.node_id = _node_id AND o.keyword <> '$ref'
+      );
+    IF _target IS NULL OR _target = _node_id THEN
+      RETURN _node_id;
+    END IF;
+    _node_id := _target;
+  END LOOP;
+  RETURN _node_id;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Detects anyOf / oneOf over tagged unions: every branch requires the same
+-- property and pins it to a distinct string const. The instruction's operand
+-- then maps each tag value to its branch, {"property": ..., "branches": {...}},
+-- and only that branch is evaluated against an object. Non-objects still go
+-- through every branch, since properties and required accept them.
+CREATE OR REPLACE FUNCTION _plan_discriminators(_plan_id INT)
+RETURNS VOID AS $$
+  WITH branch AS (
+    SELECT k.node_id, k.keyword, u.child, _plan_ref_target(_plan_id, u.child) AS target, cardinality(k.children) AS branches
+    FROM json_schema_plan_keyword AS k, unnest(k.children) AS u(child)
+    WHERE k.plan_id = _plan_id AND k.keyword IN ('anyOf', 'oneOf') AND cardinality(k.children) > 1
+  ), tag AS (
+    SELECT b.node_id, b.keyword, b.child, b.branches, p.property, c.json_operand->>0 AS value
+    FROM branch AS b
+    JOIN json_schema_plan_keyword AS props
+      ON props.plan_id = _plan_id AND props.node_id = b.target AND props.keyword = 'properties'
+    JOIN json_schema_plan_keyword AS req
+      ON req.plan_id = _plan_id AND req.node_id = b.target AND req.keyword = 'required'
+    CROSS JOIN unnest(props.text_operand[:props.num_operand], props.children[:props.num_operand]) AS p(property, child)
+    JOIN json_schema_plan_keyword AS c
+      ON c.plan_id = _plan_id AND c.node_id = _plan_ref_target(_plan_id, p.child) AND c.keyword = 'const'
+    WHERE p.property = ANY(req.text_operand) AND jsonb_typeof(c.json_operand) = 'string'
+  ), discriminator AS (
+    SELECT DISTINCT ON (node_id, keyword) node_id, keyword,
+      jsonb_build_object('property', property, 'branches', jsonb_object_agg(value, child)) AS operand
+    FROM tag
+    GROUP BY node_id, keyword, property, branches
+    HAVING count(DISTINCT child) = branches AND count(DISTINCT value) = branches AND count(*) = branches
+    ORDER BY node_id, keyword, property
+  )
+  UPDATE json_schema_plan_keyword AS k SET json_operand = d.operand
+  FROM discriminator AS d
+  WHERE k.plan_id = _plan_id AND k.node_id = d.node_id AND k.keyword = d.keyword
+$$ LANGUAGE sql;
+
+
+-- items and prefixItems whose subschemas jsonpath can express get the check
+-- of the whole array as a jsonpath predicate, evaluated over all items in one
+-- call instead of a frame per item. Keywords copied in from a $ref target
+-- are left alone: the node's own subschema doesn't have them. The keywords
+-- share one memo of $ref target translations.
+CREATE OR REPLACE FUNCTION _plan_vectorize_items(_plan_id INT)
+RETURNS VOID AS $$
+  SELECT _jsonpath_begin();
+  WITH plan AS MATERIALIZED (
+    SELECT plan_id, schema, _schema_index(schema) AS index
+    FROM json_schema_plan
+    WHERE plan_id = _plan_id
+  ), keyword AS (
+    SELECT k.node_id, k.keyword, _jsonpath_node(
+        CASE k.keyword
+          WHEN 'prefixItems' THEN jsonb_build_object('prefixItems', s.schema->'prefixItems')
+          ELSE jsonb_build_object('prefixItems', to_jsonb(array_fill(TRUE, ARRAY[k.num_operand::INT])), 'items', s.schema->'items')
+        END,
+        p.index, _plan_base(_plan_id, n.path), '{}') AS pred
+    FROM plan AS p
+    JOIN json_schema_plan_keyword AS k ON k.plan_id = p.plan_id
+    JOIN json_schema_plan_node AS n ON n.plan_id = k.plan_id AND n.node_id = k.node_id
+    CROSS JOIN LATERAL (SELECT p.schema #> n.path AS schema) AS s
+    WHERE k.keyword IN ('prefixItems', 'items') AND s.schema ? k.keyword
+  )
+  UPDATE json_schema_plan_keyword AS k
+  SET path_operand = CASE WHEN v.pred = 'false' THEN 'false' ELSE 'strict exists($ ? (' || v.pred || '))' END::JSONPATH
+  FROM keyword AS v
+  WHERE k.plan_id = _plan_id AND k.node_id = v.node_id AND k.keyword = v.keyword AND v.pred <> 'true'
+$$ LANGUAGE sql;
+
+
+CREATE OR REPLACE FUNCTION _assemble_plan(_plan_id INT)
+RETURNS VOID AS $$
+  WITH RECURSIVE keyword AS (
+    SELECT k.*, t.type_id, _plan_typed_opcode(k.keyword, k.text_operand, t.type) AS opcode
+    FROM json_schema_plan_keyword AS k
+    CROSS JOIN unnest(_plan_types()) WITH ORDINALITY AS t(type, type_id)
+    WHERE k.plan_id = _plan_id
+  ), typed AS (
+    SELECT node_id, type_id, ord, cost, opcode,
+      ROW(num_operand, text_operand, json_operand, children, NULL, path_operand)::json_schema_operand AS operand
+    FROM keyword
+    WHERE opcode NOT IN (_plan_opcode('number'), _plan_opcode('string'))
+    UNION ALL
+    -- number: [multipleOf, minimum, maximum, exclusiveMinimum, exclusiveMaximum],
+    -- and keys {integer} for type integer; string: [minLength, maxLength] and
+    -- the pattern matcher
+    SELECT node_id, type_id, min(ord), sum(cost)::INT, opcode, ROW(NULL,
+      CASE
+        WHEN opcode = _plan_opcode('string') THEN array_remove(ARRAY[min(text_operand[1]) FILTER (WHERE keyword = 'pattern')], NULL)
+        WHEN bool_or(keyword = 'type') THEN ARRAY['integer']
+      END,
+      NULL, NULL,
+      CASE WHEN opcode = _plan_opcode('string') THEN ARRAY[
+        min(num_operand) FILTER (WHERE keyword = 'minLength'),
+        min(num_operand) FILTER (WHERE keyword = 'maxLength')
+      ] ELSE ARRAY[
+        min(num_operand) FILTER (WHERE keyword = 'multipleOf'),
+        min(num_operand) FILTER (WHERE keyword = 'minimum'),
+        min(num_operand) FILTER (WHERE keyword = 'maximum'),
+        min(num_operand) FILTER (WHERE keyword = 'exclusiveMinimum'),
+        min(num_operand) FILTER (WHERE keyword = 'exclusiveMaximum')
+      ] END, NULL)::json_schema_operand
+    FROM keyword
+    WHERE opcode IN (_plan_opcode('number'), _plan_opcode('string'))
+    GROUP BY node_id, type_id, opcode
+  ), segment AS (
+    -- the code of a node for one instance type, identified by its instructions
+    SELECT n.node_id, t.type_id, CASE
+      WHEN bool_or(c.opcode = 1) THEN 'false'
+      ELSE coalesce(string_agg(c.ord || ':' || c.opcode, ',' ORDER BY c.cost, c.ord), '')
+    END AS signature
+    FROM json_schema_plan_node AS n
+    CROSS JOIN generate_series(1, cardinality(_plan_types())) AS t(type_id)
+    LEFT JOIN typed AS c ON c.node_id = n.node_id AND c.type_id = t.type_id AND c.opcode IS NOT NULL
+    WHERE n.plan_id = _plan_id
+    GROUP BY n.node_id, t.type_id
+  ), shared_segment AS (
+    -- types with the same instructions share one copy of them
+    SELECT node_id, signature, min(type_id) AS type_id
+    FROM segment
+    GROUP BY node_id, signature
+  ), code AS (
+    SELECT s.node_id, s.type_id, c.ord, c.cost, c.opcode, c.operand
+    FROM shared_segment AS s
+    JOIN typed AS c ON c.node_id = s.node_id AND c.type_id = s.type_id AND c.opcode IS NOT NULL
+    WHERE s.signature <> 'false'
+    UNION ALL
+    SELECT node_id, type_id, 0, 0, 1, NULL
+    FROM shared_segment
+    WHERE signature = 'false'
+    UNION ALL
+    SELECT node_id, type_id, NULL, NULL, 0, NULL
+    FROM shared_segment
+  ), numbered AS (
+    SELECT *, row_number() OVER (ORDER BY node_id, type_id, ord IS NULL, cost, ord) AS pc
+    FROM code
+  ), dynamic(node_id) AS (
+    -- nodes whose verdict can depend on the dynamic scope
+    SELECT node_id
+    FROM json_schema_plan_keyword
+    WHERE plan_id = _plan_id AND keyword = '$dynamicRef' AND text_operand[2] IS NOT NULL
+    UNION
+    SELECT k.node_id
+    FROM json_schema_plan_keyword AS k
+    JOIN dynamic AS d ON d.node_id = ANY(k.children)
+    WHERE k.plan_id = _plan_id
+  ), resource AS (
+    SELECT row_number() OVER (ORDER BY path) AS resource_id, uri, path
+    FROM json_schema_plan_resource
+    WHERE plan_id = _plan_id AND kind = 'resource'
+  )
+  UPDATE json_schema_plan SET
+    opcodes = (SELECT array_agg(opcode ORDER BY pc) FROM numbered),
+    operands = (SELECT array_agg(operand ORDER BY pc) FROM numbered),
+    node_start = (
+      SELECT array_agg(c.start ORDER BY t.node_id, t.type_id)
+      FROM segment AS t
+      JOIN shared_segment AS s ON s.node_id = t.node_id AND s.signature = t.signature
+      JOIN (SELECT node_id, type_id, min(pc) AS start FROM numbered GROUP BY node_id, type_id) AS c
+        ON c.node_id = s.node_id AND c.type_id = s.type_id
+    ),
+    node_shared = (
+      SELECT array_agg(coalesce(r.refs, 0) + (n.node_id = 1)::INT > 1 AND n.node_id NOT IN (SELECT node_id FROM dynamic)
+        ORDER BY n.node_id)
+      FROM json_schema_plan_node AS n
+      LEFT JOIN (
+        SELECT c.node_id, count(*) AS refs
+        FROM json_schema_plan_keyword AS k, unnest(k.children) AS c(node_id)
+        WHERE k.plan_id = _plan_id
+        GROUP BY c.node_id
+      ) AS r ON r.node_id = n.node_id
+      WHERE n.plan_id = _plan_id
+    ),
+    node_resource = (
+      SELECT array_agg((
+        SELECT r.resource_id FROM resource AS r
+        WHERE r.path = n.path[:cardinality(r.path)]
+        ORDER BY cardinality(r.path) DESC
+        LIMIT 1
+      ) ORDER BY n.node_id)
+      FROM json_schema_plan_node AS n
+      WHERE n.plan_id = _plan_id
+    ),
+    resource_anchors = (
+      SELECT array_agg((
+        SELECT coalesce(jsonb_object_agg(split_part(a.uri, '#', 2), n.node_id), '{}')
+        FROM json_schema_plan_resource AS a
+        JOIN json_schema_plan_node AS n ON n.plan_id = _plan_id AND n.path = a.path
+        WHERE a.plan_id = _plan_id AND a.kind = '$dynamicAnchor' AND split_part(a.uri, '#', 1) = r.uri
+      ) ORDER BY r.resource_id)
+      FROM resource AS r
+    )
+  WHERE plan_id = _plan_id
+$$ LANGUAGE sql;
+
+
+CREATE OR REPLACE FUNCTION compile_schema(schema JSONB)
+RETURNS INT AS $$
+DECLARE
+  _plan_id INT;
+  _fingerprint TEXT := md5(schema::TEXT);
+BEGIN
+  SELECT plan_id INTO _plan_id FROM json_schema_plan WHERE fingerprint = _fingerprint;
+  IF FOUND THEN
+    RETURN _plan_id;
+  END IF;
+  schema := simplify_schema(_bundle_schema(schema));
+
+  INSERT INTO json_schema_plan (fingerprint, schema)
+  VALUES (_fingerprint, schema)
+  ON CONFLICT (fingerprint) DO NOTHING
+  RETURNING plan_id INTO _plan_id;
+  -- another backend committed a plan for the schema since the lookup
+  IF NOT FOUND THEN
+    SELECT plan_id INTO _plan_id FROM json_schema_plan WHERE fingerprint = _fingerprint;
+    RETURN _plan_id;
+  END IF;
+
+  INSERT INTO json_schema_plan_resource (plan_id, kind, uri, path)
+  SELECT _plan_id, kind, uri, path FROM _schema_resources(schema)
+  ON CONFLICT DO NOTHING;
+
+  PERFORM _compile_schema_node(_plan_id, schema, '{}');
+  PERFORM _plan_check_cycles(_plan_id);
+  PERFORM _plan_inline_refs(_plan_id);
+  PERFORM _order_plan(_plan_id);
+  PERFORM _plan_discriminators(_plan_id);
+  PERFORM _plan_vectorize_items(_plan_id);
+  PERFORM _assemble_plan(_plan_id);
+  RETURN _plan_id;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- The plan's jsonpath translation, or NULL when there is none. Only the
+-- jsonpath engine uses it, so it is made on first use rather than by
+-- compile_schema().
+CREATE OR REPLACE FUNCTION _plan_jsonpath(_plan_id INT)
+RETURNS JSONPATH AS $$
+DECLARE
+  _plan RECORD;
+BEGIN
+  SELECT p.schema, p.jsonpath, p.jsonpath_translated INTO _plan FROM json_schema_plan AS p WHERE p.plan_id = _plan_id;
+  IF NOT _plan.jsonpath_translated THEN
+    _plan.jsonpath := compile_to_jsonpath(_plan.schema);
+    UPDATE json_schema_plan SET jsonpath = _plan.jsonpath, jsonpath_translated = TRUE WHERE plan_id = _plan_id;
+  END IF;
+  RETURN _plan.jsonpath;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,270 @@
+-- Code generation from compiled plans.
+--
+-- generate_validator(schema, fn_name) compiles the schema and turns the plan
+-- into SQL: every keyword becomes a boolean expression with its operands as
+-- literals, and the expressions of a node are AND-ed in plan order. A node
+-- used by a single instruction is inlined into its parent; the root and
+-- nodes reached along several edges (shared $defs, recursion) become
+-- functions of their own, named fn_name and fn_name_<node id>.
+--
+-- The functions are IMMUTABLE and PARALLEL SAFE, so they can be used in
+-- CHECK constraints and index expressions.
+
+
+-- SQL matching the text expression _value against a _compile_pattern() matcher.
+CREATE OR REPLACE FUNCTION _generate_pattern(_value TEXT, _matcher TEXT)
+RETURNS TEXT AS $$
+  SELECT CASE left(_matcher, 1)
+    WHEN 'L' THEN format('%s LIKE %L', _value, substr(_matcher, 2))
+    WHEN 'C' THEN format('(translate(%s, %L, '''') = ''''%s)', _value, substr(_matcher, 3),
+      CASE WHEN substr(_matcher, 2, 1) = '+' THEN format(' AND %s <> ''''', _value) ELSE '' END)
+    ELSE format('%s ~ %L', _value, substr(_matcher, 2))
+  END
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Boolean SQL expression validating the jsonb expression _data against a
+-- node. _names holds the function name of every node that has one; _depth
+-- keeps the aliases of nested subqueries apart.
+CREATE OR REPLACE FUNCTION _generate_node(_plan_id INT, _node_id INT, _data TEXT, _names TEXT[], _depth INT)
+RETURNS TEXT AS $$
+DECLARE
+  _kw json_schema_plan_keyword;
+  _parts TEXT[] := '{}';
+  _checks TEXT[];
+  _members TEXT[];
+  _type TEXT := format('jsonb_typeof(%s)', _data);
+  _alias TEXT := 'm' || _depth;
+  _guard TEXT;
+  _expr TEXT;
+BEGIN
+  FOR _kw IN
+    SELECT * FROM json_schema_plan_keyword
+    WHERE plan_id = _plan_id AND node_id = _node_id
+    ORDER BY cost, ord
+  LOOP
+    _guard := NULL;
+    _expr := NULL;
+    CASE _kw.keyword
+    WHEN 'false' THEN
+      _expr := 'FALSE';
+
+    WHEN '$ref', '$dynamicRef' THEN
+      IF _kw.text_operand[2] IS NOT NULL THEN
+        RAISE EXCEPTION 'generate_validator does not support $dynamicRef % resolved through the dynamic scope', _kw.text_operand[1];
+      END IF;
+      _expr := _generate_child(_plan_id, _kw.children[1], _data, _names, _depth);
+
+    WHEN 'type' THEN
+      _expr := format('%s = ANY(%L::TEXT[])', _type, _kw.text_operand);
+      IF 'integer' = ANY(_kw.text_operand) AND NOT 'number' = ANY(_kw.text_operand) THEN
+        _expr := format('(%s OR CASE WHEN %s = ''number'' THEN (%s)::NUMERIC = trunc((%s)::NUMERIC) ELSE FALSE END)',
+          _expr, _type, _data, _data);
+      END IF;
+
+    WHEN 'enum' THEN
+      _expr := format('(%1$s = ANY(%2$L::TEXT[]) AND CASE WHEN %1$s IN (''array'', ''object'') '
+        'THEN EXISTS (SELECT 1 FROM jsonb_array_elements(%3$L::JSONB) AS e WHERE e = %4$s) '
+        'ELSE %5$L::JSONB ? _enum_key(%4$s) END)',
+        _type, _kw.text_operand, _kw.json_operand->'containers', _data, _kw.json_operand->'scalars');
+
+    WHEN 'const' THEN
+      _expr := format('%s = %L::JSONB', _data, _kw.json_operand);
+
+    WHEN 'multipleOf', 'minimum', 'maximum', 'exclusiveMinimum', 'exclusiveMaximum' THEN
+      _guard := 'number';
+      _expr := format('(%s)::NUMERIC %s %s', _data, CASE _kw.keyword
+        WHEN 'multipleOf' THEN '%'
+        WHEN 'minimum' THEN '>='
+        WHEN 'maximum' THEN '<='
+        WHEN 'exclusiveMinimum' THEN '>'
+        ELSE '<'
+      END, _kw.num_operand) || CASE WHEN _kw.keyword = 'multipleOf' THEN ' = 0' ELSE '' END;
+
+    WHEN 'minLength', 'maxLength' THEN
+      _guard := 'string';
+      _expr := format('length(%s #>> ''{}'') %s %s', _data,
+        CASE _kw.keyword WHEN 'minLength' THEN '>=' ELSE '<=' END, _kw.num_operand);
+
+    WHEN 'pattern' THEN
+      _guard := 'string';
+      _expr := _generate_pattern(format('(%s #>> ''{}'')', _data), _kw.text_operand[1]);
+
+    WHEN 'minItems', 'maxItems' THEN
+      _guard := 'array';
+      _expr := format('jsonb_array_length(%s) %s %s', _data,
+        CASE _kw.keyword WHEN 'minItems' THEN '>=' ELSE '<=' END, _kw.num_operand);
+
+    WHEN 'uniqueItems' THEN
+      _guard := 'array';
+      _expr := format('(SELECT count(DISTINCT e) = count(*) FROM jsonb_array_elements(%s) AS e)', _data);
+
+    WHEN 'minProperties', 'maxProperties' THEN
+      _guard := 'object';
+      _expr := format('(SELECT count(*) FROM jsonb_object_keys(%s)) %s %s', _data,
+        CASE _kw.keyword WHEN 'minProperties' THEN '>=' ELSE '<=' END, _kw.num_operand);
+
+    WHEN 'required' THEN
+      _guard := 'object';
+      _expr := format('%s ?& %L::TEXT[]', _data, _kw.text_operand);
+
+    WHEN 'dependentRequired' THEN
+      _guard := 'object';
+      SELECT string_agg(format('(NOT %s ? %L OR %s ?& %L::TEXT[])', _data, d.key, _data,
+        ARRAY(SELECT jsonb_array_elements_text(d.value))), ' AND ')
+      INTO _expr
+      FROM jsonb_each(_kw.json_operand) AS d;
+
+    WHEN 'properties' THEN
+      _guard := 'object';
+      _checks := ARRAY(
+        SELECT format('(NOT %s ? %L OR %s)', _data, p.name,
+          _generate_child(_plan_id, p.child, format('(%s->%L)', _data, p.name), _names, _depth + 1))
+        FROM unnest(_kw.text_operand[:_kw.num_operand], _kw.children[:_kw.num_operand]) WITH ORDINALITY AS p(name, child, i)
+        ORDER BY p.i
+      );
+      -- members matching a pattern, and the others against additional / unevaluated
+      _members := ARRAY(
+        SELECT format('(NOT %s OR %s)', _generate_pattern(_alias || '.key', p.matcher),
+          _generate_child(_plan_id, p.child, _alias || '.value', _names, _depth + 1))
+        FROM unnest(_kw.text_operand[_kw.num_operand + 1:], _kw.children[_kw.num_operand + 1:]) WITH ORDINALITY AS p(matcher, child, i)
+        ORDER BY p.i
+      );
+      IF _kw.json_operand <> '{}' THEN
+        _members := _members || format('(%s.key = ANY(%L::TEXT[])%s OR %s)', _alias,
+          coalesce(_kw.text_operand[:_kw.num_operand], '{}'),
+          (SELECT coalesce(string_agg(' OR ' || _generate_pattern(_alias || '.key', p.matcher), '' ORDER BY p.i), '')
+            FROM unnest(_kw.text_operand[_kw.num_operand + 1:]) WITH ORDINALITY AS p(matcher, i)),
+          _generate_child(_plan_id, coalesce((_kw.json_operand->>'additional')::INT, (_kw.json_operand->>'unevaluated')::INT),
+            _alias || '.value', _names, _depth + 1));
+      END IF;
+      IF cardinality(_members) > 0 THEN
+        _checks := _checks || format('NOT EXISTS (SELECT 1 FROM jsonb_each(%s) AS %s WHERE NOT (%s))',
+          _data, _alias, array_to_string(_members, ' AND '));
+      END IF;
+      _expr := nullif(array_to_string(_checks, ' AND '), '');
+
+    WHEN 'propertyNames' THEN
+      _guard := 'object';
+      _expr := format('NOT EXISTS (SELECT 1 FROM jsonb_object_keys(%s) AS %s(key) WHERE NOT %s)', _data, _alias,
+        _generate_child(_plan_id, _kw.children[1], format('to_jsonb(%s.key)', _alias), _names, _depth + 1));
+
+    WHEN 'dependentSchemas' THEN
+      _guard := 'object';
+      SELECT string_agg(format('(NOT %s ? %L OR %s)', _data, d.key, _generate_child(_plan_id, d.child, _data, _names, _depth)),
+        ' AND ' ORDER BY d.i)
+      INTO _expr
+      FROM unnest(_kw.text_operand, _kw.children) WITH ORDINALITY AS d(key, child, i);
+
+    WHEN 'prefixItems' THEN
+      _guard := 'array';
+      SELECT string_agg(format('CASE WHEN jsonb_array_length(%s) > %s THEN %s ELSE TRUE END', _data, p.i - 1,
+        _generate_child(_plan_id, p.child, format('(%s->%s)', _data, p.i - 1), _names, _depth + 1)), ' AND ' ORDER BY p.i)
+      INTO _expr
+      FROM unnest(_kw.children) WITH ORDINALITY AS p(child, i);
+
+    WHEN 'items', 'unevaluatedItems' THEN
+      IF NOT (_kw.keyword = 'unevaluatedItems' AND (_kw.json_operand->>'items')::BOOLEAN) THEN
+        _guard := 'array';
+        _expr := format('NOT EXISTS (SELECT 1 FROM jsonb_array_elements(%s) WITH ORDINALITY AS %s(value, i) WHERE %s.i > %s AND NOT %s)',
+          _data, _alias, _alias, _kw.num_operand, _generate_child(_plan_id, _kw.children[1], _alias || '.value', _names, _depth + 1));
+      END IF;
+
+    WHEN 'contains' THEN
+      _guard := 'array';
+      _expr := format('(SELECT count(*) >= %s%s FROM jsonb_array_elements(%s) AS %s(value) WHERE %s)',
+        _kw.json_operand->>'min',
+        CASE WHEN _kw.json_operand->'max' <> 'null' THEN format(' AND count(*) <= %s', _kw.json_operand->>'max') ELSE '' END,
+        _data, _alias, _generate_child(_plan_id, _kw.children[1], _alias || '.value', _names, _depth + 1));
+
+    WHEN 'allOf' THEN
+      SELECT string_agg(_generate_child(_plan_id, c, _data, _names, _depth), ' AND ' ORDER BY i) INTO _expr
+      FROM unnest(_kw.children) WITH ORDINALITY AS t(c, i);
+
+    WHEN 'anyOf', 'oneOf' THEN
+      IF _kw.keyword = 'anyOf' THEN
+        SELECT '(' || string_agg(_generate_child(_plan_id, c, _data, _names, _depth), ' OR ' ORDER BY i) || ')' INTO _expr
+        FROM unnest(_kw.children) WITH ORDINALITY AS t(c, i);
+      ELSE
+        SELECT '(' || string_agg(format('(%s)::INT', _generate_child(_plan_id, c, _data, _names, _depth)), ' + ' ORDER BY i) || ') = 1'
+        INTO _expr
+        FROM unnest(_kw.children) WITH ORDINALITY AS t(c, i);
+      END IF;
+      IF _kw.json_operand IS NOT NULL THEN
+        -- tagged union: only the branch selected by the tag value can match
+        -- an object; other instances are checked against every branch
+        SELECT format('CASE WHEN %1$s <> ''object'' THEN %4$s WHEN jsonb_typeof(%2$s->%3$L) = ''string'' THEN CASE %2$s->>%3$L %5$s ELSE FALSE END ELSE FALSE END',
+          _type, _data, _kw.json_operand->>'property', _expr,
+          string_agg(format('WHEN %L THEN %s', b.key, _generate_child(_plan_id, b.value::INT, _data, _names, _depth)), ' ' ORDER BY b.key))
+        INTO _expr
+        FROM jsonb_each_text(_kw.json_operand->'branches') AS b;
+      END IF;
+
+    WHEN 'not' THEN
+      _expr := format('NOT %s', _generate_child(_plan_id, _kw.children[1], _data, _names, _depth));
+
+    WHEN 'if' THEN
+      _expr := format('CASE WHEN %s THEN %s ELSE %s END',
+        _generate_child(_plan_id, _kw.children[1], _data, _names, _depth),
+        coalesce(_generate_child(_plan_id, _kw.children[2], _data, _names, _depth), 'TRUE'),
+        coalesce(_generate_child(_plan_id, _kw.children[3], _data, _names, _depth), 'TRUE'));
+    END CASE;
+
+    IF _expr IS NOT NULL THEN
+      _parts := _parts || CASE
+        WHEN _guard IS NULL THEN _expr
+        ELSE format('CASE WHEN %s = %L THEN %s ELSE TRUE END', _type, _guard, _expr)
+      END;
+    END IF;
+  END LOOP;
+
+  IF cardinality(_parts) = 0 THEN
+    RETURN 'TRUE';
+  END IF;
+  RETURN '(' || array_to_string(_parts, ' AND ') || ')';
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- A call to the node's function, or the node inlined.
+CREATE OR REPLACE FUNCTION _generate_child(_plan_id INT, _node_id INT, _data TEXT, _names TEXT[], _depth INT)
+RETURNS TEXT AS $$
+  SELECT CASE
+    WHEN _node_id IS NULL THEN NULL
+    WHEN _names[_node_id] IS NOT NULL THEN format('%I(%s)', _names[_node_id], _data)
+    ELSE _generate_node(_plan_id, _node_id, _data, _names, _depth)
+  END
+$$ LANGUAGE sql;
+
+
+-- Creates fn_name(data jsonb) RETURNS boolean validating against schema, plus
+-- its helper functions, and returns the DDL that was run.
+CREATE OR REPLACE FUNCTION generate_validator(schema JSONB, fn_name TEXT)
+RETURNS TEXT AS $$
+DECLARE
+  _plan_id INT := compile_schema(schema);
+  _names TEXT[];
+  _node_id INT;
+  _ddl TEXT;
+  _source TEXT[] := '{}';
+BEGIN
+  SELECT array_agg(CASE
+    WHEN n.node_id = 1 THEN fn_name
+    WHEN (SELECT count(*) FROM json_schema_plan_keyword AS k, unnest(k.children) AS c
+      WHERE k.plan_id = _plan_id AND c = n.node_id) > 1 THEN fn_name || '_' || n.node_id
+  END ORDER BY n.node_id)
+  INTO _names
+  FROM json_schema_plan_node AS n
+  WHERE n.plan_id = _plan_id;
+
+  FOR _node_id IN SELECT i FROM generate_subscripts(_names, 1) AS i WHERE _names[i] IS NOT NULL ORDER BY i DESC
+  LOOP
+    _ddl := format('CREATE OR REPLACE FUNCTION %I(data JSONB) RETURNS BOOLEAN AS %L LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE',
+      _names[_node_id], format('BEGIN RETURN %s; END', _generate_node(_plan_id, _node_id, 'data', _names, 1)));
+    EXECUTE _ddl;
+    _source := _source || _ddl;
+  END LOOP;
+
+  RETURN array_to_string(_source, E';\n') || ';';
+END;
+$$ LANGUAGE plpgsql;
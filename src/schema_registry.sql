@@ -0,0 +1,150 @@
+-- Schema registry.
+--
+-- register_schema(schema, uri) stores a schema document under an absolute
+-- URI. Every registration of a changed document adds a version; the latest
+-- one is used for resolution. $refs to a URI that the schema itself doesn't
+-- define are resolved from the registry: _bundle_schema() embeds each
+-- registered document they reach in the root's $defs, with $id set to its
+-- URI, so every engine resolves it like a local resource and no network
+-- I/O happens.
+--
+-- The registry holds source documents, so unlike plans it survives
+-- reloading the scripts.
+
+CREATE TABLE IF NOT EXISTS json_schema_registry (
+  uri TEXT NOT NULL,
+  version INT NOT NULL,
+  fingerprint TEXT NOT NULL,
+  schema JSONB NOT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (uri, version)
+);
+
+
+-- Counts the registrations that added a version, so sessions that cache
+-- programs (_validate_cached()) or resolution indexes
+-- (_schema_index_handle()) only recheck them after it has moved.
+CREATE TABLE IF NOT EXISTS json_schema_registry_generation (
+  id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+  generation BIGINT NOT NULL
+);
+INSERT INTO json_schema_registry_generation (generation) VALUES (0) ON CONFLICT DO NOTHING;
+
+
+-- The registry generation, read at most once per statement: a statement
+-- keeps using what it cached even when another session registers a new
+-- version while it runs.
+DROP FUNCTION IF EXISTS _plan_cache_generation();
+CREATE OR REPLACE FUNCTION _registry_generation()
+RETURNS BIGINT AS $$
+BEGIN
+  IF current_setting('pg_json_schema.registry_checked_at', TRUE) IS DISTINCT FROM statement_timestamp()::TEXT THEN
+    PERFORM set_config('pg_json_schema.registry_generation',
+      coalesce((SELECT g.generation FROM json_schema_registry_generation AS g), 0)::TEXT, FALSE);
+    PERFORM set_config('pg_json_schema.registry_checked_at', statement_timestamp()::TEXT, FALSE);
+  END IF;
+  RETURN current_setting('pg_json_schema.registry_generation')::BIGINT;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Registers a schema under uri (by default its $id) and returns its version.
+-- Registering an unchanged document returns the current version. Plans that
+-- embedded an older version are dropped.
+CREATE OR REPLACE FUNCTION register_schema(schema JSONB, uri TEXT DEFAULT NULL)
+RETURNS INT AS $$
+DECLARE
+  _uri TEXT := _resolve_uri('', coalesce(uri, schema->>'$id'));
+  _fingerprint TEXT := md5(schema::TEXT);
+  _current json_schema_registry%ROWTYPE;
+BEGIN
+  IF _uri IS NULL OR _uri !~ '^[A-Za-z][A-Za-z0-9+.-]*:' OR _uri LIKE '%#%' THEN
+    RAISE EXCEPTION 'Schemas are registered under an absolute URI without a fragment, got %', coalesce(uri, schema->>'$id');
+  END IF;
+
+  -- concurrent registrations of a URI queue here instead of racing for the
+  -- next version; a row lock would take nothing on the first registration
+  PERFORM pg_advisory_xact_lock(hashtext(_uri));
+  SELECT * INTO _current FROM json_schema_registry AS r WHERE r.uri = _uri ORDER BY version DESC LIMIT 1;
+  IF FOUND AND _current.fingerprint = _fingerprint THEN
+    RETURN _current.version;
+  END IF;
+
+  INSERT INTO json_schema_registry (uri, version, fingerprint, schema)
+  VALUES (_uri, coalesce(_current.version, 0) + 1, _fingerprint, schema);
+
+  IF _current.version IS NOT NULL AND to_regclass('json_schema_plan_resource') IS NOT NULL THEN
+    DELETE FROM json_schema_plan
+    WHERE plan_id IN (SELECT r.plan_id FROM json_schema_plan_resource AS r WHERE r.kind = 'resource' AND r.uri = _uri);
+  END IF;
+  -- a first version can resolve $refs that failed before, so it counts too
+  UPDATE json_schema_registry_generation SET generation = generation + 1;
+  -- this session rereads it on its next cached validation
+  PERFORM set_config('pg_json_schema.registry_checked_at', '', FALSE);
+  RETURN coalesce(_current.version, 0) + 1;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- The registered document (latest version by default) as a resource: its
+-- $id is its registry URI.
+CREATE OR REPLACE FUNCTION _registered_resource(_uri TEXT, _version INT DEFAULT NULL)
+RETURNS JSONB AS $$
+  SELECT CASE jsonb_typeof(r.schema)
+    WHEN 'object' THEN jsonb_set(r.schema, '{$id}', to_jsonb(r.uri))
+    ELSE jsonb_build_object('$id', r.uri, 'allOf', jsonb_build_array(r.schema))
+  END
+  FROM json_schema_registry AS r
+  WHERE r.uri = _uri AND (_version IS NULL OR r.version = _version)
+  ORDER BY r.version DESC
+  LIMIT 1
+$$ LANGUAGE sql STABLE;
+
+
+-- Embeds every registered document the schema refers to, directly or
+-- through other registered documents, in its $defs.
+CREATE OR REPLACE FUNCTION _bundle_schema(schema JSONB)
+RETURNS JSONB AS $$
+DECLARE
+  _documents JSONB;
+BEGIN
+  -- a reference that is only a fragment never leaves the document, so only
+  -- schemas with other references are walked
+  IF jsonb_typeof(schema) <> 'object' OR jsonb_typeof(coalesce(schema->'$defs', '{}')) <> 'object'
+    OR NOT schema @? '$.** ? (@."$ref" like_regex "^[^#]" || @."$dynamicRef" like_regex "^[^#]")'
+    OR NOT EXISTS (SELECT FROM json_schema_registry) THEN
+    RETURN schema;
+  END IF;
+
+  LOOP
+    WITH local AS (
+      SELECT s.uri FROM _schema_resources(schema) AS s WHERE s.kind = 'resource'
+    )
+    SELECT jsonb_object_agg(f.uri, _registered_resource(f.uri)) INTO _documents
+    FROM (SELECT DISTINCT split_part(r.uri, '#', 1) AS uri FROM _schema_refs(schema) AS r) AS f
+    WHERE EXISTS (SELECT FROM json_schema_registry AS g WHERE g.uri = f.uri)
+      AND f.uri NOT IN (SELECT uri FROM local)
+      AND NOT coalesce(schema->'$defs', '{}') ? f.uri;
+    EXIT WHEN _documents IS NULL;
+    schema := jsonb_set(schema, '{$defs}', coalesce(schema->'$defs', '{}') || _documents);
+  END LOOP;
+  RETURN schema;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+
+-- The subschema a URI names, fragment included, or NULL.
+CREATE OR REPLACE FUNCTION resolve_uri(uri TEXT, version INT DEFAULT NULL)
+RETURNS JSONB AS $$
+  SELECT _resolve_ref(_schema_index(_bundle_schema(d.schema)), '', uri)
+  FROM (SELECT _registered_resource(split_part(_resolve_uri('', uri), '#', 1), version) AS schema) AS d
+  WHERE d.schema IS NOT NULL
+$$ LANGUAGE sql STABLE;
+
+
+-- Validates data against a registered schema, or a subschema of one when the
+-- URI has a fragment, through validate_schema().
+CREATE OR REPLACE FUNCTION validate_registered(data JSONB, uri TEXT)
+RETURNS BOOLEAN AS $$
+  SELECT validate_schema(data, jsonb_build_object('$ref', uri))
+$$ LANGUAGE sql;
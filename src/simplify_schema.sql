@@ -0,0 +1,279 @@
+-- Schema simplification.
+--
+-- simplify_schema(schema) rewrites a schema into an equivalent one that is
+-- cheaper to compile and run: allOf branches are merged into their parent
+-- where no keyword clashes, trivially true branches are dropped, boolean
+-- subschemas are folded through allOf/anyOf/oneOf/not/if, keywords that
+-- can't apply to the declared type are dropped, and subschemas that no
+-- instance can satisfy become false.
+--
+-- $refs address subschemas by path, so nothing is moved or dropped above a
+-- subschema that a $ref, $id or anchor points at. Rewrites that would lose
+-- annotations are skipped when the schema uses unevaluated* keywords.
+
+-- Keywords that affect validation; anything else is an annotation or unknown.
+CREATE OR REPLACE FUNCTION _validation_keywords()
+RETURNS TEXT[] AS $$
+  SELECT ARRAY[
+    'type', 'enum', 'const', 'multipleOf', 'maximum', 'exclusiveMaximum', 'minimum', 'exclusiveMinimum',
+    'maxLength', 'minLength', 'pattern', 'maxItems', 'minItems', 'uniqueItems', 'maxContains', 'minContains',
+    'maxProperties', 'minProperties', 'required', 'dependentRequired', '$ref', '$dynamicRef',
+    'allOf', 'anyOf', 'oneOf', 'not', 'if', 'then', 'else', 'dependentSchemas', 'prefixItems', 'items',
+    'contains', 'properties', 'patternProperties', 'additionalProperties', 'propertyNames',
+    'unevaluatedItems', 'unevaluatedProperties'
+  ]
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Paths that must keep their place: every resource and anchor, and the
+-- target of every JSON pointer $ref.
+CREATE OR REPLACE FUNCTION _schema_pins(_root JSONB)
+RETURNS TABLE (path TEXT[]) AS $$
+  SELECT path FROM _schema_resources(_root)
+  UNION
+  SELECT r.path || _json_pointer_path(substr(f.uri, length(split_part(f.uri, '#', 1)) + 2))
+  FROM _schema_refs(_root) AS f
+  JOIN _schema_resources(_root) AS r ON r.kind = 'resource' AND r.uri = split_part(f.uri, '#', 1)
+  WHERE substr(f.uri, length(split_part(f.uri, '#', 1)) + 2) LIKE '/%'
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- A schema every instance satisfies.
+CREATE OR REPLACE FUNCTION _trivially_true(schema JSONB)
+RETURNS BOOLEAN AS $$
+  SELECT schema = 'true' OR (jsonb_typeof(schema) = 'object' AND NOT schema ?| _validation_keywords())
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Types as an array, with integer dropped when number is present; NULL if
+-- any of them isn't a type name.
+CREATE OR REPLACE FUNCTION _simplify_types(_types JSONB)
+RETURNS JSONB AS $$
+  SELECT CASE WHEN bool_and(t IN ('null', 'boolean', 'integer', 'number', 'string', 'array', 'object')) IS NOT FALSE THEN
+    coalesce(jsonb_agg(DISTINCT t) FILTER (WHERE t <> 'integer' OR NOT _types ? 'number'), '[]')
+  END
+  FROM jsonb_array_elements(CASE jsonb_typeof(_types) WHEN 'array' THEN _types ELSE jsonb_build_array(_types) END) AS e,
+    LATERAL (SELECT CASE jsonb_typeof(e) WHEN 'string' THEN e #>> '{}' END AS t) AS n
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- number and integer intersect in integer, whichever side each is on.
+CREATE OR REPLACE FUNCTION _simplify_type_intersection(_a JSONB, _b JSONB)
+RETURNS JSONB AS $$
+  SELECT CASE count(*) WHEN 1 THEN to_jsonb(min(t)) ELSE coalesce(jsonb_agg(t), '[]') END
+  FROM (
+    SELECT CASE WHEN t = 'number' AND NOT _simplify_types(_b) ? 'number' THEN 'integer' ELSE t END AS t
+    FROM jsonb_array_elements_text(_simplify_types(_a)) AS t
+    WHERE _simplify_types(_b) ? t OR (t = 'integer' AND _simplify_types(_b) ? 'number')
+      OR (t = 'number' AND _simplify_types(_b) ? 'integer')
+  ) AS i
+$$ LANGUAGE sql IMMUTABLE;
+
+
+CREATE OR REPLACE FUNCTION _simplify_number(_value JSONB)
+RETURNS NUMERIC AS $$
+  SELECT CASE jsonb_typeof(_value) WHEN 'number' THEN _value::TEXT::NUMERIC END
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Whether a value satisfies a type array.
+CREATE OR REPLACE FUNCTION _simplify_has_type(_value JSONB, _types JSONB)
+RETURNS BOOLEAN AS $$
+  SELECT _types ? jsonb_typeof(_value)
+    OR (_types ? 'integer' AND jsonb_typeof(_value) = 'number' AND _value::TEXT::NUMERIC = floor(_value::TEXT::NUMERIC))
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- _frozen holds every pinned path and its ancestors, as to_jsonb(path)::text
+-- keys; _annotations is set when unevaluated* keywords
+-- need every annotation to survive.
+CREATE OR REPLACE FUNCTION _simplify_node(schema JSONB, _path TEXT[], _frozen JSONB, _annotations BOOLEAN)
+RETURNS JSONB AS $$
+DECLARE
+  _sub RECORD;
+  _groups CONSTANT TEXT[] := ARRAY[
+    '{properties,patternProperties,additionalProperties}', '{prefixItems,items}',
+    '{contains,minContains,maxContains}', '{if,then,else}'
+  ];
+  _domains CONSTANT JSONB := '{
+    "number": ["multipleOf", "minimum", "maximum", "exclusiveMinimum", "exclusiveMaximum"],
+    "string": ["minLength", "maxLength", "pattern"],
+    "array": ["prefixItems", "items", "contains", "minContains", "maxContains", "minItems", "maxItems",
+      "uniqueItems", "unevaluatedItems"],
+    "object": ["properties", "patternProperties", "additionalProperties", "propertyNames", "required",
+      "dependentRequired", "dependentSchemas", "minProperties", "maxProperties", "unevaluatedProperties"]
+  }';
+  _keep BOOLEAN := jsonb_typeof(schema) = 'object' AND NOT schema ?| ARRAY['$id', '$anchor', '$dynamicAnchor'];
+  _queue JSONB := '[]';
+  _branches JSONB := '[]';
+  _branch JSONB;
+  _key TEXT;
+  _group TEXT;
+  _types JSONB;
+  _merge BOOLEAN;
+  _i INT := 0;
+BEGIN
+  IF jsonb_typeof(schema) <> 'object' THEN
+    RETURN schema;
+  END IF;
+
+  FOR _sub IN SELECT * FROM _subschemas(schema)
+  LOOP
+    schema := jsonb_set(schema, _sub.path, _simplify_node(_sub.subschema, _path || _sub.path, _frozen, _annotations));
+  END LOOP;
+  -- from here on, _keep means this node may be replaced by false
+  _keep := _keep AND NOT _frozen ? to_jsonb(_path)::TEXT;
+
+  IF schema ? 'not' AND NOT _frozen ? to_jsonb(_path || 'not'::TEXT)::TEXT THEN
+    IF _trivially_true(schema->'not') AND _keep THEN
+      RETURN 'false';
+    ELSIF schema->'not' = 'false' THEN
+      schema := schema - 'not';
+    END IF;
+  END IF;
+
+  IF jsonb_typeof(schema->'oneOf') = 'array' AND NOT _frozen ? to_jsonb(_path || 'oneOf'::TEXT)::TEXT THEN
+    _branches := coalesce((SELECT jsonb_agg(b) FROM jsonb_array_elements(schema->'oneOf') AS b WHERE b <> 'false'), '[]');
+    IF _keep AND (_branches = '[]'
+      OR (SELECT count(*) FROM jsonb_array_elements(_branches) AS b WHERE _trivially_true(b)) > 1) THEN
+      RETURN 'false';
+    ELSIF jsonb_array_length(_branches) = 1 THEN
+      _queue := _queue || _branches;
+      schema := schema - 'oneOf';
+    ELSIF _branches <> '[]' THEN
+      schema := jsonb_set(schema, '{oneOf}', _branches);
+    END IF;
+  END IF;
+
+  IF jsonb_typeof(schema->'anyOf') = 'array' AND NOT _frozen ? to_jsonb(_path || 'anyOf'::TEXT)::TEXT THEN
+    _branches := coalesce((SELECT jsonb_agg(b) FROM jsonb_array_elements(schema->'anyOf') AS b WHERE b <> 'false'), '[]');
+    IF _branches = '[]' AND _keep THEN
+      RETURN 'false';
+    ELSIF jsonb_array_length(_branches) = 1 THEN
+      _queue := _queue || _branches;
+      schema := schema - 'anyOf';
+    ELSIF NOT _annotations AND EXISTS (SELECT FROM jsonb_array_elements(_branches) AS b WHERE _trivially_true(b)) THEN
+      schema := schema - 'anyOf';
+    ELSIF _branches <> '[]' THEN
+      schema := jsonb_set(schema, '{anyOf}', _branches);
+    END IF;
+  END IF;
+
+  IF NOT _frozen ?| ARRAY[to_jsonb(_path || 'if'::TEXT)::TEXT, to_jsonb(_path || 'then'::TEXT)::TEXT, to_jsonb(_path || 'else'::TEXT)::TEXT] THEN
+    IF NOT schema ? 'if' OR (NOT schema ?| ARRAY['then', 'else'] AND NOT _annotations) THEN
+      schema := schema - ARRAY['if', 'then', 'else'];
+    ELSIF _trivially_true(schema->'if') OR schema->'if' = 'false' THEN
+      _queue := _queue || coalesce(schema->CASE WHEN schema->'if' = 'false' THEN 'else' ELSE 'then' END, 'true');
+      schema := schema - ARRAY['if', 'then', 'else'];
+    END IF;
+  END IF;
+
+  -- allOf branches merge into this node when their keywords don't clash
+  -- with its own; nested allOfs are spliced in
+  IF jsonb_typeof(schema->'allOf') = 'array' AND NOT _frozen ? to_jsonb(_path || 'allOf'::TEXT)::TEXT THEN
+    _queue := _queue || (schema->'allOf');
+    schema := schema - 'allOf';
+  ELSIF _queue <> '[]' AND schema ? 'allOf' THEN
+    schema := jsonb_set(schema, '{allOf}', (schema->'allOf') || _queue);
+    _queue := '[]';
+  END IF;
+  _branches := '[]';
+  WHILE _i < jsonb_array_length(_queue)
+  LOOP
+    _branch := _queue->_i;
+    _i := _i + 1;
+    IF _trivially_true(_branch) THEN
+      CONTINUE;
+    ELSIF _branch = 'false' AND _keep THEN
+      RETURN 'false';
+    ELSIF jsonb_typeof(_branch) <> 'object' THEN
+      _branches := _branches || jsonb_build_array(_branch);
+      CONTINUE;
+    END IF;
+    _branch := (SELECT jsonb_object_agg(key, value) FROM jsonb_each(_branch) WHERE key = ANY(_validation_keywords()));
+    IF jsonb_typeof(_branch->'allOf') = 'array' THEN
+      _queue := _queue || (_branch->'allOf');
+      _branch := _branch - 'allOf';
+    END IF;
+    _merge := NOT _branch ?| ARRAY['unevaluatedProperties', 'unevaluatedItems']
+      AND NOT EXISTS (SELECT FROM jsonb_object_keys(_branch) AS k WHERE k <> 'type' AND schema ? k);
+    FOREACH _group IN ARRAY _groups
+    LOOP
+      _merge := _merge AND NOT (_branch ?| _group::TEXT[] AND schema ?| _group::TEXT[]);
+    END LOOP;
+    IF _merge THEN
+      IF schema ? 'type' AND _branch ? 'type' THEN
+        _branch := jsonb_set(_branch, '{type}', _simplify_type_intersection(schema->'type', _branch->'type'));
+      END IF;
+      schema := schema || _branch;
+    ELSIF _branch <> '{}' THEN
+      _branches := _branches || jsonb_build_array(_branch);
+    END IF;
+  END LOOP;
+  IF _branches <> '[]' THEN
+    schema := jsonb_set(schema, '{allOf}', _branches);
+  END IF;
+
+  -- keywords for types the instance can't have, and bounds no value of the
+  -- declared types can meet
+  _types := _simplify_types(schema->'type');
+  IF schema ? 'type' AND _types IS NOT NULL THEN
+    IF _types = '[]' AND _keep THEN
+      RETURN 'false';
+    END IF;
+    FOR _key IN
+      SELECT k FROM jsonb_each(_domains) AS d, jsonb_array_elements_text(d.value) AS k
+      WHERE NOT (_types ? d.key OR (d.key = 'number' AND _types ? 'integer'))
+        AND NOT _frozen ? to_jsonb(_path || k)::TEXT
+    LOOP
+      schema := schema - _key;
+    END LOOP;
+    IF jsonb_typeof(schema->'enum') = 'array' THEN
+      schema := jsonb_set(schema, '{enum}', coalesce(
+        (SELECT jsonb_agg(e) FROM jsonb_array_elements(schema->'enum') AS e WHERE _simplify_has_type(e, _types)), '[]'));
+    END IF;
+    IF schema ? 'const' AND NOT _simplify_has_type(schema->'const', _types) AND _keep THEN
+      RETURN 'false';
+    END IF;
+    IF _keep AND NOT _types ?| ARRAY['null', 'boolean', 'string', 'array', 'object'] AND (
+      _simplify_number(schema->'minimum') > _simplify_number(schema->'maximum')
+      OR _simplify_number(schema->'minimum') >= _simplify_number(schema->'exclusiveMaximum')
+      OR _simplify_number(schema->'exclusiveMinimum') >= _simplify_number(schema->'maximum')
+      OR _simplify_number(schema->'exclusiveMinimum') >= _simplify_number(schema->'exclusiveMaximum')
+    ) THEN
+      RETURN 'false';
+    END IF;
+    IF _keep AND _types = '["string"]' AND _simplify_number(schema->'minLength') > _simplify_number(schema->'maxLength') THEN
+      RETURN 'false';
+    END IF;
+    IF _keep AND _types = '["array"]' AND _simplify_number(schema->'minItems') > _simplify_number(schema->'maxItems') THEN
+      RETURN 'false';
+    END IF;
+    IF _keep AND _types = '["object"]' AND (
+      _simplify_number(schema->'minProperties') > _simplify_number(schema->'maxProperties')
+      OR (SELECT count(DISTINCT r) FROM jsonb_array_elements(CASE jsonb_typeof(schema->'required') WHEN 'array' THEN schema->'required' ELSE '[]' END) AS r)
+        > _simplify_number(schema->'maxProperties')
+    ) THEN
+      RETURN 'false';
+    END IF;
+  END IF;
+  IF schema->'enum' = '[]' AND _keep THEN
+    RETURN 'false';
+  END IF;
+
+  RETURN schema;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+CREATE OR REPLACE FUNCTION simplify_schema(schema JSONB)
+RETURNS JSONB AS $$
+  SELECT _simplify_node(
+    schema,
+    '{}',
+    (SELECT coalesce(jsonb_object_agg(to_jsonb(p.path[:n])::TEXT, TRUE), '{}')
+      FROM _schema_pins(schema) AS p, generate_series(0, cardinality(p.path)) AS n
+      WHERE cardinality(p.path) > 0),
+    schema::TEXT ~ '"unevaluated(Properties|Items)"'
+  )
+$$ LANGUAGE sql IMMUTABLE;
@@ -0,0 +1,569 @@
+-- Interpreter for the programs assembled by compile_schema().
+--
+-- Validation runs in a single function invocation with an explicit stack of
+-- frames (one per subschema being evaluated against an instance node), so
+-- nesting depth is bounded by memory rather than max_stack_depth.
+--
+-- An applicator instruction evaluates a list of tasks. For applicators that
+-- stay on the same instance (allOf, not, if, ...) a task is an index into the
+-- instruction's children; otherwise the instruction builds _f_tasks, a jsonb
+-- array of [node] or [node, instance, location segment]. Children push a
+-- frame each and hand their verdict back through _result. A frame starts at
+-- the code its node has for the type of its instance, which is looked up once
+-- when the frame is pushed; when that code is empty no frame is pushed.
+--
+-- Verdicts of shared nodes entered in place ($ref, allOf, anyOf, oneOf, if,
+-- ...) are memoized per call, keyed by node id and the JSON pointer of the
+-- instance, in a table of pg_json_schema.memo_size slots where a key
+-- overwrites the one that hashes to the same slot.
+--
+-- The frames double as the dynamic scope: $dynamicRef looks its anchor up in
+-- the anchor maps of the resources of the frames, outermost first.
+
+DROP FUNCTION IF EXISTS _validate_compiled_node(jsonb, int, int);
+
+-- Evaluates a matcher built by _compile_pattern().
+CREATE OR REPLACE FUNCTION _pattern_matches(_value TEXT, _matcher TEXT)
+RETURNS BOOLEAN AS $$
+  SELECT CASE left(_matcher, 1)
+    WHEN 'L' THEN _value LIKE substr(_matcher, 2)
+    WHEN 'C' THEN translate(_value, substr(_matcher, 3), '') = '' AND (substr(_matcher, 2, 1) = '*' OR _value <> '')
+    ELSE _value ~ substr(_matcher, 2)
+  END
+$$ LANGUAGE sql IMMUTABLE;
+
+DROP FUNCTION IF EXISTS _run_program(jsonb, int[], json_schema_operand[], int[]);
+DROP FUNCTION IF EXISTS _run_program(jsonb, int[], json_schema_operand[], int[], boolean[]);
+
+CREATE OR REPLACE FUNCTION _run_program(data JSONB, _opcodes INT[], _operands json_schema_operand[], _node_start INT[],
+  _node_shared BOOLEAN[], _node_resource INT[], _resource_anchors JSONB[])
+RETURNS BOOLEAN AS $$
+DECLARE
+  _types CONSTANT TEXT[] := _plan_types();
+  _type_count CONSTANT INT := cardinality(_types);
+  -- frames
+  _sp INT := 1;
+  _f_node INT[] := ARRAY[1];
+  _f_loc TEXT[] := ARRAY[''];
+  _f_data JSONB[] := ARRAY[data];
+  _f_type TEXT[] := ARRAY[jsonb_typeof(data)];
+  _f_pc INT[] := ARRAY[_node_start[array_position(_types, jsonb_typeof(data))]];
+  _f_tasks JSONB[] := ARRAY[NULL::JSONB];
+  _f_i INT[] := ARRAY[0];
+  _f_n INT[] := ARRAY[0];
+  _f_count INT[] := ARRAY[0];
+  _f_slot INT[] := ARRAY[0];
+  -- current instruction
+  _pc INT;
+  _op INT;
+  _opnd json_schema_operand;
+  _data JSONB;
+  _type TEXT;
+  _num NUMERIC;
+  _str TEXT;
+  _task JSONB;
+  _node INT;
+  _result BOOLEAN;
+  _verdict BOOLEAN;
+  -- memo of shared nodes, slot -> '<node>:<instance pointer>' and its verdict
+  _memo_keys TEXT[] := '{}';
+  _memo_verdicts BOOLEAN[] := '{}';
+  _memo_key TEXT;
+  _memo_limit CONSTANT INT := coalesce(nullif(current_setting('pg_json_schema.memo_size', TRUE), '')::INT, 4096);
+  _slot INT;
+  _max_depth CONSTANT INT := _max_evaluation_depth();
+  _loc TEXT;
+  _start INT;
+  _i INT;
+  OP_END CONSTANT INT := 0;
+  OP_FALSE CONSTANT INT := 1;
+  OP_REF CONSTANT INT := 2;
+  OP_DYNAMIC_REF CONSTANT INT := 3;
+  OP_ENUM CONSTANT INT := 5;
+  OP_CONST CONSTANT INT := 6;
+  OP_MIN_ITEMS CONSTANT INT := 15;
+  OP_MAX_ITEMS CONSTANT INT := 16;
+  OP_UNIQUE_ITEMS CONSTANT INT := 17;
+  OP_MIN_PROPERTIES CONSTANT INT := 18;
+  OP_MAX_PROPERTIES CONSTANT INT := 19;
+  OP_REQUIRED CONSTANT INT := 20;
+  OP_DEPENDENT_REQUIRED CONSTANT INT := 21;
+  OP_PROPERTIES CONSTANT INT := 22;
+  OP_PROPERTY_NAMES CONSTANT INT := 23;
+  OP_DEPENDENT_SCHEMAS CONSTANT INT := 24;
+  OP_PREFIX_ITEMS CONSTANT INT := 25;
+  OP_ITEMS CONSTANT INT := 26;
+  OP_UNEVALUATED_ITEMS CONSTANT INT := 27;
+  OP_CONTAINS CONSTANT INT := 28;
+  OP_ALL_OF CONSTANT INT := 29;
+  OP_ANY_OF CONSTANT INT := 30;
+  OP_ONE_OF CONSTANT INT := 31;
+  OP_NOT CONSTANT INT := 32;
+  OP_IF CONSTANT INT := 33;
+  OP_NUMBER CONSTANT INT := 34;
+  OP_STRING CONSTANT INT := 35;
+BEGIN
+  LOOP
+    _pc := _f_pc[_sp];
+    _op := _opcodes[_pc];
+    _opnd := _operands[_pc];
+    _data := _f_data[_sp];
+    _type := _f_type[_sp];
+    _verdict := NULL;
+
+    IF _result IS NOT NULL THEN
+      -- a child of the current instruction has finished
+      _f_i[_sp] := _f_i[_sp] + 1;
+      CASE _op
+      WHEN OP_ANY_OF THEN
+        IF _result THEN
+          _verdict := TRUE;
+        END IF;
+      WHEN OP_ONE_OF THEN
+        IF _result THEN
+          _f_count[_sp] := _f_count[_sp] + 1;
+          IF _f_count[_sp] > 1 THEN
+            _verdict := FALSE;
+          END IF;
+        END IF;
+      WHEN OP_NOT THEN
+        _verdict := NOT _result;
+      WHEN OP_CONTAINS THEN
+        IF _result THEN
+          _f_count[_sp] := _f_count[_sp] + 1;
+          IF _f_count[_sp] > (_opnd.val->>'max')::NUMERIC THEN
+            _verdict := FALSE;
+          ELSIF _opnd.val->'max' = 'null' AND _f_count[_sp] >= (_opnd.val->>'min')::NUMERIC THEN
+            _verdict := TRUE;
+          END IF;
+        END IF;
+      WHEN OP_IF THEN
+        IF _f_count[_sp] = 0 THEN
+          -- the condition has been evaluated, continue with then or else
+          _f_count[_sp] := 1;
+          _f_i[_sp] := CASE WHEN _result THEN 1 ELSE 2 END;
+          IF _opnd.children[_f_i[_sp] + 1] IS NULL THEN
+            _verdict := TRUE;
+          ELSE
+            _f_n[_sp] := _f_i[_sp] + 1;
+          END IF;
+        ELSE
+          _verdict := _result;
+        END IF;
+      ELSE
+        IF NOT _result THEN
+          _verdict := FALSE;
+        END IF;
+      END CASE;
+      _result := NULL;
+
+    ELSE
+      _task := NULL;
+      _f_tasks[_sp] := NULL;
+      _f_i[_sp] := 0;
+      _f_n[_sp] := 0;
+      _f_count[_sp] := 0;
+
+      CASE _op
+      WHEN OP_END THEN
+        _verdict := TRUE;
+
+      WHEN OP_FALSE THEN
+        _verdict := FALSE;
+
+      -- the code of a node only holds the keywords that apply to the type of
+      -- the instance; enum / const only where the instance type occurs in
+      -- their values
+      WHEN OP_ENUM THEN
+        _verdict := CASE
+          WHEN _type IN ('array', 'object') THEN _opnd.val->'containers' @> jsonb_build_array(_data)
+            AND EXISTS (SELECT 1 FROM jsonb_array_elements(_opnd.val->'containers') AS e WHERE e = _data)
+          ELSE _opnd.val->'scalars' ? _enum_key(_data)
+        END;
+
+      WHEN OP_CONST THEN
+        _verdict := _data = _opnd.val;
+
+      -- all number and all string keywords of a node are one instruction, so
+      -- the instance is cast once; NULL bounds are absent keywords
+      WHEN OP_NUMBER THEN
+        _num := _data::NUMERIC;
+        _verdict := (_num % _opnd.nums[1] <> 0 OR _num < _opnd.nums[2] OR _num > _opnd.nums[3]
+          OR _num <= _opnd.nums[4] OR _num >= _opnd.nums[5]
+          OR (_opnd.keys IS NOT NULL AND _num <> trunc(_num))) IS NOT TRUE;
+
+      WHEN OP_STRING THEN
+        _str := _data #>> '{}';
+        _verdict := (length(_str) < _opnd.nums[1] OR length(_str) > _opnd.nums[2]) IS NOT TRUE
+          AND (_opnd.keys[1] IS NULL OR _pattern_matches(_str, _opnd.keys[1]));
+
+      WHEN OP_MIN_ITEMS THEN
+        _verdict := jsonb_array_length(_data) >= _opnd.num;
+
+      WHEN OP_MAX_ITEMS THEN
+        _verdict := jsonb_array_length(_data) <= _opnd.num;
+
+      WHEN OP_UNIQUE_ITEMS THEN
+        _verdict := (SELECT count(DISTINCT e) = count(*) FROM jsonb_array_elements(_data) AS e);
+
+      WHEN OP_MIN_PROPERTIES THEN
+        _verdict := (SELECT count(*) FROM jsonb_object_keys(_data)) >= _opnd.num;
+
+      WHEN OP_MAX_PROPERTIES THEN
+        _verdict := (SELECT count(*) FROM jsonb_object_keys(_data)) <= _opnd.num;
+
+      WHEN OP_REQUIRED THEN
+        _verdict := _data ?& _opnd.keys;
+
+      WHEN OP_DEPENDENT_REQUIRED THEN
+        _verdict := NOT _data ?| _opnd.keys OR NOT EXISTS (
+          SELECT 1 FROM jsonb_each(_opnd.val) AS d
+          WHERE _data ? d.key AND NOT _data ?& ARRAY(SELECT jsonb_array_elements_text(d.value))
+        );
+
+      -- applicators on the same instance
+      WHEN OP_REF, OP_ALL_OF THEN
+        _f_n[_sp] := coalesce(array_length(_opnd.children, 1), 0);
+
+      WHEN OP_DYNAMIC_REF THEN
+        IF _opnd.keys[2] IS NULL THEN
+          _f_n[_sp] := 1;
+        ELSE
+          -- the outermost resource in the dynamic scope that declares the anchor
+          _node := NULL;
+          FOR _i IN 1 .. _sp LOOP
+            _node := (_resource_anchors[_node_resource[_f_node[_i]]]->>_opnd.keys[2])::INT;
+            EXIT WHEN _node IS NOT NULL;
+          END LOOP;
+          _task := jsonb_build_array(jsonb_build_array(coalesce(_node, _opnd.children[1])));
+        END IF;
+
+      WHEN OP_ANY_OF, OP_ONE_OF THEN
+        IF _opnd.val IS NULL OR _type <> 'object' THEN
+          _f_n[_sp] := coalesce(array_length(_opnd.children, 1), 0);
+        ELSE
+          -- tagged union: only the branch selected by the tag value can match
+          -- an object; other instances are checked against every branch
+          _node := (_opnd.val->'branches'->>(
+            CASE WHEN jsonb_typeof(_data->(_opnd.val->>'property')) = 'string' THEN _data->>(_opnd.val->>'property') END
+          ))::INT;
+          IF _node IS NULL THEN
+            _verdict := FALSE;
+          ELSE
+            _task := jsonb_build_array(jsonb_build_array(_node));
+          END IF;
+        END IF;
+
+      WHEN OP_NOT, OP_IF THEN
+        _f_n[_sp] := 1;
+
+      WHEN OP_DEPENDENT_SCHEMAS THEN
+        SELECT coalesce(jsonb_agg(jsonb_build_array(c)), '[]') INTO _task
+        FROM unnest(_opnd.keys, _opnd.children) AS t(k, c)
+        WHERE _data ? k;
+
+      -- applicators on object members
+      WHEN OP_PROPERTIES THEN
+        -- one pass over the members: a member is checked against its declared
+        -- property and every matching pattern, or else against
+        -- additionalProperties / unevaluatedProperties
+        SELECT coalesce(jsonb_agg(jsonb_build_array(t.child, m.value, replace(replace(m.key, '~', '~0'), '/', '~1'))), '[]') INTO _task
+        FROM jsonb_each(_data) AS m
+        CROSS JOIN LATERAL (
+          SELECT _opnd.children[array_position(_opnd.keys[:_opnd.num], m.key)] AS declared,
+            ARRAY(
+              SELECT p.child FROM unnest(_opnd.keys[_opnd.num + 1:], _opnd.children[_opnd.num + 1:]) AS p(pattern, child)
+              WHERE _pattern_matches(m.key, p.pattern)
+            ) AS matched
+        ) AS c
+        CROSS JOIN LATERAL unnest(CASE
+          WHEN c.declared IS NOT NULL OR cardinality(c.matched) > 0 THEN array_remove(ARRAY[c.declared], NULL) || c.matched
+          ELSE array_remove(ARRAY[coalesce((_opnd.val->>'additional')::INT, (_opnd.val->>'unevaluated')::INT)], NULL)
+        END) AS t(child);
+
+      WHEN OP_PROPERTY_NAMES THEN
+        -- a property name is not a location in the document: '~2' never occurs in a pointer
+        SELECT coalesce(jsonb_agg(jsonb_build_array(_opnd.children[1], to_jsonb(k), '~2' || replace(replace(k, '~', '~0'), '/', '~1'))), '[]') INTO _task
+        FROM jsonb_object_keys(_data) AS k;
+
+      -- applicators on array items; with a jsonpath operand, all items are
+      -- checked by one predicate over the array
+      WHEN OP_PREFIX_ITEMS THEN
+        IF _opnd.path IS NOT NULL THEN
+          _verdict := (_data @@ _opnd.path) IS TRUE;
+        ELSE
+          SELECT coalesce(jsonb_agg(jsonb_build_array(_opnd.children[i], e, i - 1) ORDER BY i), '[]') INTO _task
+          FROM jsonb_array_elements(_data) WITH ORDINALITY AS t(e, i)
+          WHERE i <= array_length(_opnd.children, 1);
+        END IF;
+
+      WHEN OP_ITEMS, OP_UNEVALUATED_ITEMS THEN
+        IF _opnd.path IS NOT NULL THEN
+          _verdict := (_data @@ _opnd.path) IS TRUE;
+        ELSIF NOT (_op = OP_UNEVALUATED_ITEMS AND (_opnd.val->>'items')::BOOLEAN) THEN
+          SELECT coalesce(jsonb_agg(jsonb_build_array(_opnd.children[1], e, i - 1) ORDER BY i), '[]') INTO _task
+          FROM jsonb_array_elements(_data) WITH ORDINALITY AS t(e, i)
+          WHERE i > _opnd.num;
+        END IF;
+
+      WHEN OP_CONTAINS THEN
+        SELECT coalesce(jsonb_agg(jsonb_build_array(_opnd.children[1], e, i - 1) ORDER BY i), '[]') INTO _task
+        FROM jsonb_array_elements(_data) WITH ORDINALITY AS t(e, i);
+
+      END CASE;
+
+      IF _task IS NOT NULL THEN
+        _f_tasks[_sp] := _task;
+        _f_n[_sp] := jsonb_array_length(_task);
+      ELSIF _verdict IS NULL AND _f_n[_sp] = 0 AND _op NOT IN (OP_ANY_OF, OP_ONE_OF) THEN
+        -- applicator that does not apply to this instance
+        _verdict := TRUE;
+      END IF;
+    END IF;
+
+    IF _verdict IS NULL THEN
+      IF _f_i[_sp] < _f_n[_sp] THEN
+        -- evaluate the next child in a new frame
+        _loc := _f_loc[_sp];
+        IF _f_tasks[_sp] IS NULL THEN
+          _node := _opnd.children[_f_i[_sp] + 1];
+          _slot := 1;
+        ELSE
+          _task := _f_tasks[_sp]->_f_i[_sp];
+          _node := (_task->>0)::INT;
+          _slot := CASE WHEN jsonb_array_length(_task) = 1 THEN 1 ELSE 0 END;
+          _data := coalesce(_task->1, _data);
+          IF jsonb_array_length(_task) > 2 THEN
+            _loc := _loc || '/' || (_task->>2);
+          END IF;
+        END IF;
+        _type := jsonb_typeof(_data);
+        _start := _node_start[(_node - 1) * _type_count + array_position(_types, _type)];
+        IF _opcodes[_start] = OP_END THEN
+          -- no keyword of the node applies to this instance type
+          _result := TRUE;
+          CONTINUE;
+        END IF;
+        -- only a shared node entered in place is looked up and memoized
+        IF _slot = 1 AND _node_shared[_node] AND _memo_limit > 0 THEN
+          _memo_key := _node || ':' || _loc;
+          _slot := (hashtext(_memo_key) & 2147483647) % _memo_limit + 1;
+          IF _memo_keys[_slot] = _memo_key THEN
+            _result := _memo_verdicts[_slot];
+            CONTINUE;
+          END IF;
+        ELSE
+          _slot := 0;
+        END IF;
+        IF _sp >= _max_depth THEN
+          RAISE EXCEPTION 'Evaluation depth exceeds pg_json_schema.max_depth (%)', _max_depth
+            USING ERRCODE = 'program_limit_exceeded';
+        END IF;
+        _sp := _sp + 1;
+        _f_node[_sp] := _node;
+        _f_loc[_sp] := _loc;
+        _f_data[_sp] := _data;
+        _f_type[_sp] := _type;
+        _f_pc[_sp] := _start;
+        _f_slot[_sp] := _slot;
+        CONTINUE;
+      END IF;
+
+      -- all children have been evaluated
+      _verdict := CASE _op
+        WHEN OP_ANY_OF THEN FALSE
+        WHEN OP_ONE_OF THEN _f_count[_sp] = 1
+        WHEN OP_CONTAINS THEN _f_count[_sp] >= (_opnd.val->>'min')::NUMERIC
+        ELSE TRUE
+      END;
+    END IF;
+
+    IF _verdict AND _op <> OP_END THEN
+      _f_pc[_sp] := _pc + 1;
+    ELSE
+      -- the frame is done: hand the verdict to the parent
+      IF _f_slot[_sp] > 0 THEN
+        _memo_keys[_f_slot[_sp]] := _f_node[_sp] || ':' || _f_loc[_sp];
+        _memo_verdicts[_f_slot[_sp]] := _verdict;
+      END IF;
+      _sp := _sp - 1;
+      IF _sp = 0 THEN
+        RETURN _verdict;
+      END IF;
+      _result := _verdict;
+    END IF;
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION validate_compiled(data JSONB, plan_id INT)
+RETURNS BOOLEAN AS $$
+DECLARE
+  _plan json_schema_plan;
+BEGIN
+  SELECT * INTO _plan FROM json_schema_plan AS p WHERE p.plan_id = validate_compiled.plan_id;
+  IF NOT FOUND THEN
+    RAISE EXCEPTION 'Unknown plan %', plan_id;
+  END IF;
+  RETURN _run_program(data, _plan.opcodes, _plan.operands, _plan.node_start,
+    _plan.node_shared, _plan.node_resource, _plan.resource_anchors);
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- Session plan cache.
+--
+-- Programs of recently used schemas are copied into a temporary table keyed
+-- by jsonb_hash_extended() of the schema and checked against the schema
+-- itself, so repeated validations skip compile_schema() and its md5, and
+-- don't read the shared plan table. The cache holds up to
+-- pg_json_schema.cache_size entries (default 256, 0 disables it) and
+-- pg_json_schema.cache_bytes bytes of program (default 32MB), evicting the
+-- least recently used. Calls with the same schema as the previous one skip
+-- the recency update. Every entry records the registry generation it was
+-- checked at; an entry is only checked against json_schema_plan again once
+-- the generation has moved, and the generation is read once per statement.
+-- plan_cache_stats() reports the hit, miss and eviction counters of the
+-- session.
+
+CREATE OR REPLACE FUNCTION _plan_cache_setting(_name TEXT, _default BIGINT)
+RETURNS BIGINT AS $$
+  SELECT coalesce(nullif(current_setting('pg_json_schema.' || _name, TRUE), '')::BIGINT, _default)
+$$ LANGUAGE sql STABLE;
+
+
+CREATE OR REPLACE FUNCTION _plan_cache_count(_counter TEXT, _n BIGINT DEFAULT 1)
+RETURNS VOID AS $$
+  SELECT set_config('pg_json_schema.cache_' || _counter, (_plan_cache_setting('cache_' || _counter, 0) + _n)::TEXT, FALSE)
+$$ LANGUAGE sql;
+
+
+-- Validates data against a schema through the session cache, with the
+-- schema's jsonpath translation when _jsonpath is set and there is one.
+CREATE OR REPLACE FUNCTION _validate_cached(data JSONB, schema JSONB, _jsonpath BOOLEAN DEFAULT FALSE)
+RETURNS BOOLEAN AS $$
+DECLARE
+  _size CONSTANT BIGINT := _plan_cache_setting('cache_size', 256);
+  _key BIGINT;
+  _generation BIGINT;
+  _entry RECORD;
+  _hit BOOLEAN;
+  _plan_id INT;
+  _path JSONPATH;
+  _evicted BIGINT;
+BEGIN
+  IF _size <= 0 THEN
+    _plan_id := compile_schema(schema);
+    IF _jsonpath THEN
+      _path := _plan_jsonpath(_plan_id);
+      IF _path IS NOT NULL THEN
+        RETURN (data @@ _path) IS TRUE;
+      END IF;
+    END IF;
+    RETURN validate_compiled(data, _plan_id);
+  END IF;
+
+  IF to_regclass('pg_temp.json_schema_plan_cache') IS NULL THEN
+    CREATE TEMPORARY TABLE json_schema_plan_cache (
+      key BIGINT PRIMARY KEY,
+      schema JSONB NOT NULL,
+      plan_id INT NOT NULL,
+      fingerprint TEXT NOT NULL,
+      generation BIGINT NOT NULL,
+      jsonpath JSONPATH,
+      jsonpath_translated BOOLEAN NOT NULL,
+      opcodes INT[],
+      operands json_schema_operand[],
+      node_start INT[],
+      node_shared BOOLEAN[],
+      node_resource INT[],
+      resource_anchors JSONB[],
+      bytes BIGINT NOT NULL,
+      last_used TIMESTAMPTZ NOT NULL
+    );
+  END IF;
+
+  _key := jsonb_hash_extended(schema, 0);
+  SELECT * INTO _entry FROM pg_temp.json_schema_plan_cache AS c WHERE c.key = _key AND c.schema = _validate_cached.schema;
+  _hit := FOUND;
+  _generation := _registry_generation();
+  -- plans are dropped when a registered schema they embed changes
+  IF _hit AND _entry.generation <> _generation THEN
+    IF EXISTS (
+      SELECT FROM json_schema_plan AS p WHERE p.plan_id = _entry.plan_id AND p.fingerprint = _entry.fingerprint
+    ) THEN
+      UPDATE pg_temp.json_schema_plan_cache AS c SET generation = _generation WHERE c.key = _key;
+    ELSE
+      DELETE FROM pg_temp.json_schema_plan_cache AS c WHERE c.key = _key;
+      PERFORM _plan_cache_count('evictions');
+      _hit := FALSE;
+    END IF;
+  END IF;
+
+  IF _hit THEN
+    PERFORM _plan_cache_count('hits');
+    IF current_setting('pg_json_schema.cache_last', TRUE) IS DISTINCT FROM _key::TEXT THEN
+      UPDATE pg_temp.json_schema_plan_cache AS c SET last_used = clock_timestamp() WHERE c.key = _key;
+      PERFORM set_config('pg_json_schema.cache_last', _key::TEXT, FALSE);
+    END IF;
+  ELSE
+    PERFORM _plan_cache_count('misses');
+    _plan_id := compile_schema(schema);
+    -- a different schema with the same hash gives up its slot
+    DELETE FROM pg_temp.json_schema_plan_cache AS c WHERE c.key = _key;
+    INSERT INTO pg_temp.json_schema_plan_cache
+    SELECT _key, _validate_cached.schema, p.plan_id, p.fingerprint, _generation, p.jsonpath, p.jsonpath_translated, p.opcodes, p.operands, p.node_start,
+      p.node_shared, p.node_resource, p.resource_anchors,
+      pg_column_size(_validate_cached.schema) + pg_column_size(p.opcodes) + pg_column_size(p.operands) + pg_column_size(p.node_start)
+        + pg_column_size(p.node_shared) + coalesce(pg_column_size(p.node_resource), 0)
+        + coalesce(pg_column_size(p.resource_anchors), 0) + coalesce(pg_column_size(p.jsonpath), 0),
+      clock_timestamp()
+    FROM json_schema_plan AS p
+    WHERE p.plan_id = _plan_id
+    RETURNING * INTO _entry;
+    PERFORM set_config('pg_json_schema.cache_last', _key::TEXT, FALSE);
+
+    WITH ranked AS (
+      SELECT c.key, row_number() OVER w AS n, sum(c.bytes) OVER w AS total
+      FROM pg_temp.json_schema_plan_cache AS c
+      WINDOW w AS (ORDER BY c.last_used DESC)
+    )
+    DELETE FROM pg_temp.json_schema_plan_cache AS c
+    USING ranked AS r
+    WHERE c.key = r.key AND r.n > 1
+      AND (r.n > _size OR r.total > _plan_cache_setting('cache_bytes', 33554432));
+    GET DIAGNOSTICS _evicted = ROW_COUNT;
+    IF _evicted > 0 THEN
+      PERFORM _plan_cache_count('evictions', _evicted);
+    END IF;
+  END IF;
+
+  IF _jsonpath AND NOT _entry.jsonpath_translated THEN
+    _entry.jsonpath := _plan_jsonpath(_entry.plan_id);
+    UPDATE pg_temp.json_schema_plan_cache AS c
+    SET jsonpath = _entry.jsonpath, jsonpath_translated = TRUE, bytes = c.bytes + coalesce(pg_column_size(_entry.jsonpath), 0)
+    WHERE c.key = _key;
+  END IF;
+  IF _jsonpath AND _entry.jsonpath IS NOT NULL THEN
+    RETURN (data @@ _entry.jsonpath) IS TRUE;
+  END IF;
+  RETURN _run_program(data, _entry.opcodes, _entry.operands, _entry.node_start,
+    _entry.node_shared, _entry.node_resource, _entry.resource_anchors);
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION plan_cache_stats()
+RETURNS TABLE (entries BIGINT, bytes BIGINT, hits BIGINT, misses BIGINT, evictions BIGINT) AS $$
+DECLARE
+  _entries BIGINT := 0;
+  _bytes BIGINT := 0;
+BEGIN
+  IF to_regclass('pg_temp.json_schema_plan_cache') IS NOT NULL THEN
+    SELECT count(*), coalesce(sum(c.bytes), 0) INTO _entries, _bytes FROM pg_temp.json_schema_plan_cache AS c;
+  END IF;
+  RETURN QUERY SELECT _entries, _bytes, _plan_cache_setting('cache_hits', 0), _plan_cache_setting('cache_misses', 0),
+    _plan_cache_setting('cache_evictions', 0);
+END;
+$$ LANGUAGE plpgsql;
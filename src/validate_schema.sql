@@ -1,4 +1,311 @@
-CREATE OR REPLACE FUNCTION validate_schema(data jsonb, schema jsonb, _full_schema jsonb default NULL)
+-- Bitmask of the keywords present in a schema object, so evaluators test a bit
+-- instead of probing the schema for every keyword they know about.
+CREATE OR REPLACE FUNCTION _schema_keyword_mask(schema jsonb)
+RETURNS BIGINT AS $$
+  SELECT coalesce(bit_or(1::BIGINT << (array_position(ARRAY[
+    '$ref', '$dynamicRef', 'enum', 'type', 'const',
+    'multipleOf', 'minimum', 'maximum', 'exclusiveMinimum', 'exclusiveMaximum',
+    'minLength', 'maxLength', 'pattern',
+    'minProperties', 'maxProperties', 'required', 'dependentRequired', 'dependentSchemas',
+    'properties', 'patternProperties', 'additionalProperties', 'unevaluatedProperties', 'propertyNames',
+    'items', 'prefixItems', 'unevaluatedItems', 'contains', 'minContains', 'maxContains',
+    'minItems', 'maxItems', 'uniqueItems',
+    'allOf', 'anyOf', 'oneOf', 'not', 'if', 'then', 'else'
+  ], key) - 1)), 0)
+  FROM jsonb_object_keys(CASE WHEN jsonb_typeof(schema) = 'object' THEN schema ELSE '{}' END) AS key
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Schema locations that hold subschemas, relative to their parent schema.
+CREATE OR REPLACE FUNCTION _subschemas(schema jsonb)
+RETURNS TABLE (path TEXT[], subschema JSONB) AS $$
+  SELECT ARRAY[k.key, s.key], s.value
+  FROM jsonb_each(CASE WHEN jsonb_typeof(schema) = 'object' THEN schema ELSE '{}' END) AS k,
+    jsonb_each(CASE WHEN k.key IN ('$defs', 'definitions', 'properties', 'patternProperties', 'dependentSchemas')
+      AND jsonb_typeof(k.value) = 'object' THEN k.value ELSE '{}' END) AS s
+  UNION ALL
+  SELECT ARRAY[k.key], k.value
+  FROM jsonb_each(CASE WHEN jsonb_typeof(schema) = 'object' THEN schema ELSE '{}' END) AS k
+  WHERE k.key IN ('items', 'additionalProperties', 'unevaluatedProperties', 'unevaluatedItems', 'contains',
+    'propertyNames', 'not', 'if', 'then', 'else')
+  UNION ALL
+  SELECT ARRAY[k.key, (e.n - 1)::TEXT], e.value
+  FROM jsonb_each(CASE WHEN jsonb_typeof(schema) = 'object' THEN schema ELSE '{}' END) AS k,
+    jsonb_array_elements(CASE WHEN k.key IN ('prefixItems', 'allOf', 'anyOf', 'oneOf')
+      AND jsonb_typeof(k.value) = 'array' THEN k.value ELSE '[]' END) WITH ORDINALITY AS e(value, n)
+$$ LANGUAGE sql IMMUTABLE;
+
+
+
+-- The in-place applicators, which apply subschemas to the instance itself.
+-- The items and members they evaluate aren't collected, so every engine
+-- refuses an unevaluatedItems or unevaluatedProperties that can fail next to
+-- one of them rather than check it against the wrong items or members.
+CREATE OR REPLACE FUNCTION _in_place_applicators()
+RETURNS TEXT[] AS $$
+  SELECT ARRAY['$ref', '$dynamicRef', 'allOf', 'anyOf', 'oneOf', 'if', 'dependentSchemas']
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Whether the unevaluatedItems / unevaluatedProperties _keyword of schema can
+-- be checked without the annotations of in-place applicators.
+CREATE OR REPLACE FUNCTION _unevaluated_supported(schema jsonb, _keyword TEXT)
+RETURNS BOOLEAN AS $$
+  SELECT schema->_keyword IN ('true', '{}') OR NOT schema ?| _in_place_applicators()
+$$ LANGUAGE sql IMMUTABLE;
+
+
+CREATE OR REPLACE FUNCTION _check_unevaluated(schema jsonb, _keyword TEXT)
+RETURNS VOID AS $$
+BEGIN
+  IF NOT _unevaluated_supported(schema, _keyword) THEN
+    RAISE EXCEPTION '% next to in-place applicators is not supported', _keyword
+      USING ERRCODE = 'feature_not_supported';
+  END IF;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION _uri_decode(_value TEXT)
+RETURNS TEXT AS $$
+  SELECT coalesce(convert_from(string_agg(
+    CASE WHEN m[1] IS NOT NULL THEN decode(substr(m[1], 2), 'hex') ELSE convert_to(m[2], 'UTF8') END,
+    ''::BYTEA ORDER BY n), 'UTF8'), '')
+  FROM regexp_matches(_value, '(%[0-9A-Fa-f]{2})|([^%]+|%)', 'g') WITH ORDINALITY AS t(m, n)
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- '#/a~1b/0' -> '{a/b,0}'
+CREATE OR REPLACE FUNCTION _json_pointer_path(_pointer TEXT)
+RETURNS TEXT[] AS $$
+  SELECT coalesce(array_agg(replace(replace(
+    CASE WHEN strpos(segment, '%') > 0 THEN _uri_decode(segment) ELSE segment END, '~1', '/'), '~0', '~') ORDER BY n), '{}')
+  FROM unnest(string_to_array(regexp_replace(_pointer, '^#?/?', ''), '/')) WITH ORDINALITY AS t(segment, n)
+  WHERE _pointer !~ '^#?$'
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Resolves a URI reference against a base URI (RFC 3986 section 5.2). An
+-- empty fragment is dropped, so 'a.json#' and 'a.json' name the same resource.
+CREATE OR REPLACE FUNCTION _resolve_uri(_base TEXT, _ref TEXT)
+RETURNS TEXT AS $$
+DECLARE
+  _uri TEXT;
+  _fragment TEXT := '';
+  _next TEXT;
+BEGIN
+  -- a fragment-only reference stays in the base resource
+  IF left(_ref, 1) = '#' AND strpos(_base, '/.') = 0 THEN
+    RETURN split_part(_base, '#', 1) || CASE WHEN _ref = '#' THEN '' ELSE _ref END;
+  END IF;
+
+  _base := split_part(_base, '#', 1);
+  IF strpos(_ref, '#') > 0 THEN
+    _fragment := substr(_ref, strpos(_ref, '#'));
+    _ref := left(_ref, strpos(_ref, '#') - 1);
+  END IF;
+
+  IF _ref = '' THEN
+    _uri := _base;
+  ELSIF _ref ~ '^[A-Za-z][A-Za-z0-9+.-]*:' OR _base = '' THEN
+    _uri := _ref;
+  ELSIF left(_ref, 2) = '//' THEN
+    _uri := substring(_base FROM '^[A-Za-z][A-Za-z0-9+.-]*:') || _ref;
+  ELSIF left(_ref, 1) = '/' THEN
+    _uri := coalesce(substring(_base FROM '^[A-Za-z][A-Za-z0-9+.-]*://[^/?]*'), '') || _ref;
+  ELSE
+    _uri := regexp_replace(_base, '[^/]*$', '') || _ref;
+  END IF;
+
+  _uri := regexp_replace(_uri, '/\.(?=/|\?|$)', '', 'g');
+  LOOP
+    _next := regexp_replace(_uri, '/(?!\.\.(?:/|\?|$))[^/?]+/\.\.(?=/|\?|$)', '');
+    EXIT WHEN _next = _uri;
+    _uri := _next;
+  END LOOP;
+
+  RETURN _uri || CASE WHEN _fragment = '#' THEN '' ELSE _fragment END;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+-- Every schema resource ($id, and the root) and every $anchor / $dynamicAnchor
+-- of a schema document, as absolute URIs with the path of the subschema they
+-- name and the base URI in effect there. kind is 'resource', '$anchor' or
+-- '$dynamicAnchor'. Found in one walk over the document.
+DROP FUNCTION IF EXISTS _schema_resources(jsonb);
+CREATE OR REPLACE FUNCTION _schema_resources(_root jsonb)
+RETURNS TABLE (uri TEXT, path TEXT[], base TEXT, kind TEXT) AS $$
+  WITH RECURSIVE walk(path, schema, base) AS (
+    SELECT '{}'::TEXT[], _root,
+      CASE WHEN jsonb_typeof(_root->'$id') = 'string' THEN _resolve_uri('', _root->>'$id') ELSE '' END
+    UNION ALL
+    SELECT w.path || s.path, s.subschema,
+      CASE WHEN jsonb_typeof(s.subschema->'$id') = 'string' THEN _resolve_uri(w.base, s.subschema->>'$id') ELSE w.base END
+    FROM walk AS w, _subschemas(w.schema) AS s
+  )
+  SELECT base, path, base, 'resource'
+  FROM walk
+  WHERE path = '{}' OR jsonb_typeof(schema->'$id') = 'string'
+  UNION ALL
+  SELECT base || '#' || (schema->>a.keyword), path, base, a.keyword
+  FROM walk, unnest(ARRAY['$anchor', '$dynamicAnchor']) AS a(keyword)
+  WHERE jsonb_typeof(schema->a.keyword) = 'string'
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Every $ref and $dynamicRef in a schema, resolved to an absolute URI.
+CREATE OR REPLACE FUNCTION _schema_refs(_root jsonb)
+RETURNS TABLE (path TEXT[], keyword TEXT, uri TEXT) AS $$
+  WITH RECURSIVE walk(path, schema, base) AS (
+    SELECT '{}'::TEXT[], _root,
+      CASE WHEN jsonb_typeof(_root->'$id') = 'string' THEN _resolve_uri('', _root->>'$id') ELSE '' END
+    UNION ALL
+    SELECT w.path || s.path, s.subschema,
+      CASE WHEN jsonb_typeof(s.subschema->'$id') = 'string' THEN _resolve_uri(w.base, s.subschema->>'$id') ELSE w.base END
+    FROM walk AS w, _subschemas(w.schema) AS s
+  )
+  SELECT w.path, k.keyword, _resolve_uri(w.base, w.schema->>k.keyword)
+  FROM walk AS w, unnest(ARRAY['$ref', '$dynamicRef']) AS k(keyword)
+  WHERE jsonb_typeof(w.schema->k.keyword) = 'string'
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Resolution index for the recursive evaluator: absolute URI -> subschema.
+-- A subschema that declares $id gets it rewritten to its absolute form, so
+-- entering it through a $ref sets the same base URI as reaching it in place.
+-- Every JSON pointer a $ref or $dynamicRef of the schema names (usually a
+-- $defs entry) is indexed too, so following it is one key lookup. A schema
+-- without $id or anchors is one resource, and its resources aren't walked.
+CREATE OR REPLACE FUNCTION _schema_index(_root jsonb)
+RETURNS JSONB AS $$
+  SELECT i.index || coalesce((
+    SELECT jsonb_object_agg(r.uri, t.subschema)
+    FROM _schema_refs(_root) AS r, _index_lookup(i.index, r.uri) AS t(subschema)
+    WHERE strpos(r.uri, '#/') > 0 AND t.subschema IS NOT NULL
+  ), '{}')
+  FROM (
+    SELECT CASE
+      WHEN NOT _root @? '$.** ? (exists(@."$id") || exists(@."$anchor") || exists(@."$dynamicAnchor"))' THEN
+        jsonb_build_object('', _root)
+      ELSE (
+        SELECT coalesce(jsonb_object_agg(r.uri, CASE
+          WHEN jsonb_typeof(_root #> r.path -> '$id') = 'string' THEN jsonb_set(_root #> r.path, '{$id}', to_jsonb(r.base))
+          ELSE _root #> r.path
+        END), '{}')
+        FROM _schema_resources(_root) AS r
+      )
+    END AS index
+  ) AS i
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Looks up an absolute URI in a resolution index: a URI that isn't a key
+-- and has a JSON pointer fragment is looked up in its resource.
+CREATE OR REPLACE FUNCTION _index_lookup(_index jsonb, _uri TEXT)
+RETURNS JSONB AS $$
+  SELECT coalesce(_index->_uri, CASE
+    WHEN left(fragment, 1) = '/' THEN _index #> (split_part(_uri, '#', 1) || _json_pointer_path(fragment))
+  END)
+  FROM (SELECT substr(_uri, length(split_part(_uri, '#', 1)) + 2) AS fragment) AS r
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Session cache of resolution indexes, so validating many documents against
+-- one schema bundles and walks it once. json_schema_index_cache has a row
+-- per schema, keyed by jsonb_hash_extended() of the schema and checked
+-- against the schema itself; json_schema_index_entry has a row per URI of
+-- its index. The key is the handle the recursive evaluator passes around and
+-- looks URIs up with, instead of the index itself. An entry is rebuilt once
+-- the registry generation has moved. Up to pg_json_schema.cache_size schemas
+-- (default 256) are kept, least recently used first out; the schema of the
+-- running call always stays.
+CREATE OR REPLACE FUNCTION _schema_index_handle(schema jsonb)
+RETURNS BIGINT AS $$
+DECLARE
+  _size CONSTANT BIGINT := coalesce(nullif(current_setting('pg_json_schema.cache_size', TRUE), '')::BIGINT, 256);
+  _key BIGINT;
+  _generation BIGINT;
+BEGIN
+  IF to_regclass('pg_temp.json_schema_index_cache') IS NULL THEN
+    CREATE TEMPORARY TABLE json_schema_index_cache (
+      key BIGINT PRIMARY KEY,
+      schema JSONB NOT NULL,
+      generation BIGINT NOT NULL,
+      last_used TIMESTAMPTZ NOT NULL
+    );
+    CREATE TEMPORARY TABLE json_schema_index_entry (
+      key BIGINT NOT NULL REFERENCES json_schema_index_cache ON DELETE CASCADE,
+      uri TEXT NOT NULL,
+      subschema JSONB NOT NULL,
+      PRIMARY KEY (key, uri)
+    );
+  END IF;
+
+  _key := jsonb_hash_extended(schema, 0);
+  _generation := _registry_generation();
+  UPDATE pg_temp.json_schema_index_cache AS c SET last_used = clock_timestamp()
+  WHERE c.key = _key AND c.schema = _schema_index_handle.schema AND c.generation = _generation;
+  IF FOUND THEN
+    RETURN _key;
+  END IF;
+
+  -- a stale entry, or a different schema with the same hash, gives up its slot
+  DELETE FROM pg_temp.json_schema_index_cache AS c WHERE c.key = _key;
+  INSERT INTO pg_temp.json_schema_index_cache VALUES (_key, schema, _generation, clock_timestamp());
+  INSERT INTO pg_temp.json_schema_index_entry
+  SELECT _key, e.key, e.value FROM jsonb_each(_schema_index(_bundle_schema(schema))) AS e;
+  DELETE FROM pg_temp.json_schema_index_cache AS c
+  WHERE c.key IN (
+    SELECT o.key FROM pg_temp.json_schema_index_cache AS o ORDER BY o.last_used DESC OFFSET greatest(_size, 1)
+  );
+  RETURN _key;
+END;
+$$ LANGUAGE plpgsql;
+
+
+-- _index_lookup() through a handle from _schema_index_handle().
+CREATE OR REPLACE FUNCTION _handle_lookup(_handle BIGINT, _uri TEXT)
+RETURNS JSONB AS $$
+DECLARE
+  _resource CONSTANT TEXT := split_part(_uri, '#', 1);
+  _fragment CONSTANT TEXT := substr(_uri, length(_resource) + 2);
+  _subschema JSONB;
+BEGIN
+  SELECT e.subschema INTO _subschema FROM pg_temp.json_schema_index_entry AS e WHERE e.key = _handle AND e.uri = _uri;
+  IF _subschema IS NULL AND left(_fragment, 1) = '/' THEN
+    SELECT e.subschema #> _json_pointer_path(_fragment) INTO _subschema
+    FROM pg_temp.json_schema_index_entry AS e WHERE e.key = _handle AND e.uri = _resource;
+  END IF;
+  RETURN _subschema;
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+
+-- Looks up a $ref, relative to _base, in a resolution index.
+CREATE OR REPLACE FUNCTION _resolve_ref(_index jsonb, _base TEXT, _ref TEXT)
+RETURNS JSONB AS $$
+  SELECT _index_lookup(_index, _resolve_uri(_base, _ref))
+$$ LANGUAGE sql IMMUTABLE;
+
+
+-- Evaluation depth budget: the number of subschemas that may be nested in
+-- one evaluation before validation fails.
+CREATE OR REPLACE FUNCTION _max_evaluation_depth()
+RETURNS INT AS $$
+  SELECT coalesce(nullif(current_setting('pg_json_schema.max_depth', TRUE), '')::INT, 10000)
+$$ LANGUAGE sql STABLE;
+
+
+-- The recursive evaluator has no EXCEPTION block, so it doesn't open a
+-- subtransaction per call. Every cast that depends on the instance is guarded
+-- by a type check; errors can only come from an invalid schema and are caught
+-- once by validate_schema(). $ref is looked up, relative to the base URI
+-- _base, in the index of the root schema that _handle names; _handle is NULL
+-- when the schema has no $ref or $dynamicRef. _scope is the dynamic scope, the base
+-- URIs of the resources entered so far, outermost first, where $dynamicRef
+-- looks for its $dynamicAnchor. _budget is the evaluation depth still
+-- available.
+CREATE OR REPLACE FUNCTION _validate_schema(data jsonb, schema jsonb, _handle BIGINT, _base TEXT, _scope TEXT[], _budget INT)
 RETURNS BOOLEAN AS $$
 DECLARE
   path TEXT[] DEFAULT '{}';
@@ -7,56 +314,159 @@ DECLARE
   _key2 TEXT;
   _value2 JSONB;
   _jsonb_value JSONB;
-  _required TEXT[];
-  _required_item TEXT;
   _boolean_value BOOLEAN;
   _number_value NUMERIC;
-  _path TEXT[];
+  _mask BIGINT;
+  _type TEXT;
+  -- bit positions of _schema_keyword_mask()
+  K_REF CONSTANT BIGINT := 1;
+  K_DYNAMIC_REF CONSTANT BIGINT := 2;
+  K_ENUM CONSTANT BIGINT := 4;
+  K_TYPE CONSTANT BIGINT := 8;
+  K_CONST CONSTANT BIGINT := 16;
+  K_MULTIPLE_OF CONSTANT BIGINT := 32;
+  K_MINIMUM CONSTANT BIGINT := 64;
+  K_MAXIMUM CONSTANT BIGINT := 128;
+  K_EXCLUSIVE_MINIMUM CONSTANT BIGINT := 256;
+  K_EXCLUSIVE_MAXIMUM CONSTANT BIGINT := 512;
+  K_MIN_LENGTH CONSTANT BIGINT := 1024;
+  K_MAX_LENGTH CONSTANT BIGINT := 2048;
+  K_PATTERN CONSTANT BIGINT := 4096;
+  K_MIN_PROPERTIES CONSTANT BIGINT := 8192;
+  K_MAX_PROPERTIES CONSTANT BIGINT := 16384;
+  K_REQUIRED CONSTANT BIGINT := 32768;
+  K_DEPENDENT_REQUIRED CONSTANT BIGINT := 65536;
+  K_PROPERTIES CONSTANT BIGINT := 262144;
+  K_PATTERN_PROPERTIES CONSTANT BIGINT := 524288;
+  K_ADDITIONAL_PROPERTIES CONSTANT BIGINT := 1048576;
+  K_UNEVALUATED_PROPERTIES CONSTANT BIGINT := 2097152;
+  K_ITEMS CONSTANT BIGINT := 8388608;
+  K_PREFIX_ITEMS CONSTANT BIGINT := 16777216;
+  K_UNEVALUATED_ITEMS CONSTANT BIGINT := 33554432;
+  K_CONTAINS CONSTANT BIGINT := 67108864;
+  K_MIN_ITEMS CONSTANT BIGINT := 536870912;
+  K_MAX_ITEMS CONSTANT BIGINT := 1073741824;
+  K_ALL_OF CONSTANT BIGINT := 4294967296;
+  K_ANY_OF CONSTANT BIGINT := 8589934592;
+  K_ONE_OF CONSTANT BIGINT := 17179869184;
+  K_NOT CONSTANT BIGINT := 34359738368;
 BEGIN
 
-  IF _full_schema IS NULL THEN
-    _full_schema := schema;
+  IF jsonb_typeof(schema) = 'boolean' THEN
+    RETURN schema;
+  END IF;
+
+  IF _budget <= 0 THEN
+    RAISE EXCEPTION 'Evaluation depth exceeds pg_json_schema.max_depth (%)', _max_evaluation_depth()
+      USING ERRCODE = 'program_limit_exceeded';
   END IF;
 
-  IF schema->>'$ref' IS NOT NULL THEN
-    SELECT string_to_array(regexp_replace(schema->>'$ref', '^#/', ''), '/') INTO _path;
-    IF NOT validate_schema(data #> _path, schema, _full_schema) THEN
+  _mask := _schema_keyword_mask(schema);
+  IF _mask = 0 THEN
+    RETURN TRUE;
+  END IF;
+  IF _mask & K_TYPE <> 0 THEN
+    _type := schema->>'type';
+  END IF;
+
+  IF jsonb_typeof(schema->'$id') = 'string' THEN
+    _base := _resolve_uri(_base, schema->>'$id');
+    _scope := _scope || _base;
+  END IF;
+
+  IF _mask & K_REF <> 0 THEN
+    -- the target URI is resolved once, for the lookup and the new base
+    _value := _resolve_uri(_base, schema->>'$ref');
+    _jsonb_value := _handle_lookup(_handle, _value);
+    IF _jsonb_value IS NULL THEN
+      RAISE EXCEPTION 'Unresolvable $ref %', schema->>'$ref';
+    END IF;
+    IF NOT _validate_schema(data, _jsonb_value, _handle, split_part(_value, '#', 1), _scope, _budget - 1) THEN
       RETURN FALSE;
     END IF;
   END IF;
 
-  IF schema->>'enum' IS NOT NULL THEN
-    _boolean_value := FALSE;
-    FOR _jsonb_value IN
-      SELECT jsonb_array_elements(schema->'enum')
-    LOOP
-      IF data = _jsonb_value THEN
-        _boolean_value := TRUE;
-      END IF;
-    END LOOP;
+  IF _mask & K_DYNAMIC_REF <> 0 THEN
+    _value := _resolve_uri(_base, schema->>'$dynamicRef');
+    _jsonb_value := _handle_lookup(_handle, _value);
+    IF _jsonb_value IS NULL THEN
+      RAISE EXCEPTION 'Unresolvable $dynamicRef %', schema->>'$dynamicRef';
+    END IF;
+    -- an anchor whose target is a $dynamicAnchor of that name resolves to the
+    -- outermost resource in the dynamic scope that has one too; anything else
+    -- behaves like $ref
+    _key := substr(_value, length(split_part(_value, '#', 1)) + 2);
+    IF _jsonb_value->>'$dynamicAnchor' = _key THEN
+      FOREACH _key2 IN ARRAY _scope
+      LOOP
+        _value2 := _handle_lookup(_handle, _key2 || '#' || _key);
+        IF _value2->>'$dynamicAnchor' = _key THEN
+          _jsonb_value := _value2;
+          _value := _key2;
+          EXIT;
+        END IF;
+      END LOOP;
+    END IF;
+    IF NOT _validate_schema(data, _jsonb_value, _handle, split_part(_value, '#', 1), _scope, _budget - 1) THEN
+      RETURN FALSE;
+    END IF;
+  END IF;
+
+  IF _mask & K_ENUM <> 0 THEN
+    -- containment of a one-element array only matches scalars by equality
+    IF jsonb_typeof(data) IN ('array', 'object') THEN
+      _boolean_value := EXISTS (SELECT 1 FROM jsonb_array_elements(schema->'enum') AS e WHERE e = data);
+    ELSE
+      _boolean_value := schema->'enum' @> jsonb_build_array(data);
+    END IF;
     IF NOT _boolean_value THEN
       RETURN FALSE;
     END IF;
   END IF;
 
-  IF schema->>'type' = 'array' THEN
+  IF _type = 'array' THEN
     IF NOT jsonb_typeof(data) = 'array' THEN
       RETURN FALSE;
     END IF;
-    IF schema ? 'items' THEN
-      IF NOT validate_schema(data, schema->'items', _full_schema) THEN
+  END IF;
+
+  -- prefixItems applies to the items at its positions, items and, without
+  -- items, unevaluatedItems to every item after them; an item contains
+  -- matches is evaluated too
+  IF _mask & (K_PREFIX_ITEMS | K_ITEMS | K_UNEVALUATED_ITEMS) <> 0 AND jsonb_typeof(data) = 'array' THEN
+    IF _mask & K_ITEMS = 0 AND _mask & K_UNEVALUATED_ITEMS <> 0 THEN
+      PERFORM _check_unevaluated(schema, 'unevaluatedItems');
+    END IF;
+    _number_value := coalesce(jsonb_array_length(CASE WHEN jsonb_typeof(schema->'prefixItems') = 'array' THEN schema->'prefixItems' END), 0);
+    FOR _jsonb_value, _value2 IN
+      SELECT e, CASE WHEN n <= _number_value THEN schema->'prefixItems'->(n::INT - 1) ELSE coalesce(schema->'items', schema->'unevaluatedItems') END
+      FROM jsonb_array_elements(data) WITH ORDINALITY AS t(e, n)
+    LOOP
+      IF _value2 IS NOT NULL AND NOT _validate_schema(_jsonb_value, _value2, _handle, _base, _scope, _budget - 1)
+        AND NOT (_mask & (K_ITEMS | K_CONTAINS) = K_CONTAINS AND _value2 = schema->'unevaluatedItems'
+          AND _validate_schema(_jsonb_value, schema->'contains', _handle, _base, _scope, _budget - 1)) THEN
         RETURN FALSE;
       END IF;
+    END LOOP;
+  END IF;
+
+  IF _mask & (K_MIN_ITEMS | K_MAX_ITEMS) <> 0 AND jsonb_typeof(data) = 'array' THEN
+    IF jsonb_array_length(data) < (schema->>'minItems')::NUMERIC
+      OR jsonb_array_length(data) > (schema->>'maxItems')::NUMERIC THEN
+      RETURN FALSE;
     END IF;
   END IF;
 
-  IF schema->>'oneOf' IS NOT NULL THEN
+  IF _mask & K_ONE_OF <> 0 THEN
     _number_value := 0;
     FOR _jsonb_value IN
       SELECT jsonb_array_elements(schema->'oneOf')
     LOOP
-      IF validate_schema(data, _jsonb_value, _full_schema) THEN
+      IF _validate_schema(data, _jsonb_value, _handle, _base, _scope, _budget - 1) THEN
         _number_value := _number_value + 1;
+        IF _number_value > 1 THEN
+          RETURN FALSE;
+        END IF;
       END IF;
     END LOOP;
     IF NOT _number_value = 1 THEN
@@ -64,23 +474,24 @@ BEGIN
     END IF;
   END IF;
 
-  IF schema->>'allOf' IS NOT NULL THEN
+  IF _mask & K_ALL_OF <> 0 THEN
     FOR _jsonb_value IN
       SELECT jsonb_array_elements(schema->'allOf')
     LOOP
-      IF NOT validate_schema(data, _jsonb_value, _full_schema) THEN
+      IF NOT _validate_schema(data, _jsonb_value, _handle, _base, _scope, _budget - 1) THEN
         RETURN FALSE;
       END IF;
     END LOOP;
   END IF;
 
-  IF schema->>'anyOf' IS NOT NULL THEN
+  IF _mask & K_ANY_OF <> 0 THEN
     _boolean_value := FALSE;
     FOR _jsonb_value IN
       SELECT jsonb_array_elements(schema->'anyOf')
     LOOP
-      IF validate_schema(data, _jsonb_value, _full_schema) THEN
+      IF _validate_schema(data, _jsonb_value, _handle, _base, _scope, _budget - 1) THEN
         _boolean_value := TRUE;
+        EXIT;
       END IF;
     END LOOP;
     IF _boolean_value = FALSE THEN
@@ -88,209 +499,212 @@ BEGIN
     END IF;
   END IF;
 
-  IF schema ? 'const' THEN
+  IF _mask & K_CONST <> 0 THEN
     IF NOT schema->'const' = data THEN
       RETURN FALSE;
     END IF;
   END IF;
 
-  IF jsonb_typeof(schema) = 'boolean' THEN
-    RETURN schema;
-  END IF;
 
-  IF schema->>'maxProperties' IS NOT NULL AND jsonb_typeof(data) = 'object' THEN
-    IF (SELECT array_length(array_agg(key), 1) FROM jsonb_object_keys(data::JSONB) as key) > (schema->>'maxProperties')::NUMERIC THEN
+  IF _type = 'object' THEN
+    IF NOT jsonb_typeof(data) = 'object' THEN
       RETURN FALSE;
     END IF;
   END IF;
 
-  IF schema->>'type' = 'object' THEN
-    IF NOT jsonb_typeof(data) = 'object' THEN
+  -- required, dependentRequired and the property counts each take a single
+  -- native jsonb operator or count rather than a loop
+  IF _mask & (K_REQUIRED | K_DEPENDENT_REQUIRED | K_MIN_PROPERTIES | K_MAX_PROPERTIES) <> 0
+    AND jsonb_typeof(data) = 'object' THEN
+    IF _mask & K_REQUIRED <> 0
+      AND NOT data ?& ARRAY(SELECT jsonb_array_elements_text(schema->'required')) THEN
       RETURN FALSE;
     END IF;
-  END IF;
-
-  SELECT array_agg(value) INTO _required
-  FROM jsonb_array_elements_text((SELECT schema->'required')) AS value;
 
-  FOR _key, _value IN
-    SELECT * FROM jsonb_each_text(schema->'properties')
-  LOOP
-    IF NOT _key = ANY(_required) AND NOT data ? _key THEN
-      CONTINUE;
-    END IF;
-    IF NOT validate_schema(data->_key, schema->'properties'->_key, _full_schema) THEN
+    IF _mask & K_DEPENDENT_REQUIRED <> 0 AND EXISTS (
+      SELECT 1 FROM jsonb_each(schema->'dependentRequired') AS d
+      WHERE data ? d.key AND NOT data ?& ARRAY(SELECT jsonb_array_elements_text(d.value))
+    ) THEN
       RETURN FALSE;
     END IF;
-  END LOOP;
-  IF array_length(_required, 1) > 0 AND jsonb_typeof(data) = 'object' THEN
-    FOREACH _required_item IN ARRAY _required
-    LOOP
-      IF NOT data ? _required_item THEN
+
+    IF _mask & (K_MIN_PROPERTIES | K_MAX_PROPERTIES) <> 0 THEN
+      SELECT count(*) INTO _number_value FROM jsonb_object_keys(data);
+      IF _number_value < (schema->>'minProperties')::NUMERIC
+        OR _number_value > (schema->>'maxProperties')::NUMERIC THEN
         RETURN FALSE;
       END IF;
-    END LOOP;
+    END IF;
   END IF;
 
-  IF jsonb_typeof(data) = 'object' THEN
-    FOR _key, _value IN
-      SELECT * FROM jsonb_each_text(schema->'patternProperties')
+  -- properties, patternProperties, additionalProperties and unevaluatedProperties
+  -- in one pass over the members, matching every pattern once per member
+  IF _mask & (K_PROPERTIES | K_PATTERN_PROPERTIES | K_ADDITIONAL_PROPERTIES | K_UNEVALUATED_PROPERTIES) <> 0
+    AND jsonb_typeof(data) = 'object' THEN
+    IF _mask & K_ADDITIONAL_PROPERTIES = 0 AND _mask & K_UNEVALUATED_PROPERTIES <> 0 THEN
+      PERFORM _check_unevaluated(schema, 'unevaluatedProperties');
+    END IF;
+    FOR _key, _jsonb_value IN SELECT * FROM jsonb_each(data)
     LOOP
-      FOR _key2, _value2 IN
-        SELECT * FROM jsonb_each(data)
-      LOOP
-        IF _key2 ~ _key THEN
-          IF NOT validate_schema(data->_key2, schema->'patternProperties'->_key, _full_schema) THEN
+      _boolean_value := FALSE;
+
+      IF _mask & K_PROPERTIES <> 0 THEN
+        -- #> copies only the member's subschema, not all of properties
+        _value2 := schema #> ARRAY['properties', _key];
+        IF _value2 IS NOT NULL THEN
+          _boolean_value := TRUE;
+          IF NOT _validate_schema(_jsonb_value, _value2, _handle, _base, _scope, _budget - 1) THEN
             RETURN FALSE;
           END IF;
         END IF;
-      END LOOP;
-    END LOOP;
+      END IF;
 
-    _jsonb_value := schema->'additionalProperties';
-    IF _jsonb_value IS NOT NULL THEN
-      <<outer>>
-      FOR _key, _value IN SELECT * FROM jsonb_each_text(data)
-      LOOP
-        IF schema->'properties' ? _key THEN
-          CONTINUE outer;
-        END IF;
-        <<inner>>
+      IF _mask & K_PATTERN_PROPERTIES <> 0 THEN
         FOR _key2, _value2 IN
           SELECT * FROM jsonb_each(schema->'patternProperties')
         LOOP
           IF _key ~ _key2 THEN
-            CONTINUE outer;
+            _boolean_value := TRUE;
+            IF NOT _validate_schema(_jsonb_value, _value2, _handle, _base, _scope, _budget - 1) THEN
+              RETURN FALSE;
+            END IF;
           END IF;
-        END LOOP inner;
-        IF jsonb_typeof(_jsonb_value) = 'boolean' AND NOT _jsonb_value::BOOLEAN THEN
-          RETURN FALSE;
-        END IF;
-        IF NOT validate_schema(data->_key, _jsonb_value, _full_schema) THEN
-          RETURN FALSE;
-        END IF;
-      END LOOP outer;
-    END IF;
+        END LOOP;
+      END IF;
 
-    _jsonb_value := schema->'unevaluatedProperties';
-    IF _jsonb_value IS NOT NULL THEN
-      <<outer>>
-      FOR _key, _value IN SELECT * FROM jsonb_each_text(data)
-      LOOP
-        IF schema->'properties' ? _key THEN
-          CONTINUE outer;
-        END IF;
-        <<inner>>
-        FOR _key2, _value2 IN
-          SELECT * FROM jsonb_each(schema->'patternProperties')
-        LOOP
-          IF _key ~ _key2 THEN
-            CONTINUE outer;
+      -- additionalProperties evaluates every member it sees, so
+      -- unevaluatedProperties only applies without it
+      IF NOT _boolean_value THEN
+        IF _mask & K_ADDITIONAL_PROPERTIES <> 0 THEN
+          IF NOT _validate_schema(_jsonb_value, schema->'additionalProperties', _handle, _base, _scope, _budget - 1) THEN
+            RETURN FALSE;
           END IF;
-        END LOOP inner;
-        IF jsonb_typeof(_jsonb_value) = 'boolean' AND NOT _jsonb_value::BOOLEAN THEN
+        ELSIF _mask & K_UNEVALUATED_PROPERTIES <> 0
+          AND NOT _validate_schema(_jsonb_value, schema->'unevaluatedProperties', _handle, _base, _scope, _budget - 1) THEN
           RETURN FALSE;
         END IF;
-        IF NOT validate_schema(data->_key, _jsonb_value, _full_schema) THEN
-          RETURN FALSE;
-        END IF;
-      END LOOP outer;
-    END IF;
-
+      END IF;
+    END LOOP;
   END IF;
 
   -- null validation
-  IF schema->>'type' = 'null' THEN
+  IF _type = 'null' THEN
     IF NOT jsonb_typeof(data) = 'null' THEN
       RETURN FALSE;
     END IF;
   END IF;
 
   -- boolean validation
-  IF schema->>'type' = 'boolean' THEN
+  IF _type = 'boolean' THEN
     IF NOT jsonb_typeof(data) = 'boolean' THEN
       RETURN FALSE;
     END IF;
   END IF;
 
   -- string validation
-  IF schema->>'type' = 'string' THEN
+  IF _type = 'string' THEN
     IF NOT jsonb_typeof(data) = 'string' THEN
       RETURN FALSE;
     END IF;
   END IF;
 
-  IF schema->>'maxLength' IS NOT NULL AND jsonb_typeof(data) = 'string' THEN
-    IF length((array_to_json(array[data]))->>0) > (schema->>'maxLength')::NUMERIC THEN
+  IF _mask & K_MAX_LENGTH <> 0 AND jsonb_typeof(data) = 'string' THEN
+    IF length(data #>> '{}') > (schema->>'maxLength')::NUMERIC THEN
       RETURN FALSE;
     END IF;
   END IF;
 
-  IF schema->>'minLength' IS NOT NULL AND jsonb_typeof(data) = 'string' THEN
-    IF length((array_to_json(array[data]))->>0) < (schema->>'minLength')::NUMERIC THEN
+  IF _mask & K_MIN_LENGTH <> 0 AND jsonb_typeof(data) = 'string' THEN
+    IF length(data #>> '{}') < (schema->>'minLength')::NUMERIC THEN
       RETURN FALSE;
     END IF;
   END IF;
 
-  IF schema->>'pattern' IS NOT NULL AND jsonb_typeof(data) = 'string' THEN
-    IF NOT (array_to_json(array[data]))->>0 ~ (schema->>'pattern')::TEXT THEN
+  IF _mask & K_PATTERN <> 0 AND jsonb_typeof(data) = 'string' THEN
+    IF NOT (data #>> '{}') ~ (schema->>'pattern')::TEXT THEN
       RETURN FALSE;
     END IF;
   END IF;
 
   -- integer validation
-  IF schema->>'type' = 'integer' THEN
-    IF data::NUMERIC <> FLOOR(data::NUMERIC) THEN
+  IF _type = 'integer' THEN
+    IF (CASE WHEN jsonb_typeof(data) = 'number' THEN data::NUMERIC <> FLOOR(data::NUMERIC) ELSE TRUE END) THEN
       RETURN FALSE;
     END IF;
   END IF;
 
   -- number validation
-  IF (schema->>'type' = 'number') OR (schema->>'type' = 'integer') THEN
+  IF _type IN ('number', 'integer') THEN
     IF NOT jsonb_typeof(data) = 'number' THEN
       RETURN FALSE;
     END IF;
   END IF;
 
-  IF schema->>'multipleOf' IS NOT NULL AND jsonb_typeof(data) = 'number' THEN
+  IF _mask & K_MULTIPLE_OF <> 0 AND jsonb_typeof(data) = 'number' THEN
     IF (data::NUMERIC % (schema->>'multipleOf')::NUMERIC) != 0 THEN
       RETURN FALSE;
     END IF;
   END IF;
 
-  IF schema->>'minimum' IS NOT NULL AND jsonb_typeof(data) = 'number' THEN
+  IF _mask & K_MINIMUM <> 0 AND jsonb_typeof(data) = 'number' THEN
     IF data::NUMERIC < (schema->>'minimum')::NUMERIC THEN
       RETURN FALSE;
     END IF;
   END IF;
 
-  IF schema->>'maximum' IS NOT NULL AND jsonb_typeof(data) = 'number' THEN
+  IF _mask & K_MAXIMUM <> 0 AND jsonb_typeof(data) = 'number' THEN
     IF data::NUMERIC > (schema->>'maximum')::NUMERIC THEN
       RETURN FALSE;
     END IF;
   END IF;
 
-  IF schema->>'exclusiveMinimum' IS NOT NULL AND jsonb_typeof(data) = 'number' THEN
+  IF _mask & K_EXCLUSIVE_MINIMUM <> 0 AND jsonb_typeof(data) = 'number' THEN
     IF data::NUMERIC <= (schema->>'exclusiveMinimum')::NUMERIC THEN
       RETURN FALSE;
     END IF;
   END IF;
 
-  IF schema->>'exclusiveMaximum' IS NOT NULL AND jsonb_typeof(data) = 'number' THEN
+  IF _mask & K_EXCLUSIVE_MAXIMUM <> 0 AND jsonb_typeof(data) = 'number' THEN
     IF data::NUMERIC >= (schema->>'exclusiveMaximum')::NUMERIC THEN
       RETURN FALSE;
     END IF;
   END IF;
 
-  IF schema->>'not' IS NOT NULL THEN
-    IF validate_schema(data, schema->'not', _full_schema) THEN
+  IF _mask & K_NOT <> 0 THEN
+    IF _validate_schema(data, schema->'not', _handle, _base, _scope, _budget - 1) THEN
       RETURN FALSE;
     END IF;
   END IF;
 
   RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP FUNCTION IF EXISTS validate_schema(jsonb, jsonb, jsonb);
+DROP FUNCTION IF EXISTS _validate_schema(jsonb, jsonb, jsonb);
+DROP FUNCTION IF EXISTS _validate_schema(jsonb, jsonb, jsonb, text);
+DROP FUNCTION IF EXISTS _validate_schema(jsonb, jsonb, jsonb, text, int);
+DROP FUNCTION IF EXISTS _validate_schema(jsonb, jsonb, jsonb, text, text[], int);
+
+CREATE OR REPLACE FUNCTION validate_schema(data jsonb, schema jsonb)
+RETURNS BOOLEAN AS $$
+BEGIN
+  IF current_setting('pg_json_schema.engine', TRUE) IN ('compiled', 'jsonpath') THEN
+    RETURN _validate_cached(data, schema, current_setting('pg_json_schema.engine', TRUE) = 'jsonpath');
+  END IF;
+  -- detoast the arguments once instead of at every use in the top-level call
+  data := data #> '{}';
+  schema := schema #> '{}';
+  RETURN _validate_schema(data, schema,
+    CASE WHEN schema @? '$.** ? (exists(@."$ref") || exists(@."$dynamicRef"))' THEN _schema_index_handle(schema) END,
+    '', ARRAY[''], _max_evaluation_depth());
 
   EXCEPTION
+    -- a schema that nests too deep, loops or can't be checked is not a
+    -- validation failure
+    WHEN program_limit_exceeded OR invalid_recursion OR feature_not_supported THEN
+      RAISE;
     WHEN OTHERS THEN
       RAISE NOTICE 'An error occurred: %, SQLSTATE: %', SQLERRM, SQLSTATE;
       RETURN FALSE;
@@ -0,0 +1,286 @@
+import os
+
+import psycopg2
+import pytest
+
+from conftest import query
+
+# the test suite's remote documents, at their path under http://localhost:1234/
+REMOTES = os.path.join(os.path.dirname(__file__), "..", "jsons", "remotes")
+
+ALL = {"legacy", "compiled", "jsonpath"}
+COMPILED = {"compiled", "jsonpath"}
+LEGACY = {"legacy"}
+
+# Why a case fails, and the error it fails with.
+UNEVALUATED = (
+    "unevaluatedItems and unevaluatedProperties next to an in-place applicator raise "
+    "feature_not_supported: the items and properties the applicators evaluate aren't collected. "
+    "The recursive evaluator only raises once it gets that far.",
+    psycopg2.errors.FeatureNotSupported,
+)
+ENCODING = (
+    "the test database is SQL_ASCII, which rejects the \\u escapes of non-ASCII characters in the case",
+    psycopg2.errors.UntranslatableCharacter,
+)
+METASCHEMA = (
+    "$refs the draft 2020-12 meta-schema, which isn't registered",
+    AssertionError,
+)
+VOCABULARY = (
+    "$schema is ignored, so a meta-schema's $vocabulary doesn't turn keywords off",
+    AssertionError,
+)
+LEGACY_CONTAINS = ("the recursive evaluator doesn't check contains, minContains or maxContains", AssertionError)
+LEGACY_DEPENDENT_SCHEMAS = ("the recursive evaluator doesn't implement dependentSchemas", AssertionError)
+LEGACY_IF = ("the recursive evaluator doesn't implement if, then and else", AssertionError)
+LEGACY_PROPERTY_NAMES = ("the recursive evaluator doesn't implement propertyNames", AssertionError)
+LEGACY_TYPE_ARRAYS = ("the recursive evaluator ignores type when it is an array", AssertionError)
+LEGACY_UNIQUE_ITEMS = ("the recursive evaluator doesn't implement uniqueItems", AssertionError)
+
+# Draft cases an engine is known to fail: (reason, engines, module, cases).
+# They run as xfails that must fail with the reason's error, so any other
+# failure still fails the suite, and strict ones that start passing do too
+# until they're taken off the list. ENCODING cases pass on a UTF8 database,
+# so they aren't strict.
+KNOWN_FAILURES = [
+    (UNEVALUATED, ALL, "dynamicRef", [
+        "test_instance_with_correct_field",
+        "test_instance_with_misspelled_field",
+    ]),
+    (UNEVALUATED, ALL, "not", [
+        "test_annotations_are_still_collected_inside_a_not",
+        "test_unevaluated_property",
+    ]),
+    (UNEVALUATED, ALL, "unevaluatedItems", [
+        "test_5_not_evaluated_passes_unevaluatedItems",
+        "test_7_not_evaluated_fails_unevaluatedItems",
+        "test_as_and_bs_are_valid",
+        "test_as_bs_and_cs_are_valid",
+        "test_empty_array_is_valid",
+        "test_invalid_in_case_if_is_evaluated",
+        "test_only_as_and_cs_are_invalid",
+        "test_only_as_are_valid",
+        "test_only_bs_and_cs_are_invalid",
+        "test_only_bs_are_invalid",
+        "test_only_cs_are_invalid",
+        "test_valid_in_case_if_is_evaluated",
+        "test_when_if_doesnt_match_and_it_has_no_unevaluated_items",
+        "test_when_if_doesnt_match_and_it_has_unevaluated_items",
+        "test_when_if_matches_and_it_has_no_unevaluated_items",
+        "test_when_if_matches_and_it_has_unevaluated_items",
+        "test_when_one_schema_matches_and_has_no_unevaluated_items",
+        "test_when_one_schema_matches_and_has_unevaluated_items",
+        "test_when_two_schemas_match_and_has_no_unevaluated_items",
+        "test_when_two_schemas_match_and_has_unevaluated_items",
+        "test_with_additional_items",
+        "test_with_invalid_additional_item",
+        "test_with_no_additional_items",
+        "test_with_no_unevaluated_items",
+        "test_with_only_valid_additional_items",
+        "test_with_unevaluated_items",
+    ]),
+    (UNEVALUATED, ALL, "unevaluatedProperties", [
+        "test_a_and_b_and_x_are_valid",
+        "test_a_and_b_and_y_are_valid",
+        "test_a_and_x_are_valid",
+        "test_a_and_y_are_valid",
+        "test_a_is_valid",
+        "test_all__foo_is_valid",
+        "test_all_is_valid",
+        "test_b_is_valid",
+        "test_c_is_valid",
+        "test_d_is_valid",
+        "test_invalid_in_case_if_is_evaluated",
+        "test_valid_in_case_if_is_evaluated",
+        "test_when_if_is_false_and_has_no_unevaluated_properties",
+        "test_when_if_is_false_and_has_unevaluated_properties",
+        "test_when_if_is_true_and_has_no_unevaluated_properties",
+        "test_when_if_is_true_and_has_unevaluated_properties",
+        "test_when_one_matches_and_has_no_unevaluated_properties",
+        "test_when_one_matches_and_has_unevaluated_properties",
+        "test_when_two_match_and_has_no_unevaluated_properties",
+        "test_when_two_match_and_has_unevaluated_properties",
+        "test_with_additional_properties",
+        "test_with_no_additional_properties",
+        "test_with_no_unevaluated_properties",
+        "test_with_unevaluated_properties",
+        "test_xx__foo_is_invalid",
+        "test_xx__foox_is_valid",
+        "test_xx_is_valid",
+    ]),
+    (UNEVALUATED, COMPILED, "unevaluatedProperties", [
+        "test_Empty_is_invalid",
+        "test_Empty_is_invalid_no_x_or_y",
+        "test_a__b_is_invalid",
+        "test_a__c_is_invalid",
+        "test_a__d_is_invalid",
+        "test_a_and_b_and_x_and_y_are_invalid",
+        "test_a_and_b_are_invalid_no_x_or_y",
+        "test_all__a_is_invalid",
+        "test_b__c_is_invalid",
+        "test_b__d_is_invalid",
+        "test_c__d_is_invalid",
+        "test_x_and_y_are_invalid",
+        "test_xx__a_is_invalid",
+        "test_xx__b_is_invalid",
+        "test_xx__c_is_invalid",
+        "test_xx__d_is_invalid",
+    ]),
+    (ENCODING, ALL, "additionalProperties", [
+        "test_matching_the_pattern_is_valid",
+        "test_not_matching_the_pattern_is_invalid",
+    ]),
+    (ENCODING, ALL, "format", [
+        "test_invalid_idnhostname_string_is_only_an_annotation_by_default",
+        "test_invalid_irireference_string_is_only_an_annotation_by_default",
+    ]),
+    (ENCODING, ALL, "maxLength", [
+        "test_two_graphemes_is_long_enough",
+    ]),
+    (ENCODING, ALL, "minLength", [
+        "test_one_grapheme_is_not_long_enough",
+    ]),
+    (ENCODING, ALL, "ref", [
+        "test_is_invalid",
+    ]),
+    (METASCHEMA, ALL, "defs", [
+        "test_valid_definition_schema",
+    ]),
+    (METASCHEMA, ALL, "id", [
+        "test_Identifier_name_with_absolute_URI",
+        "test_Identifier_name_with_base_URI_change_in_subschema",
+        "test_Unnormalized_identifier",
+        "test_Unnormalized_identifier_and_no_ref",
+        "test_Unnormalized_identifier_with_empty_fragment",
+        "test_Unnormalized_identifier_with_empty_fragment_and_no_ref",
+    ]),
+    (METASCHEMA, ALL, "ref", [
+        "test_remote_ref_valid",
+    ]),
+    (VOCABULARY, ALL, "vocabulary", [
+        "test_no_validation_invalid_number_but_it_still_validates",
+    ]),
+    (LEGACY_CONTAINS, LEGACY, "contains", [
+        "test_any_nonempty_array_is_invalid",
+        "test_array_without_item_5_is_invalid",
+        "test_array_without_items_matching_schema_is_invalid",
+        "test_empty_array_is_invalid",
+        "test_matches_items_does_not_match_contains",
+    ]),
+    (LEGACY_CONTAINS, LEGACY, "maxContains", [
+        "test_actual__minContains__maxContains",
+        "test_all_elements_match_invalid_maxContains",
+        "test_empty_data",
+        "test_minContains__maxContains__actual",
+        "test_some_elements_match_invalid_maxContains",
+        "test_too_many_elements_match_invalid_maxContains",
+    ]),
+    (LEGACY_CONTAINS, LEGACY, "minContains", [
+        "test_all_elements_match_invalid_maxContains",
+        "test_all_elements_match_invalid_minContains",
+        "test_invalid_maxContains",
+        "test_invalid_maxContains_and_minContains",
+        "test_invalid_minContains",
+        "test_no_elements_match",
+        "test_one_element_matches_invalid_minContains",
+        "test_some_elements_match_invalid_minContains",
+        "test_too_many",
+    ]),
+    (LEGACY_DEPENDENT_SCHEMAS, LEGACY, "dependentSchemas", [
+        "test_matches_both",
+        "test_matches_root",
+        "test_object_with_both_properties_is_invalid",
+        "test_object_with_property_having_schema_false_is_invalid",
+        "test_quoted_quote",
+        "test_quoted_quote_invalid_under_dependent_schema",
+        "test_quoted_tab_invalid_under_dependent_schema",
+        "test_wrong_type",
+        "test_wrong_type_both",
+        "test_wrong_type_other",
+    ]),
+    (LEGACY_IF, LEGACY, "dynamicRef", [
+        "test_first_scope_is_not_in_dynamic_scope_for_the_dynamicRef",
+        "test_number_list_with_string_values",
+        "test_string_list_with_number_values",
+        "test_string_matches_defsthingy_but_the_dynamicRef_does_not_stop_here",
+    ]),
+    (LEGACY_IF, LEGACY, "if-then-else", [
+        "test_boolean_schema_false_in_if_always_chooses_the_else_path_invalid",
+        "test_boolean_schema_true_in_if_always_chooses_the_then_path_invalid",
+        "test_invalid_redirects_to_else_and_fails",
+        "test_invalid_through_else",
+        "test_invalid_through_then",
+        "test_no_redirects_to_then_and_fails",
+    ]),
+    (LEGACY_PROPERTY_NAMES, LEGACY, "propertyNames", [
+        "test_object_with_any_properties_is_invalid",
+        "test_some_property_names_invalid",
+    ]),
+    (LEGACY_TYPE_ARRAYS, LEGACY, "not", [
+        "test_valid",
+    ]),
+    (LEGACY_TYPE_ARRAYS, LEGACY, "type", [
+        "test_a_boolean_is_invalid",
+        "test_a_float_is_invalid",
+        "test_an_array_is_invalid",
+        "test_an_object_is_invalid",
+        "test_null_is_invalid",
+        "test_number_is_invalid",
+        "test_string_is_invalid",
+    ]),
+    (LEGACY_UNIQUE_ITEMS, LEGACY, "uniqueItems", [
+        "test_false_false_from_items_array_is_not_valid",
+        "test_nonunique_array_extended_from_false_true_is_not_valid",
+        "test_nonunique_array_extended_from_true_false_is_not_valid",
+        "test_nonunique_array_of_arrays_is_invalid",
+        "test_nonunique_array_of_integers_is_invalid",
+        "test_nonunique_array_of_more_than_two_arrays_is_invalid",
+        "test_nonunique_array_of_more_than_two_integers_is_invalid",
+        "test_nonunique_array_of_nested_objects_is_invalid",
+        "test_nonunique_array_of_objects_is_invalid",
+        "test_nonunique_array_of_strings_is_invalid",
+        "test_nonunique_heterogeneous_types_are_invalid",
+        "test_objects_are_nonunique_despite_key_order",
+        "test_property_order_of_array_of_objects_is_ignored",
+        "test_true_true_from_items_array_is_not_valid",
+    ]),
+]
+
+
+@pytest.fixture(scope="session", autouse=True)
+def remotes(clean_testing_database):
+    """Registers the remote documents the draft cases $ref, so they resolve
+    from the registry like any other schema."""
+    conn = psycopg2.connect(os.environ["DATABASE_URL"])
+    try:
+        for root, _, files in os.walk(REMOTES):
+            for name in files:
+                path = os.path.join(root, name)
+                uri = "http://localhost:1234/" + os.path.relpath(path, REMOTES).replace(os.sep, "/")
+                with open(path) as f:
+                    query(conn, "SELECT register_schema(%s::jsonb, %s)", f.read(), uri)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+@pytest.fixture(autouse=True)
+def engine(engine):
+    """Runs every draft case once per engine."""
+    return engine
+
+
+def pytest_collection_modifyitems(items):
+    known = {}
+    for (reason, raises), engines, module, cases in KNOWN_FAILURES:
+        for case in cases:
+            for engine in engines:
+                known[module, case, engine] = (reason, raises)
+    for item in items:
+        if not hasattr(item, "callspec"):
+            continue
+        entry = known.get((item.path.stem, item.originalname, item.callspec.id))
+        if entry:
+            reason, raises = entry
+            item.add_marker(pytest.mark.xfail(reason=reason, raises=raises, strict=raises is not psycopg2.errors.UntranslatableCharacter))
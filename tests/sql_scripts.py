@@ -0,0 +1,11 @@
+# The SQL scripts that make up the validator, in load order. Kept apart from
+# conftest.py so bench.py can import it without conftest's setup.
+SCRIPTS = [
+    "validate_schema.sql",
+    "schema_registry.sql",
+    "compile_jsonpath.sql",
+    "simplify_schema.sql",
+    "compile_schema.sql",
+    "validate_compiled.sql",
+    "generate_validator.sql",
+]
@@ -0,0 +1,62 @@
+import json
+
+from conftest import query
+
+
+def test_compile_to_jsonpath(db_conn):
+    path = query(db_conn, "SELECT compile_to_jsonpath(%s::jsonb)", json.dumps({"type": "string", "maxLength": 3}))
+    assert query(db_conn, "SELECT %s::jsonb @@ %s::jsonpath", json.dumps("abc"), path) is True
+    assert query(db_conn, "SELECT %s::jsonb @@ %s::jsonpath", json.dumps("abcd"), path) is False
+    assert query(db_conn, "SELECT %s::jsonb @@ %s::jsonpath", json.dumps(3), path) is False
+
+
+def test_compile_to_jsonpath_dot_matches_newline(db_conn):
+    # as with ~, which the other engines use
+    path = query(db_conn, "SELECT compile_to_jsonpath(%s::jsonb)", json.dumps({
+        "pattern": "^a.b$", "patternProperties": {"^a.b$": {"type": "integer"}}, "additionalProperties": False,
+    }))
+    assert query(db_conn, "SELECT %s::jsonb @@ %s::jsonpath", json.dumps("a\nb"), path) is True
+    assert query(db_conn, "SELECT %s::jsonb @@ %s::jsonpath", json.dumps({"a\nb": 1}), path) is True
+    assert query(db_conn, "SELECT %s::jsonb @@ %s::jsonpath", json.dumps({"a\nb": "x"}), path) is False
+
+
+def test_compile_to_jsonpath_unsupported(db_conn):
+    assert query(db_conn, "SELECT compile_to_jsonpath(%s::jsonb)", json.dumps({"uniqueItems": True})) is None
+
+
+def test_compile_to_jsonpath_size_budget(db_conn):
+    # each level inlines the one below twice
+    defs = {"d0": {"type": "string", "maxLength": 5}}
+    for i in range(1, 13):
+        defs[f"d{i}"] = {"allOf": [{"$ref": f"#/$defs/d{i - 1}"}, {"$ref": f"#/$defs/d{i - 1}"}]}
+    assert query(db_conn, "SELECT compile_to_jsonpath(%s::jsonb)", json.dumps({"$defs": defs, "$ref": "#/$defs/d2"})) is not None
+    assert query(db_conn, "SELECT compile_to_jsonpath(%s::jsonb)", json.dumps({"$defs": defs, "$ref": "#/$defs/d12"})) is None
+
+
+def test_compile_to_jsonpath_translates_ref_targets_once(db_conn):
+    # each level names the one below twice: without a memo that is 2^40 translations
+    defs = {"d0": {"type": "string"}}
+    for i in range(1, 41):
+        defs[f"d{i}"] = {"properties": {"a": {"$ref": f"#/$defs/d{i - 1}"}, "b": {"$ref": f"#/$defs/d{i - 1}"}}}
+    query(db_conn, "SELECT set_config('statement_timeout', '5s', true)")
+    assert query(db_conn, "SELECT compile_to_jsonpath(%s::jsonb)", json.dumps({"$defs": defs, "$ref": "#/$defs/d40"})) is None
+
+
+def test_plan_is_translated_for_the_jsonpath_engine_only(db_conn):
+    schema = json.dumps({"type": "object", "required": ["id"]})
+    query(db_conn, "SELECT set_config('pg_json_schema.engine', 'compiled', false)")
+    assert query(db_conn, "SELECT validate_schema('{}', %s::jsonb)", schema) is False
+    assert query(db_conn, "SELECT jsonpath_translated FROM json_schema_plan WHERE schema = %s::jsonb", schema) is False
+
+    query(db_conn, "SELECT set_config('pg_json_schema.engine', 'jsonpath', false)")
+    assert query(db_conn, "SELECT validate_schema('{}', %s::jsonb)", schema) is False
+    assert query(db_conn, "SELECT jsonpath IS NOT NULL FROM json_schema_plan WHERE schema = %s::jsonb", schema) is True
+
+
+def test_compile_to_jsonpath_min_contains_zero(db_conn):
+    path = query(db_conn, "SELECT compile_to_jsonpath(%s::jsonb)", json.dumps({
+        "contains": {"type": "number"}, "minContains": 0, "unevaluatedItems": {"type": "string"},
+    }))
+    assert query(db_conn, "SELECT %s::jsonb @@ %s::jsonpath", json.dumps([]), path) is True
+    assert query(db_conn, "SELECT %s::jsonb @@ %s::jsonpath", json.dumps(["a", 1]), path) is True
+    assert query(db_conn, "SELECT %s::jsonb @@ %s::jsonpath", json.dumps(["a", None]), path) is False
@@ -0,0 +1,45 @@
+import json
+import os
+
+import psycopg2
+import pytest
+
+from conftest import compile_schema, query, validate_compiled
+
+
+def test_same_schema_reuses_plan(db_conn):
+    schema = {"type": "object", "required": ["id"]}
+    assert compile_schema(db_conn, schema) == compile_schema(db_conn, schema)
+
+
+def test_concurrent_compilers_share_one_plan(db_conn):
+    schema = {"type": "object", "required": ["shared"]}
+    compile_schema(db_conn, schema)
+    other = psycopg2.connect(os.environ["DATABASE_URL"])
+    try:
+        # the second compiler waits for the first's plan instead of making its own
+        query(other, "SELECT set_config('lock_timeout', '100ms', true)")
+        with pytest.raises(psycopg2.errors.LockNotAvailable):
+            compile_schema(other, schema)
+    finally:
+        other.rollback()
+        other.close()
+
+
+def test_ref_cycle_is_rejected(db_conn):
+    schema = {
+        "$ref": "#/$defs/a",
+        "$defs": {"a": {"$ref": "#/$defs/b"}, "b": {"allOf": [{"$ref": "#/$defs/a"}]}},
+    }
+    with pytest.raises(psycopg2.errors.InvalidRecursion, match="refers back to itself"):
+        compile_schema(db_conn, schema)
+
+
+def test_unevaluated_items_next_to_applicators_is_unsupported(db_conn):
+    schema = {"prefixItems": [{"type": "string"}], "allOf": [{"prefixItems": [True, {"type": "number"}]}]}
+    with pytest.raises(psycopg2.errors.FeatureNotSupported, match="unevaluatedItems"):
+        compile_schema(db_conn, {**schema, "unevaluatedItems": False})
+    db_conn.rollback()
+    # one that can't fail is fine
+    plan_id = compile_schema(db_conn, {**schema, "unevaluatedItems": True})
+    assert validate_compiled(db_conn, ["a", 1, None], plan_id) is True
@@ -0,0 +1,64 @@
+import json
+
+import psycopg2
+import pytest
+
+from conftest import TAGGED_UNION, query
+
+
+def test_generated_validator(db_conn):
+    ddl = query(db_conn, "SELECT generate_validator(%s::jsonb, 'test_validator')",
+                json.dumps({"type": "object", "required": ["id"], "properties": {"id": {"type": "integer"}}}))
+    assert ddl.startswith("CREATE OR REPLACE FUNCTION test_validator(data JSONB) RETURNS BOOLEAN")
+    assert "IMMUTABLE PARALLEL SAFE" in ddl
+    assert query(db_conn, "SELECT test_validator('{\"id\": 1}')") is True
+    assert query(db_conn, "SELECT test_validator('{\"id\": \"1\"}')") is False
+    assert query(db_conn, "SELECT test_validator('{}')") is False
+
+
+def test_shared_subschemas_get_helpers(db_conn):
+    ddl = query(db_conn, "SELECT generate_validator(%s::jsonb, 'test_tree')",
+                json.dumps({"type": "object", "properties": {"children": {"items": {"$ref": "#"}}, "name": {"type": "string"}}}))
+    assert ddl.count("CREATE OR REPLACE FUNCTION") == 1
+    assert "test_tree(m" in ddl
+    assert query(db_conn, "SELECT test_tree('{\"children\": [{\"name\": \"a\", \"children\": []}]}')") is True
+    assert query(db_conn, "SELECT test_tree('{\"children\": [{\"name\": 1}]}')") is False
+
+
+def test_generated_tagged_union(db_conn):
+    query(db_conn, "SELECT generate_validator(%s::jsonb, 'test_union')", json.dumps({"anyOf": TAGGED_UNION}))
+    assert query(db_conn, "SELECT test_union('{\"kind\": \"b\", \"b\": \"x\"}')") is True
+    assert query(db_conn, "SELECT test_union('{\"kind\": \"b\", \"b\": 1}')") is False
+    assert query(db_conn, "SELECT test_union('5')") is True
+
+
+
+def test_recursive_ref(db_conn):
+    query(db_conn, "SELECT generate_validator(%s::jsonb, 'test_list')", json.dumps({
+        "type": "object",
+        "required": ["value"],
+        "properties": {"value": {"type": "integer"}, "next": {"anyOf": [{"type": "null"}, {"$ref": "#"}]}},
+    }))
+    assert query(db_conn, "SELECT test_list('{\"value\": 1, \"next\": {\"value\": 2, \"next\": null}}')") is True
+    assert query(db_conn, "SELECT test_list('{\"value\": 1, \"next\": {\"value\": \"2\"}}')") is False
+    assert query(db_conn, "SELECT test_list('{\"value\": 1, \"next\": {\"next\": null}}')") is False
+
+
+def test_shared_defs(db_conn):
+    query(db_conn, "SELECT generate_validator(%s::jsonb, 'test_points')", json.dumps({
+        "$defs": {"point": {"type": "object", "required": ["x", "y"], "properties": {"x": {"type": "number"}, "y": {"type": "number"}}}},
+        "properties": {"from": {"$ref": "#/$defs/point"}, "to": {"$ref": "#/$defs/point"}},
+    }))
+    assert query(db_conn, "SELECT test_points('{\"from\": {\"x\": 0, \"y\": 0}, \"to\": {\"x\": 1, \"y\": 2}}')") is True
+    assert query(db_conn, "SELECT test_points('{\"from\": {\"x\": 0, \"y\": 0}, \"to\": {\"x\": 1}}')") is False
+    assert query(db_conn, "SELECT test_points('{\"from\": {\"x\": \"0\", \"y\": 0}}')") is False
+
+
+def test_dynamic_scope_is_unsupported(db_conn):
+    schema = {
+        "$id": "https://example.com/tests/tree",
+        "$dynamicAnchor": "node",
+        "properties": {"children": {"items": {"$dynamicRef": "#node"}}},
+    }
+    with pytest.raises(psycopg2.errors.RaiseException, match="dynamic scope"):
+        query(db_conn, "SELECT generate_validator(%s::jsonb, 'test_tree')", json.dumps(schema))
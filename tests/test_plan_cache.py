@@ -0,0 +1,81 @@
+import json
+
+from conftest import query
+
+
+def validate(conn, data, schema):
+    return query(conn, "SELECT validate_schema(%s::jsonb, %s::jsonb)", json.dumps(data), json.dumps(schema))
+
+
+def stats(conn):
+    return query(conn, "SELECT to_jsonb(s) FROM plan_cache_stats() s")
+
+
+def configure(conn, **settings):
+    for name, value in settings.items():
+        query(conn, "SELECT set_config(%s, %s, false)", f"pg_json_schema.{name}", str(value))
+
+
+def test_hits_and_misses(db_conn):
+    configure(db_conn, engine="compiled")
+    assert validate(db_conn, 1, {"type": "integer"}) is True
+    assert validate(db_conn, "a", {"type": "integer"}) is False
+    assert validate(db_conn, "a", {"type": "string"}) is True
+    assert validate(db_conn, 1, {"type": "integer"}) is True
+    s = stats(db_conn)
+    assert (s["entries"], s["hits"], s["misses"], s["evictions"]) == (2, 2, 2, 0)
+    assert s["bytes"] > 0
+
+
+def test_least_recently_used_is_evicted(db_conn):
+    configure(db_conn, engine="compiled", cache_size=2)
+    validate(db_conn, 1, {"type": "integer"})
+    validate(db_conn, 1, {"type": "number"})
+    validate(db_conn, 1, {"type": "integer"})
+    validate(db_conn, 1, {"minimum": 0})
+    s = stats(db_conn)
+    assert (s["entries"], s["misses"], s["evictions"]) == (2, 3, 1)
+    # number was evicted, integer is still cached
+    validate(db_conn, 1, {"type": "integer"})
+    assert stats(db_conn)["misses"] == 3
+    validate(db_conn, 1, {"type": "number"})
+    assert stats(db_conn)["misses"] == 4
+
+
+def test_byte_limit(db_conn):
+    configure(db_conn, engine="compiled", cache_bytes=1)
+    validate(db_conn, 1, {"type": "integer"})
+    validate(db_conn, 1, {"type": "number"})
+    # the entry just added is always kept
+    s = stats(db_conn)
+    assert (s["entries"], s["evictions"]) == (1, 1)
+
+
+def test_disabled(db_conn):
+    configure(db_conn, engine="compiled", cache_size=0)
+    assert validate(db_conn, 1, {"type": "integer"}) is True
+    assert validate(db_conn, "a", {"type": "integer"}) is False
+    s = stats(db_conn)
+    assert (s["entries"], s["hits"], s["misses"]) == (0, 0, 0)
+
+
+def test_unknown_jsonpath_verdict_is_false(db_conn):
+    schema = {"type": "array"}
+    plan_id = query(db_conn, "SELECT compile_schema(%s::jsonb)", json.dumps(schema))
+    query(db_conn, "UPDATE json_schema_plan SET jsonpath = 'strict $[*].a == 1', jsonpath_translated = TRUE WHERE plan_id = %s RETURNING 1", plan_id)
+    for size in (0, 256):
+        configure(db_conn, engine="jsonpath", cache_size=size)
+        assert validate(db_conn, [1], schema) is False
+
+
+def test_new_version_reaches_cached_programs(db_conn):
+    uri = "https://example.com/tests/plan_cache.json"
+    query(db_conn, "SELECT register_schema('{\"type\": \"integer\"}', %s)", uri)
+    configure(db_conn, engine="compiled")
+    generation = query(db_conn, "SELECT generation FROM json_schema_registry_generation")
+    assert validate(db_conn, "a", {"$ref": uri}) is False
+
+    query(db_conn, "SELECT register_schema('{\"type\": \"string\"}', %s)", uri)
+    assert query(db_conn, "SELECT generation FROM json_schema_registry_generation") == generation + 1
+    assert validate(db_conn, "a", {"$ref": uri}) is True
+    assert stats(db_conn)["evictions"] == 1
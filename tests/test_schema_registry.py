@@ -0,0 +1,64 @@
+import json
+import os
+
+import psycopg2
+import pytest
+
+from conftest import query
+
+URI = "https://example.com/tests/registry.json"
+
+
+def register_schema(conn, schema, uri=URI):
+    return query(conn, "SELECT register_schema(%s::jsonb, %s)", json.dumps(schema), uri)
+
+
+def test_versions(db_conn):
+    assert register_schema(db_conn, {"type": "integer"}) == 1
+    assert register_schema(db_conn, {"type": "integer"}) == 1
+    assert register_schema(db_conn, {"type": "string"}) == 2
+    assert query(db_conn, "SELECT resolve_uri(%s)", URI) == {"$id": URI, "type": "string"}
+    assert query(db_conn, "SELECT resolve_uri(%s, 1)", URI) == {"$id": URI, "type": "integer"}
+
+
+def test_uri_must_be_absolute(db_conn):
+    with pytest.raises(psycopg2.errors.RaiseException, match="absolute URI"):
+        register_schema(db_conn, {}, "registry.json")
+
+
+def test_resolve_uri_fragment(db_conn):
+    register_schema(db_conn, {"$defs": {"name": {"type": "string"}}})
+    assert query(db_conn, "SELECT resolve_uri(%s)", URI + "#/$defs/name") == {"type": "string"}
+
+
+def test_ref_to_registered_schema(engine, db_conn):
+    register_schema(db_conn, {"type": "integer"})
+    schema = json.dumps({"properties": {"n": {"$ref": URI}}})
+    assert query(db_conn, "SELECT validate_schema('{\"n\": 1}', %s::jsonb)", schema) is True
+    assert query(db_conn, "SELECT validate_schema('{\"n\": \"a\"}', %s::jsonb)", schema) is False
+    assert query(db_conn, "SELECT validate_registered('1', %s)", URI) is True
+    assert query(db_conn, "SELECT validate_registered('\"a\"', %s)", URI) is False
+
+
+def test_new_version_drops_plans(db_conn):
+    register_schema(db_conn, {"type": "integer"})
+    schema = json.dumps({"$ref": URI})
+    plan_id = query(db_conn, "SELECT compile_schema(%s::jsonb)", schema)
+    assert query(db_conn, "SELECT validate_compiled('\"a\"', %s)", plan_id) is False
+
+    register_schema(db_conn, {"type": "string"})
+    assert query(db_conn, "SELECT count(*) FROM json_schema_plan WHERE plan_id = %s", plan_id) == 0
+    plan_id = query(db_conn, "SELECT compile_schema(%s::jsonb)", schema)
+    assert query(db_conn, "SELECT validate_compiled('\"a\"', %s)", plan_id) is True
+
+
+def test_first_registrations_of_a_uri_queue(db_conn):
+    register_schema(db_conn, {"type": "integer"}, URI + "-new")
+    other = psycopg2.connect(os.environ["DATABASE_URL"])
+    try:
+        query(other, "SELECT set_config('lock_timeout', '100ms', true)")
+        with pytest.raises(psycopg2.errors.LockNotAvailable):
+            register_schema(other, {"type": "string"}, URI + "-new")
+    finally:
+        other.rollback()
+        other.close()
@@ -0,0 +1,19 @@
+import json
+
+import pytest
+
+from conftest import compile_schema, query, validate_compiled
+
+
+def test_simplify_schema_merges_all_of(db_conn):
+    schema = {"allOf": [{"type": "string"}, {"maxLength": 3}]}
+    assert query(db_conn, "SELECT simplify_schema(%s::jsonb)", json.dumps(schema)) == {"type": "string", "maxLength": 3}
+
+
+@pytest.mark.parametrize("outer, inner", [("number", "integer"), ("integer", "number")])
+def test_simplify_schema_intersects_number_and_integer(db_conn, outer, inner):
+    schema = {"type": outer, "allOf": [{"type": inner}]}
+    assert query(db_conn, "SELECT simplify_schema(%s::jsonb)", json.dumps(schema)) == {"type": "integer"}
+    plan_id = compile_schema(db_conn, schema)
+    assert validate_compiled(db_conn, 1, plan_id) is True
+    assert validate_compiled(db_conn, 1.5, plan_id) is False
@@ -0,0 +1,84 @@
+import psycopg2
+import pytest
+
+from conftest import TAGGED_UNION, compile_schema, query, validate_compiled
+
+
+def test_validate_compiled(db_conn):
+    plan_id = compile_schema(db_conn, {
+        "type": "object",
+        "required": ["id"],
+        "properties": {"id": {"type": "integer", "minimum": 1}, "tags": {"items": {"type": "string"}}},
+    })
+    assert validate_compiled(db_conn, {"id": 1, "tags": ["a"]}, plan_id) is True
+    assert validate_compiled(db_conn, {"id": 0}, plan_id) is False
+    assert validate_compiled(db_conn, {"id": 1, "tags": [1]}, plan_id) is False
+    assert validate_compiled(db_conn, {}, plan_id) is False
+
+
+def test_unknown_plan(db_conn):
+    with pytest.raises(psycopg2.errors.RaiseException, match="Unknown plan"):
+        validate_compiled(db_conn, {}, -1)
+
+
+def test_recursion_through_the_instance_compiles(db_conn):
+    plan_id = compile_schema(db_conn, {"type": "object", "properties": {"child": {"$ref": "#"}}})
+    assert validate_compiled(db_conn, {"child": {"child": {}}}, plan_id) is True
+    assert validate_compiled(db_conn, {"child": {"child": 1}}, plan_id) is False
+
+
+def test_deep_documents(db_conn):
+    # deeper than the recursive evaluator's max_stack_depth allows
+    plan_id = compile_schema(db_conn, {"type": "object", "properties": {"child": {"$ref": "#"}}})
+    data = '{"child": ' * 2000 + "{}" + "}" * 2000
+    assert query(db_conn, "SELECT validate_compiled(%s::jsonb, %s)", data, plan_id) is True
+
+
+def test_tagged_union(db_conn):
+    plan_id = compile_schema(db_conn, {"anyOf": TAGGED_UNION})
+    assert query(db_conn, "SELECT count(*) FROM json_schema_plan_keyword WHERE plan_id = %s AND json_operand ? 'branches'", plan_id) == 1
+    assert validate_compiled(db_conn, {"kind": "a", "a": 1}, plan_id) is True
+    assert validate_compiled(db_conn, {"kind": "a", "a": "x"}, plan_id) is False
+    assert validate_compiled(db_conn, {"kind": "c"}, plan_id) is False
+    assert validate_compiled(db_conn, {"a": 1}, plan_id) is False
+    # the branches don't constrain non-objects
+    assert validate_compiled(db_conn, 5, plan_id) is True
+    assert validate_compiled(db_conn, 5, compile_schema(db_conn, {"oneOf": TAGGED_UNION})) is False
+
+
+@pytest.mark.parametrize("memo_size", ["0", "1", "4096"])
+def test_memo_size(db_conn, memo_size):
+    plan_id = compile_schema(db_conn, {
+        "$defs": {"tree": {
+            "type": "object",
+            "anyOf": [{"required": ["a"]}, {"required": ["b"]}],
+            "properties": {"kids": {"items": {"$ref": "#/$defs/tree"}}},
+        }},
+        "allOf": [{"$ref": "#/$defs/tree"}],
+        "anyOf": [{"required": ["x"]}, {"$ref": "#/$defs/tree"}],
+    })
+    query(db_conn, "SELECT set_config('pg_json_schema.memo_size', %s, true)", memo_size)
+    assert validate_compiled(db_conn, {"a": 1, "kids": [{"b": 1}, {"a": 1, "kids": [{"b": 2}]}]}, plan_id) is True
+    assert validate_compiled(db_conn, {"a": 1, "kids": [{"b": 1}, {"a": 1, "kids": [{}]}]}, plan_id) is False
+
+
+def test_depth_budget(db_conn):
+    plan_id = compile_schema(db_conn, {"properties": {"child": {"$ref": "#"}}})
+    data = {}
+    for _ in range(10):
+        data = {"child": data}
+    query(db_conn, "SELECT set_config('pg_json_schema.max_depth', '5', true)")
+    with pytest.raises(psycopg2.errors.ProgramLimitExceeded, match="max_depth"):
+        validate_compiled(db_conn, data, plan_id)
+
+
+def test_vectorized_items_fail_closed(db_conn):
+    plan_id = compile_schema(db_conn, {"items": {"type": "integer"}, "prefixItems": [{"minimum": 0}]})
+    assert query(db_conn, "SELECT count(*) FROM json_schema_plan_keyword WHERE plan_id = %s AND path_operand IS NOT NULL", plan_id) > 0
+    assert validate_compiled(db_conn, [0, 1], plan_id) is True
+    assert validate_compiled(db_conn, [-1, 1], plan_id) is False
+    assert validate_compiled(db_conn, [0, "a"], plan_id) is False
+    # a predicate that comes out unknown fails the array
+    query(db_conn, "UPDATE json_schema_plan_keyword SET path_operand = 'strict $[*].a == 1' WHERE plan_id = %s AND path_operand IS NOT NULL RETURNING 1", plan_id)
+    query(db_conn, "SELECT _assemble_plan(%s)", plan_id)
+    assert validate_compiled(db_conn, [0, 1], plan_id) is False
@@ -0,0 +1,64 @@
+import json
+
+import psycopg2
+import pytest
+
+from conftest import query
+
+
+def validate_schema(conn, data, schema):
+    return query(conn, "SELECT validate_schema(%s::jsonb, %s::jsonb)", json.dumps(data), json.dumps(schema))
+
+
+def test_depth_limit_is_raised(engine, db_conn):
+    query(db_conn, "SELECT set_config('pg_json_schema.max_depth', '5', true)")
+    data = {}
+    for _ in range(10):
+        data = {"child": data}
+    with pytest.raises(psycopg2.errors.ProgramLimitExceeded):
+        validate_schema(db_conn, data, {"properties": {"child": {"$ref": "#"}}})
+
+
+def test_cycle_is_raised(engine, db_conn):
+    # the recursive evaluator doesn't look for cycles and runs into max_depth
+    query(db_conn, "SELECT set_config('pg_json_schema.max_depth', '50', true)")
+    with pytest.raises(psycopg2.errors.InvalidRecursion if engine else psycopg2.errors.ProgramLimitExceeded):
+        validate_schema(db_conn, {}, {"$ref": "#/$defs/a", "$defs": {"a": {"allOf": [{"$ref": "#/$defs/a"}]}}})
+
+
+@pytest.mark.parametrize("keyword, data", [("unevaluatedItems", ["a", 1]), ("unevaluatedProperties", {"a": 1})])
+def test_unevaluated_next_to_applicators_is_raised(engine, db_conn, keyword, data):
+    # the items and members the applicators evaluate aren't collected
+    schema = {"anyOf": [{"prefixItems": [True, True], "properties": {"a": True}}, {"minItems": 3, "minProperties": 3}], keyword: False}
+    with pytest.raises(psycopg2.errors.FeatureNotSupported, match=keyword):
+        validate_schema(db_conn, data, schema)
+    db_conn.rollback()
+    # one that can't fail is fine
+    assert validate_schema(db_conn, data, {**schema, keyword: True}) is True
+
+
+def test_unevaluated_items_after_contains(engine, db_conn):
+    schema = {"prefixItems": [{"type": "string"}], "contains": {"type": "number"}, "unevaluatedItems": False}
+    assert validate_schema(db_conn, ["a", 1, 2], schema) is True
+    assert validate_schema(db_conn, ["a", 1, None], schema) is False
+
+
+def test_additional_properties_leaves_nothing_unevaluated(engine, db_conn):
+    schema = {"additionalProperties": True, "unevaluatedProperties": False}
+    assert validate_schema(db_conn, {"a": 1}, schema) is True
+
+
+def test_index_is_cached_until_the_registry_changes(db_conn):
+    uri = "https://example.com/tests/index_cache.json"
+    schema = {"properties": {"n": {"$ref": uri}, "m": {"$ref": "#/$defs/m"}}, "$defs": {"m": {"type": "null"}}}
+    query(db_conn, "SELECT register_schema('{\"type\": \"integer\"}', %s)", uri)
+    assert validate_schema(db_conn, {"n": 1, "m": None}, schema) is True
+    assert validate_schema(db_conn, {"n": "a"}, schema) is False
+    assert validate_schema(db_conn, {"m": 1}, schema) is False
+    assert query(db_conn, "SELECT count(*) FROM pg_temp.json_schema_index_cache") == 1
+    # the pointer is indexed along with the resources
+    assert query(db_conn, "SELECT count(*) FROM pg_temp.json_schema_index_entry WHERE uri = '#/$defs/m'") == 1
+
+    query(db_conn, "SELECT register_schema('{\"type\": \"string\"}', %s)", uri)
+    assert validate_schema(db_conn, {"n": "a"}, schema) is True
+    assert query(db_conn, "SELECT count(*) FROM pg_temp.json_schema_index_cache") == 1